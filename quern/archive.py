@@ -0,0 +1,332 @@
+import bz2
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import logging
+import lzma
+import os
+import tarfile
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger('quern')
+
+
+# Default level for each algorithm, used when build.compression_level is unset
+DEFAULT_LEVELS = {
+    'gzip': 6,
+    'bzip2': 9,
+    'xz': 6,
+    'zstd': 3,
+}
+
+LEVEL_RANGES = {
+    'gzip': (1, 9),
+    'bzip2': (1, 9),
+    'xz': (0, 9),
+    'zstd': (1, 22),
+}
+
+# Uncompressed size of each independently compressed block
+BLOCK_SIZES = {
+    'gzip': 4 * 1024 * 1024,
+    'bzip2': 9 * 100 * 1024 * 4,
+    'xz': 16 * 1024 * 1024,
+}
+
+
+def _gzip_block(level):
+    def compress(data):
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    return compress
+
+
+def _bzip2_block(level):
+    def compress(data):
+        return bz2.compress(data, compresslevel=level)
+    return compress
+
+
+def _xz_block(level):
+    def compress(data):
+        return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+    return compress
+
+
+# Leading bytes of compressed streams
+MAGICS = [
+    (b'BZh', 'bzip2'),
+    (b'\xfd7zXZ', 'xz'),
+    (b'\x1f\x8b', 'gzip'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+]
+
+
+def detect_algorithm(fileobj):
+    """Guess the compression of a seekable file from its first bytes."""
+    position = fileobj.tell()
+    magic = fileobj.read(6)
+    fileobj.seek(position)
+    for prefix, algorithm in MAGICS:
+        if magic.startswith(prefix):
+            return algorithm
+    raise ValueError("Unknown compression for %s" % getattr(fileobj, 'name', fileobj))
+
+
+BLOCK_COMPRESSORS = {
+    'gzip': _gzip_block,
+    'bzip2': _bzip2_block,
+    'xz': _xz_block,
+}
+
+
+def is_available(algorithm):
+    if algorithm == 'zstd':
+        return zstandard is not None
+    return algorithm in BLOCK_COMPRESSORS
+
+
+def effective_threads(threads):
+    return threads or os.cpu_count() or 1
+
+
+class BlockCompressor:
+    """File-like object compressing fixed-size blocks on a thread pool.
+
+    gzip, bzip2 and xz all accept concatenated members, so each block is
+    compressed on its own and the output stays readable by standard tools.
+    """
+
+    def __init__(self, fileobj, compress, block_size, threads):
+        self.fileobj = fileobj
+        self.compress = compress
+        self.block_size = block_size
+        self.max_pending = 2 * threads
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(self.compress, block))
+        # Bound memory usage: never keep more than 2 blocks per thread in flight
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # The output is discarded: drop pending blocks, and stop the workers
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown()
+
+
+class ZstdCompressor:
+    """File-like wrapper around zstandard's multi-threaded stream writer."""
+
+    def __init__(self, fileobj, level, threads):
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+        self.writer = compressor.stream_writer(fileobj, closefd=False)
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def make_compressor(fileobj, algorithm, level=None, threads=0):
+    if level is None:
+        level = DEFAULT_LEVELS[algorithm]
+    threads = effective_threads(threads)
+    if algorithm == 'zstd':
+        return ZstdCompressor(fileobj, level=level, threads=threads)
+    return BlockCompressor(
+        fileobj,
+        compress=BLOCK_COMPRESSORS[algorithm](level),
+        block_size=BLOCK_SIZES[algorithm],
+        threads=threads,
+    )
+
+
+ArchiveInfo = collections.namedtuple('ArchiveInfo', ['path', 'digest', 'size', 'diff_id'])
+
+
+class DigestWriter:
+    """Pass-through file-like object computing the sha256 of written data."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    @property
+    def digest(self):
+        return 'sha256:%s' % self.sha256.hexdigest()
+
+
+class DigestReader:
+    """Pass-through readable file-like object computing the sha256 of read data."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def readable(self):
+        return True
+
+    def drain(self, chunk_size=1024 * 1024):
+        while self.read(chunk_size):
+            pass
+
+    @property
+    def digest(self):
+        return 'sha256:%s' % self.sha256.hexdigest()
+
+
+def open_decompressor(fileobj, algorithm):
+    """Return a readable file-like object decompressing `fileobj`."""
+    if algorithm == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    elif algorithm == 'bzip2':
+        return bz2.BZ2File(fileobj, mode='rb')
+    elif algorithm == 'xz':
+        return lzma.LZMAFile(fileobj, mode='rb')
+    else:
+        assert algorithm == 'zstd'
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+
+
+class Decompressor:
+    """Incremental decompressor, accepting concatenated members."""
+
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.decompressor = self._make()
+
+    def _make(self):
+        if self.algorithm == 'gzip':
+            return zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        elif self.algorithm == 'bzip2':
+            return bz2.BZ2Decompressor()
+        elif self.algorithm == 'xz':
+            return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+        else:
+            assert self.algorithm == 'zstd'
+            return zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        chunks = []
+        while data:
+            chunks.append(self.decompressor.decompress(data))
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data
+                self.decompressor = self._make()
+            else:
+                data = b''
+        return b''.join(chunks)
+
+
+def write_archive(path, fill, algorithm, level=None, threads=0):
+    """Write a compressed tarball at `path`; `fill` receives the TarFile to populate.
+
+    Returns an ArchiveInfo with the digests of the compressed (digest) and
+    uncompressed (diff_id) streams.
+    """
+    tmp_path = '%s.partial' % path
+    try:
+        with open(tmp_path, 'wb') as f:
+            compressed = DigestWriter(f)
+            with make_compressor(compressed, algorithm, level=level, threads=threads) as compressor:
+                uncompressed = DigestWriter(compressor)
+                with tarfile.open(fileobj=uncompressed, mode='w|') as tar:
+                    fill(tar)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    return ArchiveInfo(path=path, digest=compressed.digest, size=compressed.size, diff_id=uncompressed.digest)
+
+
+def normalizer(mtime):
+    """Build a tarfile filter making entries independent of when and by whom files were written.
+
+    tarfile already adds folder contents in sorted order; integer mtimes
+    also avoid sub-second PAX headers.
+    """
+    def normalize(info):
+        info.mtime = mtime
+        info.uname = info.gname = ''
+        return info
+    return normalize
+
+
+def pack(root, path, algorithm, level=None, threads=0, mtime=None):
+    """Write the content of `root` to a compressed tarball at `path`.
+
+    With a `mtime`, all entries get that modification time and numeric owners only.
+    """
+    def fill(tar):
+        tar.add(root, arcname='.', filter=normalizer(mtime) if mtime is not None else None)
+
+    return write_archive(path, fill, algorithm, level=level, threads=threads)
+
+
+def pack_paths(root, paths, path, algorithm, level=None, threads=0, mtime=None):
+    """Write the given `root`-relative paths to a compressed tarball at `path`.
+
+    Paths are added without recursion, so folders must be listed explicitly.
+    """
+    entry_filter = normalizer(mtime) if mtime is not None else None
+
+    def fill(tar):
+        for relpath in sorted(paths):
+            tar.add(os.path.join(root, relpath), arcname=os.path.join('.', relpath), recursive=False, filter=entry_filter)
+
+    return write_archive(path, fill, algorithm, level=level, threads=threads)
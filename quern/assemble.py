@@ -0,0 +1,333 @@
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import logging
+import os
+import os.path
+import stat
+import struct
+import tarfile
+
+from . import archive
+from . import binpkgs
+from . import cache
+from . import fsutil
+from . import layers
+from . import profiles
+
+
+logger = logging.getLogger('quern')
+
+
+PLANS_FOLDER = '.quern-plans'
+
+# Packages running code at merge time are merged by emerge
+MERGE_PHASES = {'preinst', 'postinst'}
+
+# xpak entries needed to register a package in the package database
+REQUIRED_XPAK_KEYS = ('CATEGORY', 'PF')
+
+# Paths masked by FEATURES="nodoc noinfo noman" (strip.doc)
+STRIPPED_DOC_PATHS = ('usr/share/doc', 'usr/share/info', 'usr/share/man')
+
+_EXTRACT_OPTIONS = {'filter': 'fully_trusted'} if hasattr(tarfile, 'fully_trusted_filter') else {}
+
+
+def read_xpak(path):
+    """Read a binpkg's xpak metadata; returns (metadata, archive_size)."""
+    with open(path, 'rb') as f:
+        f.seek(-8, os.SEEK_END)
+        xpak_size, stop = struct.unpack('>I4s', f.read(8))
+        if stop != b'STOP':
+            raise ValueError("%s has no xpak trailer" % path)
+        archive_size = f.tell() - 8 - xpak_size
+        f.seek(archive_size)
+        segment = f.read(xpak_size)
+
+    if segment[:8] != b'XPAKPACK' or segment[-8:] != b'XPAKSTOP':
+        raise ValueError("%s has an invalid xpak segment" % path)
+    index_size, _data_size = struct.unpack('>II', segment[8:16])
+    index = segment[16:16 + index_size]
+    data = segment[16 + index_size:-8]
+
+    metadata = {}
+    offset = 0
+    while offset < len(index):
+        name_size, = struct.unpack('>I', index[offset:offset + 4])
+        name = index[offset + 4:offset + 4 + name_size].decode('utf-8')
+        data_offset, data_size = struct.unpack('>II', index[offset + 4 + name_size:offset + 12 + name_size])
+        metadata[name] = data[data_offset:data_offset + data_size]
+        offset += 12 + name_size
+    return metadata, archive_size
+
+
+class _BoundedReader:
+    """Read at most `size` bytes from a file; binpkg archives are followed by their xpak."""
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readable(self):
+        return True
+
+
+def plan_key(config):
+    """Identify the inputs of portage's dependency resolution."""
+    digest = hashlib.sha256()
+    base_profile = profiles.base_profile(config)
+    for profile in sorted({config.profile, base_profile}):
+        profiles.content_hash(profiles.chain(config, profile), digest)
+    inputs = {
+        'make.conf': list(config.make_conf_key_lines()),
+        'repos.conf': list(config.make_repos_conf_lines()),
+        'repositories': {
+            repo.name: cache.repository_revision(repo.location)
+            for repo in config.repositories
+        },
+        'profile': config.profile,
+        'base_profile': base_profile,
+        'include_system': config.include_system,
+        'baselayout_atoms': config.baselayout_atoms,
+    }
+    digest.update(json.dumps(inputs, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class Assembler:
+    """Assemble an image root straight from binpkgs, without emerge.
+
+    Builds going through emerge record their merge list (from the image's
+    package database) as a plan, keyed on the inputs of dependency
+    resolution. When a later build has the same key and all binpkgs of the
+    plan are still listed in the Packages index, they are extracted in
+    parallel to staging folders, then moved into the image root in merge
+    order; packages with pkg_preinst or pkg_postinst phases are merged by
+    `merge` (emerge) at their place in the order.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.root = config.workdir_image
+        self._key = None
+
+    @property
+    def enabled(self):
+        return bool(self.config.binpkg_dir)
+
+    @property
+    def key(self):
+        if self._key is None:
+            self._key = plan_key(self.config)
+        return self._key
+
+    @property
+    def plan_path(self):
+        return os.path.join(self.config.binpkg_dir, PLANS_FOLDER, '%s.json' % self.key)
+
+    def _index(self):
+        path = os.path.join(self.config.binpkg_dir, binpkgs.INDEX_NAME)
+        if not os.path.isfile(path):
+            return {}
+        _header, entries = binpkgs.read_index(path)
+        return {(entry['CPV'], entry.get('BUILD_ID', '')): entry for entry in entries}
+
+    def record(self, install_mask):
+        """Store the merge list of the image root as the plan for the current inputs."""
+        if not self.enabled:
+            return
+        if install_mask:
+            # Not applied by the assembler
+            logger.info("INSTALL_MASK is set, not recording a binpkg plan")
+            return
+
+        vdb = os.path.join(self.root, layers.VDB_PATH)
+        index = self._index()
+        packages = []
+        for cpv in layers.read_contents(self.root):
+            folder = os.path.join(vdb, cpv)
+
+            def read(name):
+                try:
+                    with open(os.path.join(folder, name), 'r', encoding='utf-8') as f:
+                        return f.read().strip()
+                except FileNotFoundError:
+                    return ''
+
+            entry = index.get((cpv, read('BUILD_ID')))
+            if entry is None:
+                logger.info("No binpkg for %s, not recording a binpkg plan", cpv)
+                return
+            packages.append({
+                'cpv': cpv,
+                'counter': int(read('COUNTER') or 0),
+                'path': binpkgs.entry_path(entry),
+                'size': int(entry.get('SIZE', 0)),
+                'phases': read('DEFINED_PHASES').split(),
+            })
+
+        packages.sort(key=lambda package: package['counter'])
+        os.makedirs(os.path.dirname(self.plan_path), exist_ok=True)
+        tmp_path = '%s.partial' % self.plan_path
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'profile': self.config.profile, 'packages': packages}, f, indent=2)
+        os.replace(tmp_path, self.plan_path)
+        logger.info("Recorded binpkg plan of %d packages as %s", len(packages), self.key)
+
+    def load(self):
+        """Return the planned packages if they can all be assembled from binpkgs, else None."""
+        if not self.enabled or os.path.isdir(self.root) and os.listdir(self.root):
+            return None
+
+        try:
+            with open(self.plan_path, 'r', encoding='utf-8') as f:
+                packages = json.load(f)['packages']
+        except FileNotFoundError:
+            logger.info("No binpkg plan for %s", self.key)
+            return None
+
+        indexed = {binpkgs.entry_path(entry): entry for entry in self._index().values()}
+        for package in packages:
+            entry = indexed.get(package['path'])
+            path = os.path.join(self.config.binpkg_dir, package['path'])
+            if entry is None or not os.path.isfile(path) or os.path.getsize(path) != package['size']:
+                logger.info("Binpkg %s of %s changed or missing, using emerge", package['path'], package['cpv'])
+                return None
+        return packages
+
+    def _stage(self, index, package):
+        """Extract a binpkg to its staging folder; returns (staging, metadata)."""
+        path = os.path.join(self.config.binpkg_dir, package['path'])
+        metadata, archive_size = read_xpak(path)
+        missing = [key for key in REQUIRED_XPAK_KEYS if key not in metadata]
+        if missing:
+            raise ValueError("%s has no %s in its xpak metadata" % (path, ', '.join(missing)))
+        staging = os.path.join(self.config.workdir, 'assemble', '%04d' % index)
+        fsutil.remove_tree(staging)
+        os.makedirs(staging)
+
+        with open(path, 'rb') as f:
+            algorithm = archive.detect_algorithm(f)
+            with archive.open_decompressor(_BoundedReader(f, archive_size), algorithm) as stream:
+                with tarfile.open(fileobj=stream, mode='r|') as tar:
+                    for member in tar:
+                        name = os.path.normpath(member.name).lstrip('/')
+                        if name == '.' or self.config.strip and name.startswith(STRIPPED_DOC_PATHS):
+                            continue
+                        member.name = name
+                        tar.extract(member, staging, **_EXTRACT_OPTIONS)
+
+        return staging, metadata
+
+    def _target(self, relpath):
+        """Resolve a path within the image root, following symlinked folders inside it."""
+        current = self.root
+        for part in relpath.split('/')[:-1]:
+            candidate = os.path.join(current, part)
+            for _hop in range(40):
+                if not os.path.islink(candidate):
+                    break
+                target = os.readlink(candidate)
+                if os.path.isabs(target):
+                    candidate = os.path.join(self.root, target.lstrip('/'))
+                else:
+                    candidate = os.path.normpath(os.path.join(os.path.dirname(candidate), target))
+            current = candidate
+        return os.path.join(current, relpath.split('/')[-1])
+
+    def _install(self, staging, counter, metadata):
+        """Move a staged package into the image root, and register it in the package database."""
+        contents = []
+        for dirpath, dirnames, filenames in os.walk(staging):
+            reldir = os.path.relpath(dirpath, staging)
+            for dirname in sorted(dirnames):
+                relpath = os.path.normpath(os.path.join(reldir, dirname))
+                source = os.path.join(dirpath, dirname)
+                target = self._target(relpath)
+                if os.path.islink(source):
+                    filenames.append(dirname)
+                    continue
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                    st = os.lstat(source)
+                    os.chown(target, st.st_uid, st.st_gid)
+                    os.chmod(target, stat.S_IMODE(st.st_mode))
+                contents.append('dir /%s' % relpath)
+
+            for filename in sorted(filenames):
+                relpath = os.path.normpath(os.path.join(reldir, filename))
+                source = os.path.join(dirpath, filename)
+                target = self._target(relpath)
+                st = os.lstat(source)
+                if stat.S_ISLNK(st.st_mode):
+                    contents.append('sym /%s -> %s %d' % (relpath, os.readlink(source), st.st_mtime))
+                elif stat.S_ISREG(st.st_mode):
+                    md5 = hashlib.md5()
+                    with open(source, 'rb') as f:
+                        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                            md5.update(chunk)
+                    contents.append('obj /%s %s %d' % (relpath, md5.hexdigest(), st.st_mtime))
+                else:
+                    contents.append('fif /%s' % relpath)
+                if os.path.isdir(target) and not os.path.islink(target):
+                    # Like portage, never replace a folder
+                    logger.warning("Not replacing folder /%s with a file from %s", relpath, staging)
+                    continue
+                os.replace(source, target)
+
+        category = metadata['CATEGORY'].decode('utf-8').strip()
+        pf = metadata['PF'].decode('utf-8').strip()
+        folder = os.path.join(self.root, layers.VDB_PATH, category, pf)
+        os.makedirs(folder)
+        for name, value in metadata.items():
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(value)
+        with open(os.path.join(folder, 'COUNTER'), 'w', encoding='utf-8') as f:
+            f.write('%d\n' % counter)
+        with open(os.path.join(folder, 'CONTENTS'), 'w', encoding='utf-8', errors='surrogateescape') as f:
+            f.write(''.join('%s\n' % line for line in contents))
+        fsutil.remove_tree(staging)
+
+    def assemble(self, packages, merge):
+        """Assemble the image root from the plan; merge(cpv) installs packages with merge-time phases."""
+        logger.info("Assembling %d packages from binpkgs into %s", len(packages), self.root)
+        os.makedirs(self.root, exist_ok=True)
+        staged = [package for package in packages if not MERGE_PHASES & set(package['phases'])]
+
+        workers = os.cpu_count() or 1
+        # Staging runs at most this many packages ahead of installation, to bound the space used by staging folders
+        ahead = 2 * workers
+        upcoming = iter(enumerate(staged))
+        futures = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            def fill():
+                for index, package in itertools.islice(upcoming, ahead - len(futures)):
+                    futures[id(package)] = executor.submit(self._stage, index, package)
+
+            fill()
+            for counter, package in enumerate(packages, 1):
+                if id(package) in futures:
+                    staging, metadata = futures.pop(id(package)).result()
+                    fill()
+                    self._install(staging, counter, metadata)
+                else:
+                    logger.info("Merging %s with emerge (defines %s)", package['cpv'], ', '.join(
+                        sorted(MERGE_PHASES & set(package['phases']))))
+                    # emerge numbers its merges from the package database counter
+                    self._write_counter(counter - 1)
+                    merge(package['cpv'])
+        self._write_counter(len(packages))
+
+    def _write_counter(self, counter):
+        path = os.path.join(self.root, 'var', 'cache', 'edb', 'counter')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('%d' % counter)
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import logging
+import os
+import os.path
+
+from . import cache
+from . import fsutil
+from . import profiles
+
+
+logger = logging.getLogger('quern')
+
+
+class BaseRootCache:
+    """Pre-populated image roots (baselayout atoms and @system), shared between builds.
+
+    Roots are keyed on the base profile's parent chain, the generated portage
+    configuration and the merged atoms; a hit is cloned into the image root so
+    that emerge only needs to add the profile-specific packages.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.profile = profiles.base_profile(config)
+        self._key = None
+
+    @property
+    def enabled(self):
+        return bool(self.config.roots_cache_dir)
+
+    @property
+    def key(self):
+        if self._key is None:
+            digest = hashlib.sha256()
+            profiles.content_hash(profiles.chain(self.config, self.profile), digest)
+            inputs = {
+                'make.conf': list(self.config.make_conf_key_lines()),
+                'repos.conf': list(self.config.make_repos_conf_lines()),
+                'repositories': {
+                    repo.name: cache.repository_revision(repo.location)
+                    for repo in self.config.repositories
+                },
+                'profile': self.profile,
+                'include_system': self.config.include_system,
+                'baselayout_atoms': self.config.baselayout_atoms,
+            }
+            digest.update(json.dumps(inputs, sort_keys=True).encode('utf-8'))
+            self._key = digest.hexdigest()
+        return self._key
+
+    @property
+    def root_path(self):
+        return os.path.join(self.config.roots_cache_dir, self.key)
+
+    def restore(self):
+        """Clone a cached root into the image root; returns whether one was found."""
+        if not self.enabled:
+            return False
+
+        if not os.path.isdir(self.root_path):
+            logger.info("No cached base root for %s (key=%s)", self.profile, self.key)
+            return False
+
+        logger.info("Starting from cached base root %s", self.root_path)
+        fsutil.clone_tree(self.root_path, self.config.workdir_image)
+        return True
+
+    def store(self):
+        if not self.enabled or os.path.isdir(self.root_path):
+            return
+
+        logger.info("Storing base root for %s at %s", self.profile, self.root_path)
+        tmp_path = '%s.partial' % self.root_path
+        fsutil.clone_tree(self.config.workdir_image, tmp_path)
+        try:
+            os.rename(tmp_path, self.root_path)
+        except OSError:
+            # Another build stored the same root in the meantime
+            fsutil.remove_tree(tmp_path)
@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import os.path
+import time
+
+from . import layers
+from . import locks
+
+
+logger = logging.getLogger('quern')
+
+
+USAGE_FOLDER = '.quern-usage'
+INDEX_NAME = 'Packages'
+BINPKG_SUFFIXES = ('.tbz2', '.xpak', '.gpkg.tar')
+
+MB = 1024 * 1024
+DAY = 24 * 3600
+
+def read_index(path):
+    """Parse a Packages index into (header, entries); each a dict of fields."""
+    with open(path, 'r', encoding='utf-8') as f:
+        blocks = f.read().split('\n\n')
+
+    def parse(block):
+        fields = {}
+        for line in block.splitlines():
+            key, _sep, value = line.partition(': ')
+            fields[key] = value
+        return fields
+
+    header = parse(blocks[0])
+    entries = [parse(block) for block in blocks[1:] if block.strip()]
+    return header, entries
+
+
+def write_index(path, header, entries):
+    def format_block(fields):
+        return ''.join('%s: %s\n' % (key, value) for key, value in fields.items())
+
+    tmp_path = '%s.partial' % path
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(format_block(header))
+        for entry in entries:
+            f.write('\n')
+            f.write(format_block(entry))
+    os.replace(tmp_path, path)
+
+
+def entry_path(entry):
+    return entry.get('PATH') or '%s.tbz2' % entry['CPV']
+
+
+class BinpkgStore:
+    """Track binpkg usage, and keep PKGDIR under portage.binpkg_max_size.
+
+    Each build records the binpkgs of the packages installed in its image
+    in PKGDIR/.quern-usage/usage.json; eviction removes the least recently used
+    binpkgs first, never those used or written in the last
+    portage.binpkg_keep_days, and drops their entries from the Packages
+    index instead of having portage rescan the whole folder.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.root = config.binpkg_dir
+
+    @property
+    def usage_folder(self):
+        return os.path.join(self.root, USAGE_FOLDER)
+
+    @property
+    def usage_path(self):
+        return os.path.join(self.usage_folder, 'usage.json')
+
+    def _load_usage(self):
+        try:
+            with open(self.usage_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_usage(self, usage):
+        tmp_path = '%s.partial' % self.usage_path
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(usage, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.usage_path)
+
+    def binpkgs(self):
+        """Yield (relpath, stat) for all binpkgs of the store."""
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if filename.endswith(BINPKG_SUFFIXES):
+                    path = os.path.join(dirpath, filename)
+                    yield os.path.relpath(path, self.root), os.stat(path)
+
+    def record(self, image_root):
+        """Mark the binpkgs of the packages installed in an image root as used.
+
+        With binpkg-multi-instance, only the instance matching the package's
+        BUILD_ID is marked: older builds of the same version stay evictable.
+        """
+        index_path = os.path.join(self.root or '', INDEX_NAME)
+        if not (self.root and os.path.isfile(index_path)):
+            return
+
+        _header, entries = read_index(index_path)
+        index = {(entry['CPV'], entry.get('BUILD_ID', '')): entry for entry in entries}
+        vdb = os.path.join(image_root, layers.VDB_PATH)
+        used = set()
+        for cpv in layers.read_contents(image_root):
+            try:
+                with open(os.path.join(vdb, cpv, 'BUILD_ID'), 'r', encoding='utf-8') as f:
+                    build_id = f.read().strip()
+            except FileNotFoundError:
+                build_id = ''
+            entry = index.get((cpv, build_id))
+            if entry is not None:
+                used.add(entry_path(entry))
+
+        now = time.time()
+        with locks.exclusive(self.usage_folder):
+            usage = self._load_usage()
+            usage.update((relpath, now) for relpath in used)
+            self._write_usage(usage)
+        logger.info("Recorded %d binpkgs used by %s", len(used), self.config.profile)
+
+    def prune(self, wait=False):
+        """Evict least recently used binpkgs until the store fits in its budget.
+
+        Other builds may be using the store: unless `wait` is set, pruning is
+        skipped when the store is busy.
+        """
+        if not (self.root and self.config.binpkg_max_size):
+            return
+
+        lock = locks.exclusive(self.root) if wait else locks.exclusive_nowait(self.root)
+        with lock as acquired:
+            if acquired is False:
+                logger.info("Binpkgs at %s are in use, pruning them later", self.root)
+                return
+            with locks.exclusive(self.usage_folder):
+                self._prune()
+
+    def _prune(self):
+        budget = self.config.binpkg_max_size * MB
+        protected_since = time.time() - self.config.binpkg_keep_days * DAY
+        usage = self._load_usage()
+
+        files = []
+        total = 0
+        for relpath, stat in self.binpkgs():
+            last_used = max(usage.get(relpath, 0), stat.st_mtime)
+            files.append((last_used, relpath, stat.st_size))
+            total += stat.st_size
+
+        if total <= budget:
+            logger.info("Binpkgs use %d MB out of %d MB", total // MB, budget // MB)
+            return
+
+        evicted = set()
+        for last_used, relpath, size in sorted(files):
+            if total <= budget:
+                break
+            if last_used >= protected_since:
+                logger.warning(
+                    "Binpkgs use %d MB out of %d MB, but the remaining ones were used in the last %d days",
+                    total // MB, budget // MB, self.config.binpkg_keep_days,
+                )
+                break
+            os.unlink(os.path.join(self.root, relpath))
+            usage.pop(relpath, None)
+            evicted.add(relpath)
+            total -= size
+
+        logger.info("Evicted %d binpkgs from %s, %d MB left", len(evicted), self.root, total // MB)
+        self._write_usage(usage)
+        self._update_index(evicted)
+
+    def _update_index(self, evicted):
+        path = os.path.join(self.root, INDEX_NAME)
+        if not evicted or not os.path.isfile(path):
+            return
+
+        header, entries = read_index(path)
+        entries = [entry for entry in entries if entry_path(entry) not in evicted]
+        if 'PACKAGES' in header:
+            header['PACKAGES'] = str(len(entries))
+        header['TIMESTAMP'] = str(int(time.time()))
+        write_index(path, header, entries)
@@ -3,47 +3,91 @@
 import getconf
 import sys
 
+from . import binpkgs
 from . import core
-from . import drivers
-from . import postbuild
+from . import matrix
+from . import planner
+from . import runner
 
 
 NAMESPACE = 'quern'
 
+FLAGS = ('--resume', '--matrix', '--prune-binpkgs', '--plan')
+
+
+def load_config(config_files, resume=False):
+    getter = getconf.ConfigGetter(NAMESPACE, config_files)
+    config = core.Config(getter, NAMESPACE)
+    if resume:
+        config.resume = True
+    return getter, config
+
 
 def main(argv=sys.argv):
     core.setup_logging()
 
+    args = argv[1:]
+    flags = {arg for arg in args if arg in FLAGS}
+    args = [arg for arg in args if arg not in FLAGS]
+
     display_help = False
-    if len(argv) == 1 or argv[1] in ('-h', '--help'):
+    if not args or args[0] in ('-h', '--help'):
         display_help = True
         config_files = []
 
     else:
-        config_files = argv[1:]
+        config_files = args
 
-    getter = getconf.ConfigGetter(NAMESPACE, config_files)
-    config = core.Config(getter, NAMESPACE)
+    getter, config = load_config(config_files, resume='--resume' in flags)
 
     if display_help:
         # Help requested
-        print("Usage: %s path/to/example.conf" % argv[0])
+        print("Usage: %s [--resume] path/to/example.conf" % argv[0])
+        print("       %s [--resume] --matrix path/to/first.conf path/to/second.conf ..." % argv[0])
+        print("       %s --prune-binpkgs path/to/example.conf" % argv[0])
+        print("       %s --plan path/to/example.conf" % argv[0])
         print("\nExample configuration file:\n\n")
         print(getter.get_ini_template())
         return
 
-    config.check()
+    if '--prune-binpkgs' in flags:
+        # Maintenance: wait for running builds to release the binpkgs
+        binpkgs.BinpkgStore(config).prune(wait=True)
+        return
 
-    driver = drivers.load(config.driver, config)
+    if config.plan_file:
+        # Running in a builder container for `--plan`
+        config.check()
+        planner.Planner(config).resolve()
+        return
 
-    driver.setup()
-    driver.build()
+    if '--plan' in flags:
+        config.check()
+        build_planner = planner.Planner(config)
+        planner.log_estimate(config, build_planner.estimate(build_planner.plan()))
+        return
 
-    for engine_name in config.postbuild_engines:
-        engine = postbuild.load(engine_name, config)
-        engine.run()
+    if '--matrix' in flags:
+        # One build per configuration file
+        configs = [load_config([path], resume='--resume' in flags)[1] for path in config_files]
+    elif config.matrix_profiles:
+        configs = [config]
+    else:
+        config.check()
+        runner.build(config)
+        return
 
+    core.setup_logging(concurrent=True)
+    scheduler = matrix.Scheduler(
+        matrix.expand(configs),
+        jobs=config.matrix_jobs,
+    )
+    scheduler.check()
+    results = scheduler.run()
+    matrix.log_summary(results)
+    if any(result.status == runner.STATUS_FAILED for result in results):
+        return 1
 
-if __name__ == '__main__':
-    main(sys.argv)
 
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,85 @@
+import collections
+import gzip
+import logging
+import os
+import os.path
+import re
+
+
+logger = logging.getLogger('quern')
+
+
+_EMERGING_RE = re.compile(rb'^>>> Emerging (?:binary )?\(\d+ of \d+\) (\S+)')
+_PACKAGE_END_RE = re.compile(rb'^>>> (Auto-cleaning|INFO: Stage )')
+# Lines shown on the console in 'progress' mode: quern's own messages and emerge's progress
+_PROGRESS_RE = re.compile(rb'^>>> (INFO|WARNING|ERROR|Emerging|Installing|Completed|Jobs)')
+_ANSI_RE = re.compile(rb'\x1b\[[0-9;]*[A-Za-z]')
+
+
+class BuildLog:
+    """Store a builder's output in compressed files, outside of the logging stack.
+
+    The full stream goes to <image>.logs/build.log.gz, and each package's
+    output to its own file; the console only shows progress lines, and the
+    last log.tail lines are kept in memory to be dumped on failure.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.folder = os.path.join(config.outdir, '%s.logs' % config.image_basename)
+        os.makedirs(self.folder, exist_ok=True)
+        self.main = gzip.open(os.path.join(self.folder, 'build.log.gz'), 'wb')
+        self.tail = collections.deque(maxlen=config.log_tail)
+        self.partial = b''
+        self.package = None
+        self.package_file = None
+
+    def feed(self, data):
+        """Process a chunk of output; returns its complete lines, decoded."""
+        self.main.write(data)
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        return [self._line(line) for line in lines]
+
+    def _line(self, line):
+        clean = _ANSI_RE.sub(b'', line).rstrip(b'\r')
+        self.tail.append(clean)
+
+        match = _EMERGING_RE.match(clean)
+        if match:
+            self._switch_package(match.group(1).split(b'::')[0].decode('utf-8', 'replace'))
+        elif _PACKAGE_END_RE.match(clean):
+            self._switch_package(None)
+        if self.package_file is not None:
+            self.package_file.write(line + b'\n')
+
+        text = clean.decode('utf-8', 'replace')
+        if self.config.log_console == 'full' or _PROGRESS_RE.match(clean):
+            logger.info("  logs: %s", text)
+        return text
+
+    def _switch_package(self, package):
+        if package == self.package:
+            return
+        if self.package_file is not None:
+            self.package_file.close()
+            self.package_file = None
+
+        self.package = package
+        if package is not None:
+            path = os.path.join(self.folder, '%s.log.gz' % package.replace('/', '_'))
+            # Append: a package may show up in several emerge runs
+            self.package_file = gzip.open(path, 'ab')
+
+    def close(self, success=True):
+        if self.partial:
+            self._line(self.partial)
+            self.partial = b''
+        self._switch_package(None)
+        self.main.close()
+
+        if not success:
+            logger.error("Last %d lines of builder output:", len(self.tail))
+            for line in self.tail:
+                logger.error("  logs: %s", line.decode('utf-8', 'replace'))
+        logger.info("Builder logs available in %s", self.folder)
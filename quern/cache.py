@@ -0,0 +1,201 @@
+import hashlib
+import json
+import logging
+import os
+import os.path
+import shutil
+import subprocess
+
+from . import core
+from .version import VERSION
+
+
+logger = logging.getLogger('quern')
+
+
+def repository_revision(location):
+    """Compute a cheap identifier for the current state of a repository.
+
+    Uses, in order: the git revision (if the tree is clean), the rsync
+    timestamp written by `emerge --sync`, or a hash of all file sizes and mtimes.
+    """
+    if os.path.isdir(os.path.join(location, '.git')):
+        try:
+            head = subprocess.check_output(
+                ['git', '-C', location, 'rev-parse', 'HEAD'],
+                stderr=subprocess.DEVNULL,
+            ).decode('ascii').strip()
+            dirty = subprocess.check_output(
+                ['git', '-C', location, 'status', '--porcelain', '--untracked-files=no'],
+                stderr=subprocess.DEVNULL,
+            )
+        except (OSError, subprocess.CalledProcessError):
+            pass
+        else:
+            if not dirty:
+                return 'git:%s' % head
+
+    timestamp = os.path.join(location, 'metadata', 'timestamp.chk')
+    if os.path.isfile(timestamp) and not os.path.isdir(os.path.join(location, '.git')):
+        with open(timestamp, 'r', encoding='utf-8') as f:
+            return 'timestamp:%s' % f.read().strip()
+
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(location):
+        dirnames[:] = sorted(d for d in dirnames if d not in ('.git', 'distfiles', 'packages'))
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            digest.update(('%s\0%d\0%d\n' % (
+                os.path.relpath(path, location), st.st_size, st.st_mtime_ns,
+            )).encode('utf-8', 'surrogateescape'))
+    return 'stat:%s' % digest.hexdigest()
+
+
+def link_or_copy(source, target):
+    """Hard-link source to target, falling back to a copy across filesystems."""
+    tmp_target = '%s.partial' % target
+    if os.path.lexists(tmp_target):
+        os.unlink(tmp_target)
+    try:
+        os.link(source, tmp_target)
+    except OSError:
+        shutil.copy2(source, tmp_target)
+    os.replace(tmp_target, target)
+
+
+class BuildCache:
+    """Content-addressed store of built archives, keyed on all build inputs."""
+
+    def __init__(self, config):
+        self.config = config
+        self._key = None
+
+    @property
+    def enabled(self):
+        return bool(self.config.cache_dir)
+
+    def _docker_image_id(self):
+        """Resolve the builder image, so that rebuilding it under the same tag changes the key."""
+        if not self.config.uses_docker:
+            return ''
+        # Only docker builds need docker-py
+        from .drivers import docker as docker_driver
+        client = docker_driver.get_client(self.config.docker_address)
+        return client.inspect_image(self.config.docker_image)['Id']
+
+    def inputs(self):
+        return {
+            'quern': VERSION,
+            'driver': self.config.driver,
+            'docker_image': self._docker_image_id(),
+            'make.conf': list(self.config.make_conf_key_lines()),
+            'repos.conf': list(self.config.make_repos_conf_lines()),
+            'repositories': {
+                repo.name: repository_revision(repo.location)
+                for repo in self.config.repositories
+            },
+            'unblocker_profile': self.config.unblocker_profile,
+            'profile': self.config.profile,
+            'base_profile': self.config.base_profile,
+            'include_system': self.config.include_system,
+            'baselayout_atoms': self.config.baselayout_atoms,
+            'strip': self.config.strip,
+            'strip_folders': self.config.strip_folders,
+            'strip_patterns': self.config.strip_patterns,
+            'strip_exclude': self.config.strip_exclude,
+            'strip_elf': self.config.strip_elf,
+            'strip_dedupe': self.config.strip_dedupe,
+            'minimize': [
+                self.config.dockergen_entrypoint, self.config.dockergen_command, self.config.minimize_keep,
+            ] if self.config.minimize else None,
+            'compression': self.config.image_compression,
+            'compression_level': self.config.image_compression_level,
+            'mtime': self.config.archive_mtime,
+            'layers': [self.config.layers_groups, self.config.layers_volatile_changes] if self.config.layers_enabled else None,
+        }
+
+    @property
+    def key(self):
+        if self._key is None:
+            self._inputs = self.inputs()
+            serialized = json.dumps(self._inputs, sort_keys=True).encode('utf-8')
+            self._key = hashlib.sha256(serialized).hexdigest()
+        return self._key
+
+    def _entry_path(self, suffix):
+        return os.path.join(self.config.cache_dir, self.key[:2], '%s%s' % (self.key, suffix))
+
+    @property
+    def archive_path(self):
+        return self._entry_path('.tar.%s' % core.COMPRESSION_SUFFIXES[self.config.image_compression])
+
+    def restore(self):
+        """Restore a cached archive to config.image_path; returns whether it was found."""
+        if not self.enabled:
+            return False
+
+        logger.info("Build key: %s", self.key)
+        if not os.path.isfile(self.archive_path):
+            logger.info("No cached image for this build key")
+            return False
+
+        if self.config.layers_enabled and not os.path.isfile(self._entry_path('.layers.json')):
+            logger.info("Cached image has no layers, rebuilding")
+            return False
+
+        logger.info("Reusing cached image %s", self.archive_path)
+        os.makedirs(self.config.outdir, exist_ok=True)
+        link_or_copy(self.archive_path, self.config.image_path)
+        if self.config.layers_enabled:
+            self._restore_layers()
+        return True
+
+    def _layer_entry_path(self, index, layer):
+        return self._entry_path('.layer-{index:02d}-{name}.tar.{suffix}'.format(
+            index=index,
+            name=layer['name'],
+            suffix=core.COMPRESSION_SUFFIXES[self.config.image_compression],
+        ))
+
+    def _restore_layers(self):
+        with open(self._entry_path('.layers.json'), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+
+        for index, layer in enumerate(manifest['layers']):
+            layer_path = self.config.layer_path(index, layer['name'])
+            link_or_copy(self._layer_entry_path(index, layer), layer_path)
+            layer['file'] = os.path.basename(layer_path)
+
+        manifest['image'] = self.config.image_name
+        with open(self.config.layers_manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+
+    def _store_layers(self):
+        with open(self.config.layers_manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+
+        for index, layer in enumerate(manifest['layers']):
+            link_or_copy(os.path.join(self.config.outdir, layer['file']), self._layer_entry_path(index, layer))
+
+        with open(self._entry_path('.layers.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+
+    def store(self):
+        if not self.enabled:
+            return
+
+        if not os.path.isfile(self.config.image_path):
+            raise core.BuildError("Expected image at %s, not found" % self.config.image_path)
+
+        logger.info("Storing image in build cache as %s", self.archive_path)
+        os.makedirs(os.path.dirname(self.archive_path), exist_ok=True)
+        with open(self._entry_path('.json'), 'w', encoding='utf-8') as f:
+            json.dump(self._inputs, f, indent=2, sort_keys=True)
+        if self.config.layers_enabled:
+            self._store_layers()
+        # The main archive comes last: its presence marks a complete entry
+        link_or_copy(self.config.image_path, self.archive_path)
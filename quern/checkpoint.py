@@ -0,0 +1,111 @@
+import hashlib
+import json
+import logging
+import os
+import os.path
+
+from . import fsutil
+
+
+logger = logging.getLogger('quern')
+
+
+def fingerprint(config):
+    """Identify the build inputs a checkpoint is valid for."""
+    inputs = {
+        'make.conf': list(config.make_conf_key_lines()),
+        'repos.conf': list(config.make_repos_conf_lines()),
+        'profile': config.profile,
+        'base_profile': config.base_profile,
+        'include_system': config.include_system,
+        'baselayout_atoms': config.baselayout_atoms,
+        'layers': config.layers_enabled,
+        'strip_folders': config.strip_folders,
+        'strip_patterns': config.strip_patterns,
+        'strip_exclude': config.strip_exclude,
+        'strip_elf': config.strip_elf,
+        'strip_dedupe': config.strip_dedupe,
+        'minimize': [config.dockergen_entrypoint, config.dockergen_command, config.minimize_keep] if config.minimize else None,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Checkpoints:
+    """Completion markers and image snapshots for the stages of a build.
+
+    Only the snapshot of the latest completed stage is kept, under
+    <build.workdir>/checkpoints.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.root = os.path.join(config.workdir, 'checkpoints')
+        self.state_path = os.path.join(self.root, 'state.json')
+        self.fingerprint = fingerprint(config)
+
+    def _snapshot_path(self, stage):
+        return os.path.join(self.root, stage)
+
+    def _read_state(self):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'fingerprint': None, 'completed': []}
+
+    def _write_state(self, state):
+        tmp_path = '%s.partial' % self.state_path
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def restore(self, stages):
+        """Restore the image after the last completed stage.
+
+        Returns the list of stages that need not be run again.
+        """
+        state = self._read_state()
+        if not state['completed']:
+            logger.info("No checkpoint found, building from scratch")
+            return []
+        if state['fingerprint'] != self.fingerprint:
+            logger.warning("Checkpoints were created with a different configuration, building from scratch")
+            self.clear()
+            return []
+
+        done = []
+        for stage in stages:
+            if stage not in state['completed']:
+                break
+            done.append(stage)
+
+        if not done or not os.path.isdir(self._snapshot_path(done[-1])):
+            logger.warning("Checkpoint snapshot missing, building from scratch")
+            self.clear()
+            return []
+
+        logger.info("Resuming after stage %s", done[-1])
+        fsutil.clone_tree(self._snapshot_path(done[-1]), self.config.workdir_image)
+        return done
+
+    def record(self, stage):
+        state = self._read_state()
+        if state['fingerprint'] != self.fingerprint:
+            state = {'fingerprint': self.fingerprint, 'completed': []}
+        previous = state['completed'][-1] if state['completed'] else None
+
+        logger.info("Recording checkpoint for stage %s", stage)
+        os.makedirs(self.root, exist_ok=True)
+        if os.path.isdir(self.config.workdir_image):
+            fsutil.clone_tree(self.config.workdir_image, self._snapshot_path(stage))
+        else:
+            os.makedirs(self._snapshot_path(stage), exist_ok=True)
+
+        state['completed'].append(stage)
+        self._write_state(state)
+
+        if previous and previous != stage:
+            fsutil.remove_tree(self._snapshot_path(previous))
+
+    def clear(self):
+        fsutil.remove_tree(self.root)
@@ -0,0 +1,323 @@
+import glob
+import json
+import logging
+import os
+import os.path
+import stat
+import struct
+
+from . import core
+from . import strip
+
+
+logger = logging.getLogger('quern')
+
+
+# Searched by the dynamic linker after RPATH/RUNPATH and ld.so.conf folders
+DEFAULT_LIBRARY_PATH = ['/lib64', '/usr/lib64', '/lib', '/usr/lib']
+# PATH used to resolve the entrypoint, as in a docker container
+DEFAULT_PATH = ['/usr/local/sbin', '/usr/local/bin', '/usr/sbin', '/usr/bin', '/sbin', '/bin']
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+# Symlink hops before giving up on a path
+MAX_LINKS = 40
+
+
+def read_elf(path):
+    """Read the dynamic linking information of an ELF file.
+
+    Returns (interpreter, needed, search_paths) or None if the file isn't ELF.
+    """
+    with open(path, 'rb') as f:
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != strip.ELF_MAGIC:
+            return None
+        is_64 = ident[4] == 2
+        endian = '<' if ident[5] == 1 else '>'
+
+        if is_64:
+            header = struct.unpack(endian + 'HHIQQQIHHHHHH', f.read(48))
+            phoff, phentsize, phnum = header[4], header[8], header[9]
+            phdr_format, dyn_format = endian + 'IIQQQQQQ', endian + 'qQ'
+        else:
+            header = struct.unpack(endian + 'HHIIIIIHHHHHH', f.read(36))
+            phoff, phentsize, phnum = header[4], header[8], header[9]
+            phdr_format, dyn_format = endian + 'IIIIIIII', endian + 'iI'
+
+        segments = []
+        for index in range(phnum):
+            f.seek(phoff + index * phentsize)
+            fields = struct.unpack(phdr_format, f.read(struct.calcsize(phdr_format)))
+            if is_64:
+                p_type, _flags, p_offset, p_vaddr, _paddr, p_filesz = fields[:6]
+            else:
+                p_type, p_offset, p_vaddr, _paddr, p_filesz = fields[:5]
+            segments.append((p_type, p_offset, p_vaddr, p_filesz))
+
+        interpreter = None
+        dynamic = []
+        for p_type, p_offset, _vaddr, p_filesz in segments:
+            if p_type == PT_INTERP:
+                f.seek(p_offset)
+                interpreter = f.read(p_filesz).split(b'\0')[0].decode('utf-8', 'surrogateescape')
+            elif p_type == PT_DYNAMIC:
+                f.seek(p_offset)
+                data = f.read(p_filesz)
+                size = struct.calcsize(dyn_format)
+                for offset in range(0, len(data) - size + 1, size):
+                    tag, value = struct.unpack(dyn_format, data[offset:offset + size])
+                    if tag == DT_NULL:
+                        break
+                    dynamic.append((tag, value))
+
+        # DT_STRTAB is an address; find the loaded segment holding it
+        strtab = None
+        for tag, value in dynamic:
+            if tag == DT_STRTAB:
+                for p_type, p_offset, p_vaddr, p_filesz in segments:
+                    if p_type == PT_LOAD and p_vaddr <= value < p_vaddr + p_filesz:
+                        strtab = value - p_vaddr + p_offset
+
+        def string(offset):
+            f.seek(strtab + offset)
+            chunk = f.read(4096)
+            return chunk.split(b'\0')[0].decode('utf-8', 'surrogateescape')
+
+        needed = []
+        search_paths = []
+        if strtab is not None:
+            for tag, value in dynamic:
+                if tag == DT_NEEDED:
+                    needed.append(string(value))
+                elif tag in (DT_RPATH, DT_RUNPATH):
+                    search_paths.extend(part for part in string(value).split(':') if part)
+        return interpreter, needed, search_paths
+
+
+class RuntimeClosure:
+    """Drop the files of an image root that its entrypoint can't use at runtime.
+
+    The closure starts from dockergen.entrypoint and dockergen.command, and
+    the files matching minimize.keep globs (a matching folder keeps all its
+    contents); it follows symlinks, script interpreters (#!), ELF
+    interpreters and DT_NEEDED libraries, searched like the dynamic linker
+    does (RPATH/RUNPATH, ld.so.conf, musl's ld-musl-*.path, default folders).
+    Other files and symlinks are removed; folders are kept. Files loaded at
+    runtime otherwise (Python modules, plugins, data) must be listed in
+    minimize.keep.
+
+    A DT_NEEDED library missing from the image fails the build, unless
+    minimize.allow_missing_libraries is set: all library folders are then kept.
+    """
+
+    def __init__(self, config, root):
+        self.config = config
+        self.root = root
+        self.keep = [strip.compile_pattern(pattern) for pattern in config.minimize_keep]
+        self._library_path = None
+
+    @property
+    def report_path(self):
+        return os.path.join(self.config.outdir, '%s.minimize.json' % self.config.image_basename)
+
+    def _host_path(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def _read_lines(self, path):
+        try:
+            with open(self._host_path(path), 'r', encoding='utf-8', errors='replace') as f:
+                return [line.split('#')[0].strip() for line in f]
+        except (FileNotFoundError, IsADirectoryError):
+            return []
+
+    def _ld_so_conf(self, path, seen):
+        folders = []
+        for line in self._read_lines(path):
+            if line.startswith('include'):
+                for pattern in line.split()[1:]:
+                    if not pattern.startswith('/'):
+                        pattern = os.path.join(os.path.dirname(path), pattern)
+                    for included in sorted(glob.glob(self._host_path(pattern))):
+                        included = '/' + os.path.relpath(included, self.root)
+                        if included not in seen:
+                            seen.add(included)
+                            folders.extend(self._ld_so_conf(included, seen))
+            elif line:
+                folders.extend(line.replace(',', ' ').split())
+        return folders
+
+    @property
+    def library_path(self):
+        if self._library_path is None:
+            folders = self._ld_so_conf('/etc/ld.so.conf', {'/etc/ld.so.conf'})
+            for musl_path in sorted(glob.glob(self._host_path('/etc/ld-musl-*.path'))):
+                for line in self._read_lines('/' + os.path.relpath(musl_path, self.root)):
+                    folders.extend(part for part in line.replace(':', ' ').split())
+            self._library_path = folders + DEFAULT_LIBRARY_PATH
+        return self._library_path
+
+    def _resolve(self, path, kept):
+        """Follow the symlinks of an image path within the image, adding them to `kept`.
+
+        Returns the final path, or None if it doesn't exist.
+        """
+        path = os.path.normpath('/' + path.lstrip('/'))
+        for _hop in range(MAX_LINKS):
+            # Find the first symlink along the path; its parents are real folders
+            parts = path.strip('/').split('/')
+            for index in range(len(parts)):
+                current = '/' + '/'.join(parts[:index + 1])
+                host = self._host_path(current)
+                if os.path.islink(host):
+                    kept.add(current)
+                    target = os.readlink(host)
+                    if not target.startswith('/'):
+                        target = os.path.join(os.path.dirname(current), target)
+                    path = os.path.normpath(os.path.join(target, *parts[index + 1:]))
+                    break
+                if not os.path.lexists(host):
+                    return None
+            else:
+                return path
+        return None
+
+    def _find_library(self, name, search_paths):
+        if '/' in name:
+            return name
+        for folder in search_paths + self.library_path:
+            candidate = os.path.join(folder, name)
+            if self._resolve(candidate, set()) is not None:
+                return candidate
+        return None
+
+    def _dependencies(self, path):
+        """List the image paths a file needs at runtime."""
+        host = self._host_path(path)
+        try:
+            with open(host, 'rb') as f:
+                head = f.read(256)
+        except OSError:
+            return []
+
+        if head.startswith(b'#!'):
+            words = head[2:].split(b'\n')[0].decode('utf-8', 'replace').split()
+            if not words:
+                return []
+            dependencies = [words[0]]
+            if os.path.basename(words[0]) == 'env' and len(words) > 1:
+                dependencies.append(self._find_executable(words[1]))
+            return dependencies
+
+        try:
+            elf = read_elf(host)
+        except (struct.error, OSError, ValueError):
+            logger.warning("Unable to parse ELF file %s, keeping it without its libraries", path)
+            return []
+        if elf is None:
+            return []
+
+        interpreter, needed, search_paths = elf
+        origin = os.path.dirname(path)
+        search_paths = [
+            folder.replace('$ORIGIN', origin).replace('${ORIGIN}', origin)
+            for folder in search_paths
+        ]
+        dependencies = [interpreter] if interpreter else []
+        for name in needed:
+            library = self._find_library(name, search_paths)
+            if library is None:
+                if not self.config.minimize_allow_missing_libraries:
+                    raise core.BuildError("%s needs %s, which is not in the image" % (path, name))
+                logger.warning("%s needs %s, which is not in the image; keeping all library folders", path, name)
+                dependencies.extend(search_paths + self.library_path)
+            else:
+                dependencies.append(library)
+        return dependencies
+
+    def _find_executable(self, name):
+        if '/' in name:
+            return name
+        for folder in DEFAULT_PATH:
+            candidate = os.path.join(folder, name)
+            if self._resolve(candidate, set()) is not None:
+                return candidate
+        return None
+
+    def _kept_by_pattern(self, relpath):
+        parts = relpath.split('/')
+        return any(
+            pattern.match('/'.join(parts[:depth]))
+            for depth in range(1, len(parts) + 1)
+            for pattern in self.keep
+        )
+
+    def _roots(self):
+        roots = []
+        # Docker runs the command as arguments of the entrypoint
+        command = self.config.dockergen_entrypoint + self.config.dockergen_command
+        if command:
+            roots.append(self._find_executable(command[0]))
+        # Absolute paths in arguments, e.g a script run by the entrypoint
+        roots.extend(arg for arg in command[1:] if arg.startswith('/'))
+
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in dirnames + filenames:
+                host = os.path.join(dirpath, name)
+                relpath = os.path.relpath(host, self.root)
+                if (name in filenames or os.path.islink(host)) and self._kept_by_pattern(relpath):
+                    roots.append('/' + relpath)
+        return [root for root in roots if root]
+
+    def compute(self):
+        """Return the set of image paths in the runtime closure."""
+        kept = set()
+        pending = self._roots()
+        while pending:
+            resolved = self._resolve(pending.pop(), kept)
+            if resolved is None or resolved in kept:
+                continue
+            kept.add(resolved)
+            if os.path.isdir(self._host_path(resolved)):
+                for dirpath, dirnames, filenames in os.walk(self._host_path(resolved)):
+                    pending.extend(
+                        '/' + os.path.relpath(os.path.join(dirpath, name), self.root)
+                        for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]
+                    )
+            else:
+                pending.extend(dependency for dependency in self._dependencies(resolved) if dependency)
+        return kept
+
+    def run(self):
+        """Remove files outside the closure, and write a report of them."""
+        kept = self.compute()
+        removed = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            symlinked = [name for name in dirnames if os.path.islink(os.path.join(dirpath, name))]
+            for name in filenames + symlinked:
+                host = os.path.join(dirpath, name)
+                path = '/' + os.path.relpath(host, self.root)
+                if path in kept:
+                    continue
+                st = os.lstat(host)
+                os.unlink(host)
+                removed.append({'path': path, 'size': st.st_size if stat.S_ISREG(st.st_mode) else 0})
+
+        size = sum(entry['size'] for entry in removed)
+        logger.info(
+            "Kept %d paths of the runtime closure, removed %d files (%.1f MB)",
+            len(kept), len(removed), size / strip.MB,
+        )
+        tmp_path = '%s.partial' % self.report_path
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'kept': sorted(kept), 'removed': sorted(removed, key=lambda entry: entry['path']), 'size': size}, f, indent=1)
+        os.replace(tmp_path, self.report_path)
+        logger.info("Minimisation report written to %s", self.report_path)
@@ -1,9 +1,12 @@
 import collections
+import copy
 import datetime
 import logging
 import re
 import os.path
 
+from . import archive
+
 
 logger = logging.getLogger('quern')
 
@@ -16,10 +19,16 @@ class ImproperlyConfigured(QuernError):
     """Configuration errors"""
 
 
-def setup_logging():
+class BuildError(QuernError):
+    """Failures while building an image"""
+
+
+def setup_logging(concurrent=False):
     logging.basicConfig(
         level=logging.INFO,
-        format='>>> %(levelname)s: %(message)s',
+        # Concurrent builds run in threads named after their profile
+        format='>>> %(levelname)s: [%(threadName)s] %(message)s' if concurrent else '>>> %(levelname)s: %(message)s',
+        force=True,
     )
     logging.getLogger('getconf').setLevel(logging.WARNING)
 
@@ -33,6 +42,8 @@ _RepositoryConfig = collections.namedtuple(
 COMPRESSION_SUFFIXES = {
     'gzip': 'gz',
     'bzip2': 'bz2',
+    'xz': 'xz',
+    'zstd': 'zst',
 }
 
 
@@ -102,27 +113,117 @@ class Config:
         self.distfiles_dir = getter.getstr('portage.distfiles',
             doc="Path to distfiles")
         self.binpkg_dir = getter.getstr('portage.binpkg', doc="Path where binpkgs should be written")
+        self.binpkg_max_size = getter.getint('portage.binpkg_max_size', 0,
+            doc="Evict least recently used binpkgs beyond this size, in MB; 0 for no limit")
+        self.binpkg_keep_days = getter.getint('portage.binpkg_keep_days', 7,
+            doc="Never evict binpkgs used by builds of the last days")
         self.autofix_portage = getter.getbool('portage.autofix', False, doc="Point system /usr/portage at main repository")
+        self.fetch_jobs = getter.getint('portage.fetch_jobs', 4,
+            doc="Concurrent downloads when prefetching distfiles before the build; 0 to let emerge fetch them")
+        self.fetch_mirrors = getter.getlist('portage.fetch_mirrors',
+            doc="Comma-separated distfiles mirrors tried first when prefetching, e.g http://localhost:8000 or file:///srv/distfiles")
         self.debug_workdir = getter.getstr('portage.debug_workdir', doc="Store failed build workspaces")
 
         # Build profile
         self.unblocker_profile = getter.getstr('build.unblocker_profile', doc="Portage profile to break blockers (merged to host)")
         self.profile = getter.getstr('build.profile', doc="Portage profile to use")
+        self.base_profile = getter.getstr('build.base_profile',
+            doc="Profile used to build the shared base root (baselayout, @system); defaults to build.profile, or its single parent with cache.roots")
         self.include_system = getter.getbool('build.include_system', False, doc="Include @system set in built image")
         self.baselayout_atoms = getter.getlist('build.baselayout_atoms', "sys-apps/baselayout", doc="Atoms to install to the image before any other package")
         self.outdir = getter.getstr('build.outdir', doc="Folder where the generated will be written")
         self.forced_image_name = getter.getstr('build.image_name', doc="Force generated image name (with .tar.XXX suffix)")
+        self.plan_file = getter.getstr('build.plan_file',
+            doc="Only resolve the build plan to this file within build.outdir (set by quern-builder --plan)")
         self.keep_failed = getter.getbool('build.keep_failed', True, doc="Keep build environment of failed builds")
+        self.resume = getter.getbool('build.resume', False, doc="Resume from the last completed stage of a previous build")
         self.image_compression = getter.getstr('build.compression', 'gzip', doc="Compression method to use")
+        self.image_compression_level = getter.getint('build.compression_level', None,
+            doc="Compression level; unset for the algorithm's default")
+        self.image_compression_threads = getter.getint('build.compression_threads', 0,
+            doc="Compression threads; 0 for one per CPU")
+        self.delta = getter.getbool('build.delta', False,
+            doc="Also write a delta archive from the previous image of the profile, for quern-delta")
+        self.reproducible = getter.getbool('build.reproducible', False,
+            doc="Write identical archives for identical contents: fixed mtimes, numeric owners only")
+        # Parsed by check(), only reproducible builds use it
+        self.source_date_epoch = getter.getstr('build.source_date_epoch', os.environ.get('SOURCE_DATE_EPOCH', ''),
+            doc="Timestamp of files in reproducible archives; defaults to $SOURCE_DATE_EPOCH, else 0")
+
+        self.cache_dir = getter.getstr('cache.dir', doc="Folder for cached build archives; empty to disable caching")
+        self.roots_cache_dir = getter.getstr('cache.roots',
+            doc="Folder for reusable base roots (baselayout and @system); empty to disable")
+        self.metadata_cache_dir = getter.getstr('cache.metadata',
+            doc="Intermediate cache for regenerating the (writable) repositories' dependency metadata when they change; empty to disable")
+        self.metadata_update = getter.getbool('cache.metadata_update', True,
+            doc="Regenerate stale repository metadata before building; docker drivers run it on the host")
+
+        # Layered output
+        self.layers_enabled = getter.getbool('layers.enabled', False,
+            doc="Also write the image as per-package layer archives with a manifest")
+        self.layers_groups = getter.getlist('layers.groups',
+            'sys-apps/baselayout sys-libs/* virtual/libc, dev-libs/* sys-apps/* app-arch/* virtual/*',
+            doc="Comma-separated layers, most stable first; each a space-separated list of package patterns")
+        self.layers_volatile_changes = getter.getint('layers.volatile_changes', 3,
+            doc="Move packages to the last layer once their version changed this many times")
 
         # Emerge configuration
         self.emerge_jobs = getter.getint('emerge.jobs', doc="Parallel portage builds")
         self.emerge_ask = getter.getbool('emerge.ask', doc="Require questions from emerge")
+        self.make_jobs = getter.getint('emerge.make_jobs', doc="Parallel jobs within each package build (MAKEOPTS)")
+        self.load_average = getter.getint('emerge.load_average',
+            doc="Don't start new jobs while the load average is above this value; 0 for no limit")
+
+        # Host-wide resource sharing
+        self.governor_dir = getter.getstr('governor.dir',
+            doc="Folder shared by the builds of this host to split its resources; empty to disable")
+        self.governor_cpus = getter.getint('governor.cpus', 0, doc="CPUs shared between builds; 0 for all")
+        self.governor_memory_per_job = getter.getint('governor.memory_per_job', 1024,
+            doc="Memory needed by each build job, in MB; 0 to ignore memory")
 
         # Optional features
         self.workdir = getter.getstr('build.workdir', '/tmp/quern', doc="Working directory for the build process")
         self.strip = getter.getbool('strip.doc', False, doc="Strip simple files (man/info/doc) from the image")
         self.strip_folders = getter.getlist('strip.paths', doc="Comma-separated list of folders strip from the image")
+        self.strip_patterns = getter.getlist('strip.patterns',
+            doc="Comma-separated list of glob patterns (e.g **/__pycache__, *.a) of paths to strip from the image")
+        self.strip_exclude = getter.getlist('strip.exclude',
+            doc="Comma-separated list of glob patterns of paths never stripped (e.g usr/share/locale/en*)")
+        self.strip_elf = getter.getbool('strip.elf', False, doc="Strip debug symbols from ELF binaries and libraries")
+        self.strip_dedupe = getter.getbool('strip.dedupe', False,
+            doc="Replace identical files of the image with hard links to a single copy")
+        self.strip_jobs = getter.getint('strip.jobs', 0, doc="Number of concurrent strip workers; 0 for one per CPU")
+        self.minimize = getter.getbool('minimize.enabled', False,
+            doc="Only keep the runtime closure of dockergen.entrypoint / dockergen.command in the image")
+        self.minimize_keep = getter.getlist('minimize.keep', 'etc',
+            doc="Comma-separated list of glob patterns of paths always kept by minimize, with their dependencies")
+        self.minimize_allow_missing_libraries = getter.getbool('minimize.allow_missing_libraries', False,
+            doc="When an ELF file needs a library missing from the image, keep all library folders instead of failing")
+
+        # Reports
+        self.report_timings = getter.getbool('report.timings', True,
+            doc="Write a JSON report of stage and package timings next to the image")
+        self.report_prometheus_dir = getter.getstr('report.prometheus_dir',
+            doc="Folder where timings are written for the node_exporter textfile collector")
+
+        # Builder logs
+        self.log_console = getter.getstr('log.console', 'progress',
+            doc="Builder output shown on the console: progress (quern and emerge progress lines) or full")
+        self.log_tail = getter.getint('log.tail', 200, doc="Builder output lines kept in memory and shown on failure")
+
+        # Resource usage
+        self.resources_interval = getter.getint('resources.interval', 5,
+            doc="Seconds between samples of the builder container's resource usage; 0 to disable")
+        self.resources_apply = getter.getbool('resources.apply', False,
+            doc="Use the tmpfs size and emerge jobs recommended by the last successful build of the profile")
+
+        # Matrix builds
+        self.matrix_profiles = getter.getlist('matrix.profiles', doc="Comma-separated profiles to build in a single run")
+        self.matrix_jobs = getter.getint('matrix.jobs', 1, doc="Number of concurrent builds in a matrix run")
+
+        # Build service (quern-server)
+        self.server_socket = getter.getstr('server.socket', '/run/quern.sock', doc="Unix socket of quern-server")
+        self.server_jobs = getter.getint('server.jobs', 1, doc="Number of concurrent builds run by quern-server")
 
         # Driver
         self.driver = getter.getstr('build.driver', 'raw', doc="Build driver")
@@ -135,6 +236,17 @@ class Config:
             'tmpfs:200M',
             doc="Backing storage for the working dir; tmpfs:xxM or file:/path/to/folder",
         )
+        self.docker_pool_size = getter.getint('docker.pool_size', 2,
+            doc="Warm containers kept per image and set of mounts (docker_pool driver)")
+        self.docker_pool_lockdir = getter.getstr('docker.pool_lockdir', '/var/lock/quern-pool',
+            doc="Folder for the lock files of pooled containers (docker_pool driver)")
+
+        # Timeouts (docker_async driver)
+        self.timeout_build = getter.getint('timeouts.build', 0, doc="Maximum duration of a build, in seconds; 0 for none")
+        self.timeout_inactivity = getter.getint('timeouts.inactivity', 0,
+            doc="Abort builds without any output for that many seconds; 0 for none")
+        self.timeout_stages = getter.getlist('timeouts.stages',
+            doc="Comma-separated stage=seconds inactivity timeouts, overriding timeouts.inactivity")
 
         # Post-generation
         self.postbuild_engines = getter.getlist('postbuild.engines', doc="Engines for post-generation tasks")
@@ -149,6 +261,8 @@ class Config:
         self.dockergen_volumes = getter.getlist('dockergen.volumes', doc="Dockerfile' VOLUME")
         self.dockergen_workdir = getter.getstr('dockergen.workdir', doc="Dockerfile' WORKDIR")
         self.dockergen_user = getter.getstr('dockergen.user', doc="Dockerfile' USER")
+        self.dockergen_architecture = getter.getstr('dockergen.architecture', 'amd64',
+            doc="Image architecture, for OCI image configuration")
 
     @classmethod
     def _parse_shell(cls, text):
@@ -166,6 +280,39 @@ class Config:
                 % (self.image_compression, ' / '.join(sorted(COMPRESSION_SUFFIXES)))
             )
 
+        if not archive.is_available(self.image_compression):
+            raise ImproperlyConfigured(
+                "build.compression: %s requires the zstandard module" % self.image_compression
+            )
+
+        if self.image_compression_level is not None:
+            min_level, max_level = archive.LEVEL_RANGES[self.image_compression]
+            if not min_level <= self.image_compression_level <= max_level:
+                raise ImproperlyConfigured(
+                    "build.compression_level: %s supports levels %d to %d; got %d"
+                    % (self.image_compression, min_level, max_level, self.image_compression_level)
+                )
+
+        if self.reproducible:
+            try:
+                int(self.source_date_epoch or 0)
+            except ValueError:
+                raise ImproperlyConfigured(
+                    "build.source_date_epoch (or $SOURCE_DATE_EPOCH) should be an integer timestamp; got %s" % self.source_date_epoch
+                )
+
+        if self.minimize and not (self.dockergen_entrypoint or self.dockergen_command):
+            raise ImproperlyConfigured("minimize.enabled requires dockergen.entrypoint or dockergen.command")
+        if self.strip_jobs < 0:
+            raise ImproperlyConfigured("strip.jobs must be positive; got %d" % self.strip_jobs)
+        if self.fetch_jobs < 0:
+            raise ImproperlyConfigured("portage.fetch_jobs must be positive; got %d" % self.fetch_jobs)
+
+        if self.image_compression_threads < 0:
+            raise ImproperlyConfigured(
+                "build.compression_threads must be positive; got %d" % self.image_compression_threads
+            )
+
         expected_suffix = '.tar.%s' % COMPRESSION_SUFFIXES[self.image_compression]
 
         if self.forced_image_name and not self.forced_image_name.endswith(expected_suffix):
@@ -174,10 +321,28 @@ class Config:
                 % (expected_suffix, self.forced_image_name)
             )
 
-        if not self.profile:
+        if not self.profile and not self.matrix_profiles:
             raise ImproperlyConfigured("build.profile is not set")
 
-        if self.driver == 'docker':
+        for option, path in [
+                ('cache.dir', self.cache_dir),
+                ('cache.roots', self.roots_cache_dir),
+                ('cache.metadata', self.metadata_cache_dir),
+                ('governor.dir', self.governor_dir)]:
+            if path and os.path.exists(path) and not os.path.isdir(path):
+                raise ImproperlyConfigured("%s: %s is not a directory." % (option, path))
+
+        try:
+            self.inactivity_timeouts
+        except ValueError:
+            raise ImproperlyConfigured(
+                "timeouts.stages should be a list of stage=seconds; got %s" % ', '.join(self.timeout_stages)
+            )
+
+        if self.log_console not in ('progress', 'full'):
+            raise ImproperlyConfigured("log.console should be either progress or full; got %s" % self.log_console)
+
+        if self.uses_docker:
             if not self.docker_image:
                 raise ImproperlyConfigured("docker.image is not set, but using the docker driver")
 
@@ -187,10 +352,49 @@ class Config:
                     % self.docker_workdir_storage,
                 )
 
+            if self.resume and self.docker_workdir_storage.startswith('tmpfs:'):
+                raise ImproperlyConfigured(
+                    "build.resume requires a persistent docker.workdir_storage (file:/path/to/folder)"
+                )
+
+        if self.driver == 'docker_pool':
+            if self.docker_pool_size < 1:
+                raise ImproperlyConfigured("docker.pool_size must be at least 1; got %d" % self.docker_pool_size)
+            if self.resume:
+                # Builds may land in any slot, and slots reset their workdir
+                raise ImproperlyConfigured("build.resume isn't supported by the docker_pool driver")
+
         if 'docker' in self.postbuild_engines:
             if not self.dockergen_name:
                 raise ImproperlyConfigured("dockergen.name is required when using 'docker' in postbuild.engines.")
 
+    def for_profile(self, profile, name=None):
+        """Derive the configuration of a single build of a matrix run.
+
+        The build gets its own workdir, in a `name` subfolder (defaults to the profile).
+        """
+        config = copy.copy(self)
+        config.profile = profile
+        config.matrix_profiles = []
+        name = name or config.profile_safe
+        config.workdir = os.path.join(self.workdir, name)
+        if self.docker_workdir_storage.startswith('file:'):
+            config.docker_workdir_storage = os.path.join(self.docker_workdir_storage, name)
+        return config
+
+    @property
+    def uses_docker(self):
+        return self.driver in ('docker', 'docker_async', 'docker_pool')
+
+    @property
+    def inactivity_timeouts(self):
+        """Per-stage inactivity timeouts, from timeouts.stages"""
+        timeouts = {}
+        for entry in self.timeout_stages:
+            stage, seconds = entry.split('=', 1)
+            timeouts[stage.strip()] = int(seconds)
+        return timeouts
+
     @property
     def profile_safe(self):
         basename = self.profile
@@ -202,6 +406,11 @@ class Config:
 
         return basename
 
+    @property
+    def archive_mtime(self):
+        """Modification time of all archived files, or None to keep theirs."""
+        return int(self.source_date_epoch or 0) if self.reproducible else None
+
     @property
     def workdir_image(self):
         return os.path.join(self.workdir, 'image')
@@ -231,6 +440,24 @@ class Config:
     def image_path(self):
         return os.path.join(self.outdir, self.image_name)
 
+    @property
+    def image_basename(self):
+        """Image name, without the .tar.xxx suffix"""
+        suffix = '.tar.%s' % COMPRESSION_SUFFIXES[self.image_compression]
+        return self.image_name[:-len(suffix)]
+
+    def layer_path(self, index, name):
+        return os.path.join(self.outdir, '{basename}.layer-{index:02d}-{name}.tar.{suffix}'.format(
+            basename=self.image_basename,
+            index=index,
+            name=name,
+            suffix=COMPRESSION_SUFFIXES[self.image_compression],
+        ))
+
+    @property
+    def layers_manifest_path(self):
+        return os.path.join(self.outdir, '%s.layers.json' % self.image_basename)
+
     def make_repos_conf_lines(self):
         """Generate the lines for /etc/portage/repos.conf."""
         for i, repo in enumerate(self.repositories):
@@ -241,6 +468,13 @@ class Config:
             yield ''
             yield from repo.as_repos_conf_lines()
 
+    def make_conf_key_lines(self):
+        """make.conf lines, without the per-build ROOT and parallelism tuning (for cache keys)."""
+        for line in self.make_conf_lines():
+            if line.startswith(('ROOT=', 'MAKEOPTS=')) or '--jobs=' in line or '--load-average=' in line:
+                continue
+            yield line
+
     def make_conf_lines(self):
         def varline(var, value):
             return '{var}="{value}"'.format(var=var, value=value)
@@ -256,9 +490,15 @@ class Config:
             yield varline('PKGDIR', self.binpkg_dir)
         if self.binhost:
             yield varline('BINHOST', self.binhost)
+        if self.metadata_cache_dir:
+            yield varline('PORTAGE_DEPCACHEDIR', self.metadata_cache_dir)
 
         if self.emerge_jobs:
             yield extendline('EMERGE_DEFAULT_OPTS', "--jobs=%d" % self.emerge_jobs)
+        if self.load_average:
+            yield extendline('EMERGE_DEFAULT_OPTS', "--load-average=%d" % self.load_average)
+        if self.make_jobs:
+            yield varline('MAKEOPTS', "-j%d" % self.make_jobs + (" -l%d" % self.load_average if self.load_average else ""))
         if self.emerge_ask:
             yield extendline('EMERGE_DEFAULT_OPTS', '--ask')
         yield extendline('EMERGE_DEFAULT_OPTS', '--tree')
@@ -0,0 +1,88 @@
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import os.path
+import stat
+
+from . import strip
+
+
+logger = logging.getLogger('quern')
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Deduplicator:
+    """Replace identical files of an image root with hard links to a single copy.
+
+    Files are grouped by size, mode and owner (shared by all links to a
+    file), and by modification time unless build.reproducible normalizes
+    it; only groups of several files are hashed, by strip.jobs worker
+    threads. tar then stores the copies as link entries.
+    """
+
+    def __init__(self, config, root):
+        self.config = config
+        self.root = root
+
+    def _candidates(self):
+        """Group regular files which may be identical; returns lists of paths."""
+        groups = collections.defaultdict(list)
+        seen = set()
+        for dirpath, _dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                if not stat.S_ISREG(st.st_mode) or not st.st_size:
+                    continue
+                if (st.st_dev, st.st_ino) in seen:
+                    # Already a hard link to a file of the group
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+                # Links share their mtime; it is only normalized in reproducible archives
+                mtime = st.st_mtime_ns if self.config.archive_mtime is None else None
+                groups[st.st_size, st.st_mode, st.st_uid, st.st_gid, mtime].append(path)
+        return [paths for paths in groups.values() if len(paths) > 1]
+
+    def _link(self, source, target):
+        tmp_path = '%s.quern-dedupe' % target
+        os.link(source, tmp_path)
+        os.replace(tmp_path, target)
+
+    def run(self):
+        """Deduplicate the image root; returns {'files': N, 'bytes': N} reclaimed."""
+        candidates = self._candidates()
+        paths = [path for group in candidates for path in group]
+        logger.info("Hashing %d candidate files for deduplication", len(paths))
+
+        jobs = self.config.strip_jobs or os.cpu_count() or 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            digests = dict(zip(paths, executor.map(_digest, paths)))
+
+        files = size = 0
+        for group in candidates:
+            originals = {}
+            # Sorted, to always keep the same copy
+            for path in sorted(group):
+                original = originals.setdefault(digests[path], path)
+                if original != path:
+                    st = os.lstat(path)
+                    self._link(original, path)
+                    files += 1
+                    # Space is only reclaimed when no other link keeps the replaced file
+                    if st.st_nlink == 1:
+                        size += st.st_size
+
+        logger.info("Deduplicated %d files, reclaiming %.1f MB", files, size / strip.MB)
+        return {'files': files, 'bytes': size}
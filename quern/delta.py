@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import copy
+import glob
+import hashlib
+import io
+import json
+import logging
+import os
+import os.path
+import shutil
+import stat
+import sys
+import tarfile
+import tempfile
+import time
+
+from . import archive
+from . import core
+from . import fsutil
+
+
+logger = logging.getLogger('quern')
+
+
+MANIFESTS_FOLDER = 'manifests'
+# Description of a delta, as its first entry
+DELTA_METADATA = '.quern-delta.json'
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _extract_filter(member, dest_path):
+    # The 'tar' filter refuses paths outside the root; images keep their setuid and group-writable modes
+    return tarfile.tar_filter(member, dest_path).replace(mode=member.mode, deep=False)
+
+
+_EXTRACT_OPTIONS = {'filter': _extract_filter} if hasattr(tarfile, 'tar_filter') else {}
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan(root, threads=0):
+    """Describe the entries of an image root, as {relpath: {type, mode, uid, gid, ...}}.
+
+    Files also get their size and sha256, symlinks their target, and device
+    nodes their file type and device number. Hard links within the root get
+    the first of their paths as `link`.
+    """
+    entries = {}
+    files = []
+    inodes = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            relpath = os.path.relpath(path, root)
+            st = os.lstat(path)
+            entry = {'mode': stat.S_IMODE(st.st_mode), 'uid': st.st_uid, 'gid': st.st_gid}
+            if stat.S_ISDIR(st.st_mode):
+                entry['type'] = 'dir'
+            elif stat.S_ISLNK(st.st_mode):
+                entry.update(type='symlink', target=os.readlink(path))
+            elif stat.S_ISREG(st.st_mode):
+                entry.update(type='file', size=st.st_size)
+                files.append(relpath)
+                if st.st_nlink > 1:
+                    inodes.setdefault((st.st_dev, st.st_ino), []).append(relpath)
+            else:
+                entry.update(type='special', format=stat.S_IFMT(st.st_mode), rdev=st.st_rdev)
+            entries[relpath] = entry
+
+    for relpaths in inodes.values():
+        if len(relpaths) > 1:
+            for relpath in relpaths:
+                entries[relpath]['link'] = min(relpaths)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=archive.effective_threads(threads)) as executor:
+        digests = executor.map(_sha256, [os.path.join(root, relpath) for relpath in files])
+        for relpath, digest in zip(files, digests):
+            entries[relpath]['sha256'] = digest
+    return entries
+
+
+# Device node types of tar members, as stat file types
+_SPECIAL_FORMATS = {tarfile.CHRTYPE: stat.S_IFCHR, tarfile.BLKTYPE: stat.S_IFBLK, tarfile.FIFOTYPE: stat.S_IFIFO}
+
+
+def scan_archive(path):
+    """Describe the entries of an image archive, like scan() does for its root."""
+    entries = {}
+    links = {}
+    with open(path, 'rb') as f:
+        stream, tar = _open_tar(f)
+        with stream, tar:
+            for member in tar:
+                relpath = os.path.normpath(member.name)
+                if relpath == os.curdir:
+                    continue
+                if member.islnk():
+                    original = os.path.normpath(member.linkname)
+                    entries[relpath] = dict(entries[original])
+                    links.setdefault(original, [original]).append(relpath)
+                    continue
+
+                entry = {'mode': member.mode, 'uid': member.uid, 'gid': member.gid}
+                if member.isdir():
+                    entry['type'] = 'dir'
+                elif member.issym():
+                    entry.update(type='symlink', target=member.linkname)
+                elif member.isreg():
+                    digest = hashlib.sha256()
+                    content = tar.extractfile(member)
+                    for chunk in iter(lambda: content.read(CHUNK_SIZE), b''):
+                        digest.update(chunk)
+                    entry.update(type='file', size=member.size, sha256=digest.hexdigest())
+                else:
+                    entry.update(
+                        type='special',
+                        format=_SPECIAL_FORMATS[member.type],
+                        rdev=os.makedev(member.devmajor, member.devminor),
+                    )
+                entries[relpath] = entry
+
+    for relpaths in links.values():
+        for relpath in relpaths:
+            entries[relpath]['link'] = min(relpaths)
+    return entries
+
+
+class DeltaWriter:
+    """Write a delta archive between the previous image of a profile and the current one.
+
+    Each build stores a manifest of its image root in
+    <outdir>/manifests/<profile>/<image>.json; the delta holds the entries
+    which were added or changed since the previous manifest, and a
+    description listing removed entries along with the new manifest, which
+    `quern-delta` checks when rebuilding the image.
+
+    Builds restored from the build cache have no image root: their manifest
+    and delta are computed from the image archive instead.
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    @property
+    def folder(self):
+        return os.path.join(self.config.outdir, MANIFESTS_FOLDER, self.config.profile_safe)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.folder, '%s.json' % self.config.image_basename)
+
+    def previous(self):
+        """Load the manifest of the latest other image of the profile, if any."""
+        candidates = [
+            path for path in glob.glob(os.path.join(self.folder, '*.json'))
+            if path != self.manifest_path
+        ]
+        if not candidates:
+            return None
+        with open(max(candidates, key=os.path.getmtime), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def delta_path(self, previous):
+        return os.path.join(self.config.outdir, '%s.delta-from-%s.tar.%s' % (
+            self.config.image_basename,
+            previous['image'],
+            core.COMPRESSION_SUFFIXES[self.config.image_compression],
+        ))
+
+    def write(self, root):
+        """Write the manifest and delta of the image built from an image root."""
+        entry_filter = archive.normalizer(self.config.archive_mtime) if self.config.archive_mtime is not None else None
+
+        def add_entries(tar, changed):
+            for relpath in changed:
+                tar.add(os.path.join(root, relpath), arcname=os.path.join('.', relpath), recursive=False, filter=entry_filter)
+
+        self._write(scan(root, self.config.image_compression_threads), add_entries)
+
+    def write_from_archive(self, path):
+        """Write the manifest and delta of a packed image, e.g restored from the build cache."""
+        entries = scan_archive(path)
+
+        def add_entries(tar, changed):
+            changed = set(changed)
+            # Unchanged files hard-linked to changed paths: the delta holds a copy of their content
+            changed_links = {entries[relpath]['link'] for relpath in changed if 'link' in entries[relpath]}
+            added = set()
+            copies = {}
+            with tempfile.TemporaryDirectory(prefix='quern-delta-') as workdir, open(path, 'rb') as f:
+                stream, source = _open_tar(f)
+                with stream, source:
+                    for member in source:
+                        relpath = os.path.normpath(member.name)
+                        if relpath not in changed:
+                            if member.isreg() and entries.get(relpath, {}).get('link') in changed_links:
+                                copy_path = os.path.join(workdir, '%d' % len(copies))
+                                with open(copy_path, 'wb') as out:
+                                    shutil.copyfileobj(source.extractfile(member), out, CHUNK_SIZE)
+                                copies[relpath] = (member, copy_path)
+                            continue
+
+                        if member.islnk() and os.path.normpath(member.linkname) not in added:
+                            original, copy_path = copies[os.path.normpath(member.linkname)]
+                            info = copy.copy(original)
+                            info.name = member.name
+                            with open(copy_path, 'rb') as content:
+                                tar.addfile(info, content)
+                        elif member.isreg():
+                            tar.addfile(member, source.extractfile(member))
+                        else:
+                            tar.addfile(member)
+                        added.add(relpath)
+
+        self._write(entries, add_entries)
+
+    def _write(self, entries, add_entries):
+        manifest = {
+            'image': self.config.image_basename,
+            'profile': self.config.profile,
+            'compression': self.config.image_compression,
+            'compression_level': self.config.image_compression_level,
+            'mtime': self.config.archive_mtime,
+            'entries': entries,
+        }
+
+        previous = self.previous()
+        if previous is None:
+            logger.info("No previous image for %s, not writing a delta", self.config.profile)
+        else:
+            self._write_delta(previous, manifest, add_entries)
+
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_path = '%s.partial' % self.manifest_path
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _write_delta(self, previous, manifest, add_entries):
+        old_entries = previous['entries']
+        new_entries = manifest['entries']
+        changed = sorted(relpath for relpath, entry in new_entries.items() if old_entries.get(relpath) != entry)
+        removed = sorted(relpath for relpath in old_entries if relpath not in new_entries)
+
+        metadata = json.dumps({
+            'base': previous['image'],
+            'removed': removed,
+            'manifest': manifest,
+        }, sort_keys=True).encode('utf-8')
+        mtime = self.config.archive_mtime
+
+        def fill(tar):
+            info = tarfile.TarInfo(DELTA_METADATA)
+            info.size = len(metadata)
+            info.mtime = int(time.time()) if mtime is None else mtime
+            tar.addfile(info, io.BytesIO(metadata))
+            add_entries(tar, changed)
+
+        path = self.delta_path(previous)
+        info = archive.write_archive(
+            path, fill,
+            algorithm=self.config.image_compression,
+            level=self.config.image_compression_level,
+            threads=self.config.image_compression_threads,
+        )
+        logger.info(
+            "Delta from %s written to %s: %d added or changed entries, %d removed, %d bytes",
+            previous['image'], path, len(changed), len(removed), info.size,
+        )
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        fsutil.remove_tree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def _image_path(root, relpath):
+    """Path of an archive or manifest entry within root; refuses entries outside it."""
+    normalized = os.path.normpath(relpath)
+    path = os.path.join(root, normalized)
+    real_root = os.path.realpath(root)
+    if (os.path.isabs(normalized) or normalized == os.curdir or normalized.split(os.sep)[0] == os.pardir
+            or os.path.commonpath([real_root, os.path.realpath(os.path.dirname(path))]) != real_root):
+        raise core.QuernError("%s is outside the image root" % relpath)
+    return path
+
+
+def _relink(root, entries):
+    """Recreate the hard links of a manifest, whose paths may have been extracted as distinct files."""
+    for relpath, entry in sorted(entries.items()):
+        source = entry.get('link')
+        if source is None or source == relpath:
+            continue
+        path = _image_path(root, relpath)
+        source_path = _image_path(root, source)
+        if os.path.samestat(os.lstat(path), os.lstat(source_path)):
+            continue
+        tmp_path = '%s.quern-delta' % path
+        os.link(source_path, tmp_path)
+        os.replace(tmp_path, path)
+
+
+def _open_tar(f):
+    stream = archive.open_decompressor(f, archive.detect_algorithm(f))
+    return stream, tarfile.open(fileobj=stream, mode='r|')
+
+
+def apply(base_path, delta_path, output_path):
+    """Rebuild an image from the previous image of its profile and a delta."""
+    with tempfile.TemporaryDirectory(prefix='quern-delta-') as workdir:
+        root = os.path.join(workdir, 'root')
+        os.makedirs(root)
+
+        logger.info("Extracting %s", base_path)
+        with open(base_path, 'rb') as f:
+            stream, tar = _open_tar(f)
+            with stream, tar:
+                tar.extractall(root, numeric_owner=True, **_EXTRACT_OPTIONS)
+
+        logger.info("Applying %s", delta_path)
+        with open(delta_path, 'rb') as f:
+            stream, tar = _open_tar(f)
+            with stream, tar:
+                metadata = None
+                for member in tar:
+                    if metadata is None:
+                        if member.name != DELTA_METADATA:
+                            raise core.QuernError("%s is not a quern delta archive" % delta_path)
+                        metadata = json.loads(tar.extractfile(member).read().decode('utf-8'))
+                        for relpath in metadata['removed']:
+                            _remove(_image_path(root, relpath))
+                        continue
+
+                    path = _image_path(root, member.name)
+                    # Never write through hard links shared with unchanged files
+                    if not (member.isdir() and os.path.isdir(path) and not os.path.islink(path)):
+                        _remove(path)
+                    tar.extract(member, root, numeric_owner=True, **_EXTRACT_OPTIONS)
+
+        if metadata is None:
+            raise core.QuernError("%s is not a quern delta archive" % delta_path)
+        manifest = metadata['manifest']
+        _relink(root, manifest['entries'])
+        _check(root, manifest)
+
+        logger.info("Packing %s", output_path)
+        archive.pack(
+            root, output_path,
+            algorithm=manifest['compression'],
+            level=manifest['compression_level'],
+            mtime=manifest['mtime'],
+        )
+
+
+def _check(root, manifest):
+    """Compare a rebuilt image root with the manifest of the image."""
+    entries = scan(root)
+    check_owners = os.geteuid() == 0
+    if not check_owners:
+        logger.warning("Not running as root, owners were not restored and are not checked")
+
+    def comparable(entry):
+        if entry is None or check_owners:
+            return entry
+        return {key: value for key, value in entry.items() if key not in ('uid', 'gid')}
+
+    expected = manifest['entries']
+    mismatches = sorted(
+        relpath for relpath in set(entries) | set(expected)
+        if comparable(entries.get(relpath)) != comparable(expected.get(relpath))
+    )
+    if mismatches:
+        raise core.QuernError(
+            "Rebuilt image doesn't match %s: %d entries differ, e.g %s"
+            % (manifest['image'], len(mismatches), ', '.join(mismatches[:5]))
+        )
+    logger.info("Checked %d entries of %s", len(entries), manifest['image'])
+
+
+USAGE = """Usage: {prog} previous-image.tar.gz image.delta-from-previous.tar.gz image.tar.gz
+
+Rebuild an image from the previous image of its profile and a delta written by quern (build.delta)."""
+
+
+def main(argv=sys.argv):
+    args = argv[1:]
+    if len(args) != 3:
+        print(USAGE.format(prog=argv[0]))
+        return 0 if args and args[0] in ('-h', '--help') else 1
+
+    core.setup_logging()
+    try:
+        apply(*args)
+    except (core.QuernError, OSError, ValueError, tarfile.TarError) as e:
+        print("Error: %s" % e, file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,108 @@
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import urllib.error
+import urllib.request
+
+
+logger = logging.getLogger('quern')
+
+
+Distfile = collections.namedtuple('Distfile', ['name', 'size', 'digests', 'uris'])
+
+# Manifest hash names, as supported by hashlib
+HASHES = {
+    'BLAKE2B': hashlib.blake2b,
+    'SHA512': hashlib.sha512,
+    'SHA256': hashlib.sha256,
+}
+
+CHUNK_SIZE = 1024 * 1024
+FETCH_TIMEOUT = 60
+
+
+def verify(path, distfile):
+    """Check a file against the size and digests of its Manifest entry."""
+    try:
+        if os.path.getsize(path) != distfile.size:
+            return False
+    except FileNotFoundError:
+        return False
+
+    hashers = {name: HASHES[name]() for name in distfile.digests if name in HASHES}
+    if not hashers:
+        # Nothing we can check beyond the size
+        return True
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            for hasher in hashers.values():
+                hasher.update(chunk)
+    return all(hasher.hexdigest() == distfile.digests[name] for name, hasher in hashers.items())
+
+
+class Prefetcher:
+    """Download the distfiles of a build ahead of compilation.
+
+    Missing or corrupt files are fetched by portage.fetch_jobs concurrent
+    workers, trying the portage.fetch_mirrors (flat folders of distfiles,
+    e.g http://localhost:8000 or file:///srv/distfiles) before the
+    upstream URIs. Failures are left for emerge to handle.
+    """
+
+    def __init__(self, config, distdir):
+        self.config = config
+        self.distdir = distdir
+
+    def _uris(self, distfile):
+        mirrors = ['%s/%s' % (mirror.rstrip('/'), distfile.name) for mirror in self.config.fetch_mirrors]
+        return mirrors + list(distfile.uris)
+
+    def _download(self, distfile):
+        path = os.path.join(self.distdir, distfile.name)
+        # Concurrent builds may fetch the same file
+        fd, tmp_path = tempfile.mkstemp(dir=self.distdir, prefix='.%s.' % distfile.name)
+        os.close(fd)
+        try:
+            for uri in self._uris(distfile):
+                try:
+                    with urllib.request.urlopen(uri, timeout=FETCH_TIMEOUT) as response, open(tmp_path, 'wb') as f:
+                        shutil.copyfileobj(response, f, CHUNK_SIZE)
+                except (OSError, urllib.error.URLError, ValueError) as e:
+                    logger.info("Unable to fetch %s from %s: %s", distfile.name, uri, e)
+                    continue
+
+                if verify(tmp_path, distfile):
+                    os.chmod(tmp_path, 0o644)
+                    os.replace(tmp_path, path)
+                    return True
+                logger.warning("Digest mismatch for %s from %s", distfile.name, uri)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        logger.warning("Unable to prefetch %s, leaving it to emerge", distfile.name)
+        return False
+
+    def _prefetch(self, distfile):
+        if verify(os.path.join(self.distdir, distfile.name), distfile):
+            return True
+        return self._download(distfile)
+
+    def run(self, distfiles):
+        """Prefetch distfiles; returns the names of those that are still missing."""
+        if not distfiles:
+            return []
+
+        os.makedirs(self.distdir, exist_ok=True)
+        logger.info("Prefetching %d distfiles to %s with %d workers", len(distfiles), self.distdir, self.config.fetch_jobs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.config.fetch_jobs) as executor:
+            results = executor.map(self._prefetch, distfiles)
+            missing = [distfile.name for distfile, present in zip(distfiles, results) if not present]
+
+        logger.info("Prefetched %d distfiles, %d missing", len(distfiles) - len(missing), len(missing))
+        return missing
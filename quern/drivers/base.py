@@ -10,6 +10,8 @@ class BaseDriver:
     INNER_BINPKG = os.path.join(PREFIX, 'binpkg')
     INNER_DISTFILES = os.path.join(PREFIX, 'distfiles')
     INNER_REPOSITORIES = os.path.join(PREFIX, 'repositories')
+    INNER_ROOTS = os.path.join(PREFIX, 'roots')
+    INNER_METADATA = os.path.join(PREFIX, 'metadata')
     INNER_PORTAGE_WORKDIR = '/var/tmp/portage'
 
     def __init__(self, config):
@@ -1,23 +1,73 @@
+import collections
+import itertools
 import logging
 import os.path
+import threading
 
 import docker
 
 from . import base
+from .. import buildlog
 from .. import core
+from .. import metadata
+from .. import profiling
+from .. import resources
 
 
 logger = logging.getLogger('quern')
 
 
+# Distinguish containers of concurrent builds from the same process
+_container_counter = itertools.count()
+
+
+Container = collections.namedtuple('Container', ['id', 'name', 'env'])
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(address):
+    """Docker client for an address, shared by all builds of the process."""
+    with _clients_lock:
+        if address not in _clients:
+            logger.info("Connecting to docker at %s", address)
+            _clients[address] = docker.Client(address)
+        return _clients[address]
+
+
 class Driver(base.BaseDriver):
 
     def setup(self):
         for repo in self.config.repositories:
             if not os.path.isdir(repo.location):
                 raise core.ImproperlyConfigured("Missing repository at %s" % repo.location)
+        metadata.MetadataCache(self.config).update()
 
     def build(self):
+        timings = profiling.BuildReport(self.config)
+
+        client = get_client(self.config.docker_address)
+
+        container = self._create_container(client, timings)
+        self._start_container(client, container, timings)
+
+        sampler = self._start_sampler(client, container)
+        with timings.measure('run', section='container'):
+            logs = client.logs(container=container.id, stdout=True, stderr=True, stream=True, follow=True)
+            for log in logs:
+                self._handle_log(log, sampler)
+
+        logger.info("Waiting for container to disappear")
+        with timings.measure('wait', section='container'):
+            retcode = client.wait(container=container.id)
+
+        self._stop_sampler(sampler, success=not retcode)
+        self._finish(client, container, retcode, timings)
+
+    def _container_volumes(self):
+        """Compute (ro_volumes, rw_volumes, tmpfs_volumes) for the builder container."""
         ro_volumes = self.repository_map.copy()
         rw_volumes = {}
         rw_volumes[self.config.outdir] = self.INNER_IMAGE
@@ -27,6 +77,10 @@ class Driver(base.BaseDriver):
             rw_volumes[self.config.binpkg_dir] = self.INNER_BINPKG
         if self.config.distfiles_dir:
             rw_volumes[self.config.distfiles_dir] = self.INNER_DISTFILES
+        if self.config.roots_cache_dir:
+            rw_volumes[self.config.roots_cache_dir] = self.INNER_ROOTS
+        if self.config.metadata_cache_dir:
+            rw_volumes[self.config.metadata_cache_dir] = self.INNER_METADATA
         if self.config.debug_workdir:
             rw_volumes[self.config.debug_workdir] = self.INNER_PORTAGE_WORKDIR
 
@@ -39,13 +93,16 @@ class Driver(base.BaseDriver):
             assert workdir_engine == 'file'
             rw_volumes[workdir_param] = self.config.workdir
 
-        logger.info("Connecting to docker")
-        client = docker.Client(self.config.docker_address)
+        return ro_volumes, rw_volumes, tmpfs_volumes
+
+    def _create_container(self, client, timings):
+        ro_volumes, rw_volumes, tmpfs_volumes = self._container_volumes()
 
         base_image = self.config.docker_image
-        container_name = 'quern-%s-%d' % (
+        container_name = 'quern-%s-%d-%d' % (
             self.config.profile.replace(':', '-').replace('/', '-'),
             os.getpid(),
+            next(_container_counter),
         )
 
         logger.info("Creating container from %s, name=%s", base_image, container_name)
@@ -59,42 +116,70 @@ class Driver(base.BaseDriver):
         env = self._make_runner_env()
         logger.info("Container environment: %s", '  '.join('%s=%r' % (k, v) for (k, v) in sorted(env.items())))
 
-        container = client.create_container(
-            image=base_image,
-            entrypoint=['/usr/bin/quern-builder', '/etc/quern.conf'],
-            environment=env,
-            volumes=list(ro_volumes.values()) + list(rw_volumes.values()),
-            name=container_name,
-            host_config = host_config,
-        )
-
-        container_id = container.get('Id')
-        logger.info("Starting container (id=%s, name=%s)", container_id, container_name)
-        response = client.start(container=container_id)
+        with timings.measure('create', section='container'):
+            container = client.create_container(
+                image=base_image,
+                entrypoint=['/usr/bin/quern-builder', '/etc/quern.conf'],
+                environment=env,
+                volumes=list(ro_volumes.values()) + list(rw_volumes.values()),
+                name=container_name,
+                host_config = host_config,
+            )
+
+        return Container(id=container.get('Id'), name=container_name, env=env)
+
+    def _start_container(self, client, container, timings):
+        logger.info("Starting container (id=%s, name=%s)", container.id, container.name)
+        with timings.measure('start', section='container'):
+            response = client.start(container=container.id)
         if response is not None:
-            logger.error("Error starting container: %s", response)
-            return
-
-        logs = client.logs(container=container_id, stdout=True, stderr=True, stream=True, follow=True)
-        for log in logs:
-            logger.info("  logs: %s", log.decode('utf-8').strip())
+            raise core.BuildError("Error starting container: %s" % response)
+        self.build_log = buildlog.BuildLog(self.config)
+
+    def _start_sampler(self, client, container):
+        if not self.config.resources_interval:
+            return None
+        sampler = resources.ResourceSampler(client, container.id, self.config.resources_interval)
+        sampler.start()
+        return sampler
+
+    def _stop_sampler(self, sampler, success):
+        if sampler is not None:
+            sampler.stop()
+            resources.write_report(self.config, sampler, success)
+
+    def _handle_log(self, log, sampler):
+        text = '\n'.join(self.build_log.feed(log))
+        if sampler is not None:
+            sampler.feed_log(text)
+        return text
+
+    def _finish(self, client, container, retcode, timings):
+        self.build_log.close(success=not retcode)
+        if retcode:
+            logger.error("Container exited with code %d", retcode)
 
-        logger.info("Waiting for container to disappear")
-        retcode = client.wait(container=container_id)
+        self._release_container(client, container, retcode, timings)
 
         if retcode:
-            logger.error("Container exited with code %d", retcode)
+            raise core.BuildError("Container exited with code %d" % retcode)
 
-            if self.config.keep_failed:
-                logger.info("Failed container kept: id=%s, name=%s", container_id, container_name)
-                logger.info("Container environment: %s", '  '.join('%s=%r' % (k, v) for (k, v) in sorted(env.items())))
-                return
+        # Complete the report written by the builder with container timings
+        report = profiling.BuildReport.load(self.config)
+        report.data['container'] = timings.data['container']
+        report.write()
 
-        logger.info("Removing container")
-        client.remove_container(container=container_id, v=True)
+        logger.info("Build complete, image is available at %s", self.config.image_path)
 
-        if retcode == 0:
-            logger.info("Build complete, image is available at %s", self.config.image_path)
+    def _release_container(self, client, container, retcode, timings):
+        if retcode and self.config.keep_failed:
+            logger.info("Failed container kept: id=%s, name=%s", container.id, container.name)
+            logger.info("Container environment: %s", '  '.join('%s=%r' % (k, v) for (k, v) in sorted(container.env.items())))
+            return
+
+        logger.info("Removing container")
+        with timings.measure('remove', section='container'):
+            client.remove_container(container=container.id, v=True)
 
     def _make_host_config(self, ro_volumes, rw_volumes, tmpfs_volumes):
         binds = {}
@@ -122,24 +207,61 @@ class Driver(base.BaseDriver):
             'portage.binhost': self.config.binhost,
             'build.unblocker_profile': self.config.unblocker_profile,
             'build.profile': self.config.profile,
+            'build.base_profile': self.config.base_profile,
             'build.baselayout_atoms': ', '.join(self.config.baselayout_atoms),
             'build.include_system': self.config.include_system,
+            'build.resume': self.config.resume,
+            'build.compression': self.config.image_compression,
+            'build.reproducible': self.config.reproducible,
+            'build.delta': self.config.delta,
+            'build.source_date_epoch': self.config.source_date_epoch,
+            'build.compression_threads': self.config.image_compression_threads,
+            'portage.fetch_jobs': self.config.fetch_jobs,
+            'portage.fetch_mirrors': ', '.join(self.config.fetch_mirrors),
             'emerge.jobs': self.config.emerge_jobs,
+            'emerge.make_jobs': self.config.make_jobs,
+            'emerge.load_average': self.config.load_average,
             'strip.doc': self.config.strip,
             'strip.paths': ', '.join(self.config.strip_folders),
+            'strip.patterns': ', '.join(self.config.strip_patterns),
+            'strip.exclude': ', '.join(self.config.strip_exclude),
+            'strip.elf': self.config.strip_elf,
+            'strip.dedupe': self.config.strip_dedupe,
+            'strip.jobs': self.config.strip_jobs,
+            'minimize.enabled': self.config.minimize,
+            'minimize.keep': ', '.join(self.config.minimize_keep),
+            'minimize.allow_missing_libraries': self.config.minimize_allow_missing_libraries,
+            'dockergen.entrypoint': ' '.join(self.config.dockergen_entrypoint),
+            'dockergen.command': ' '.join(self.config.dockergen_command),
+            'report.timings': self.config.report_timings,
+            'layers.enabled': self.config.layers_enabled,
+            'layers.groups': ', '.join(self.config.layers_groups),
+            'layers.volatile_changes': self.config.layers_volatile_changes,
 
             # Forced for our setup
             # Build
             'build.driver': 'raw',
+            'build.workdir': self.config.workdir,
             'build.outdir': os.path.join(self.PREFIX, 'image'),
             'build.image_name': self.config.image_name,
+            'build.plan_file': self.config.plan_file,
 
             # Portage
             'portage.binpkg': os.path.join(self.PREFIX, 'binpkg') if self.config.binpkg_dir else '',
             'portage.distfiles': os.path.join(self.PREFIX, 'distfiles') if self.config.distfiles_dir else '',
             'portage.autofix': True,
+
+            # Caches
+            'cache.roots': self.INNER_ROOTS if self.config.roots_cache_dir else '',
+            'cache.metadata': self.INNER_METADATA if self.config.metadata_cache_dir else '',
+            # Repositories are mounted read-only; setup() updated their metadata
+            'cache.metadata_update': False,
         }
 
+        # Unset means the algorithm's default
+        if self.config.image_compression_level is not None:
+            env['build.compression_level'] = self.config.image_compression_level
+
         # Add repository sections
         env['portage.repositories'] = ','.join(repo.name for repo in self.config.repositories)
         for repo in self.config.repositories:
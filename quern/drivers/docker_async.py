@@ -0,0 +1,156 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import signal
+
+import docker
+
+from . import docker as docker_driver
+from .. import core
+from .. import profiling
+
+
+logger = logging.getLogger('quern')
+
+
+# Seconds between two checks of the inactivity timeouts
+WATCHDOG_PERIOD = 1
+
+
+def _run_in_executor(loop, func, *args):
+    # Executor threads don't inherit context variables, e.g the job of a quern-server worker
+    return loop.run_in_executor(None, functools.partial(contextvars.copy_context().run, func, *args))
+
+
+class Driver(docker_driver.Driver):
+    """Docker driver supervising the builder container with asyncio.
+
+    Logs are followed while waiting for the container's exit code, and the
+    global (timeouts.build) and inactivity (timeouts.inactivity,
+    timeouts.stages) timeouts are enforced concurrently. On timeout or
+    SIGINT/SIGTERM, the container is killed and removed.
+    """
+
+    def build(self):
+        asyncio.run(self._build())
+
+    async def _build(self):
+        loop = asyncio.get_running_loop()
+        timings = profiling.BuildReport(self.config)
+
+        client = docker_driver.get_client(self.config.docker_address)
+
+        container = await _run_in_executor(loop, self._create_container, client, timings)
+        signals = self._install_signal_handlers(loop, asyncio.current_task())
+        self._background = []
+        self.build_log = None
+        sampler = None
+        try:
+            await _run_in_executor(loop, self._start_container, client, container, timings)
+            sampler = self._start_sampler(client, container)
+            retcode = await self._supervise(loop, client, container, sampler, timings)
+
+        except asyncio.CancelledError:
+            logger.error("Build interrupted")
+            await self._abort(loop, client, container, sampler, keep=False)
+            raise core.BuildError("Build of %s interrupted" % self.config.profile) from None
+
+        except core.BuildError:
+            await self._abort(loop, client, container, sampler, keep=self.config.keep_failed)
+            raise
+
+        finally:
+            for signum in signals:
+                loop.remove_signal_handler(signum)
+
+        self._stop_sampler(sampler, success=not retcode)
+        await _run_in_executor(loop, self._finish, client, container, retcode, timings)
+
+    def _install_signal_handlers(self, loop, task):
+        installed = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, task.cancel)
+            except (RuntimeError, ValueError):
+                # Not in the main thread (e.g matrix builds): the main thread handles signals.
+                break
+            installed.append(signum)
+        return installed
+
+    async def _supervise(self, loop, client, container, sampler, timings):
+        self._last_activity = loop.time()
+        self._stage = None
+
+        with timings.measure('run', section='container'):
+            logs = _run_in_executor(loop, self._follow_logs, loop, client, container, sampler)
+            wait = _run_in_executor(loop, client.wait, container.id)
+            self._background = [logs, wait]
+            watchdog = asyncio.ensure_future(self._watch_inactivity(loop))
+
+            try:
+                done, _pending = await asyncio.wait(
+                    {wait, watchdog},
+                    timeout=self.config.timeout_build or None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    raise core.BuildError(
+                        "Build of %s timed out after %d seconds" % (self.config.profile, self.config.timeout_build),
+                    )
+                if watchdog in done:
+                    watchdog.result()
+
+                retcode = wait.result()
+                # The log stream ends with the container.
+                await logs
+            finally:
+                watchdog.cancel()
+
+        return retcode
+
+    def _follow_logs(self, loop, client, container, sampler):
+        logs = client.logs(container=container.id, stdout=True, stderr=True, stream=True, follow=True)
+        for log in logs:
+            text = self._handle_log(log, sampler)
+            loop.call_soon_threadsafe(self._on_log, loop, text)
+
+    def _on_log(self, loop, text):
+        self._last_activity = loop.time()
+        self._stage = profiling.parse_stage(text) or self._stage
+
+    async def _watch_inactivity(self, loop):
+        while True:
+            await asyncio.sleep(WATCHDOG_PERIOD)
+            limit = self.config.inactivity_timeouts.get(self._stage, self.config.timeout_inactivity)
+            idle = loop.time() - self._last_activity
+            if limit and idle > limit:
+                raise core.BuildError(
+                    "No output from the builder for %d seconds during stage %s"
+                    % (idle, self._stage or 'setup'),
+                )
+
+    async def _abort(self, loop, client, container, sampler, keep):
+        await _run_in_executor(loop, self._stop_container, client, container, keep)
+        # Log and wait calls return once the container is gone
+        await asyncio.gather(*self._background, return_exceptions=True)
+        self._stop_sampler(sampler, success=False)
+        if self.build_log is not None:
+            self.build_log.close(success=False)
+
+    def _stop_container(self, client, container, keep):
+        logger.info("Killing container (id=%s, name=%s)", container.id, container.name)
+        try:
+            client.kill(container=container.id)
+        except docker.errors.APIError as e:
+            logger.warning("Unable to kill container %s: %s", container.name, e)
+
+        if keep:
+            logger.info("Failed container kept: id=%s, name=%s", container.id, container.name)
+            return
+
+        logger.info("Removing container")
+        try:
+            client.remove_container(container=container.id, v=True, force=True)
+        except docker.errors.APIError as e:
+            logger.warning("Unable to remove container %s: %s", container.name, e)
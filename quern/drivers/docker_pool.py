@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+import os.path
+
+import docker
+
+from . import docker as docker_driver
+from .. import buildlog
+from .. import core
+from .. import locks
+from .. import profiling
+
+
+logger = logging.getLogger('quern')
+
+
+POOL_LABEL = 'quern.pool'
+
+# Keeps pooled containers alive between builds
+IDLE_COMMAND = ['/bin/sleep', 'infinity']
+
+
+class Driver(docker_driver.Driver):
+    """Docker driver running builds in warm, long-lived containers.
+
+    Up to docker.pool_size containers are kept running for each docker.image
+    and set of mounts; builds are dispatched with `docker exec`, and the
+    working directory is reset between builds. Slots are shared between quern
+    processes through lock files in docker.pool_lockdir.
+    """
+
+    def build(self):
+        timings = profiling.BuildReport(self.config)
+
+        client = docker_driver.get_client(self.config.docker_address)
+
+        image_id = client.inspect_image(self.config.docker_image)['Id']
+        key = self._pool_key(image_id)
+        slots = [os.path.join(self.config.docker_pool_lockdir, '%s-%d' % (key, index))
+            for index in range(self.config.docker_pool_size)]
+
+        with locks.first_available(slots) as slot:
+            container = self._warm_container(client, image_id, key, os.path.basename(slot), timings)
+            self._reset_workdir(client, container, timings)
+
+            self.build_log = buildlog.BuildLog(self.config)
+            sampler = self._start_sampler(client, container)
+            with timings.measure('run', section='container'):
+                retcode = self._exec(client, container, sampler)
+            self._stop_sampler(sampler, success=not retcode)
+
+            self._finish(client, container, retcode, timings)
+
+    def _pool_key(self, image_id):
+        # Warm containers of an image tag's previous version are left alone
+        ro_volumes, rw_volumes, tmpfs_volumes = self._container_volumes()
+        description = json.dumps([
+            image_id,
+            sorted(ro_volumes.items()),
+            sorted(rw_volumes.items()),
+            sorted(tmpfs_volumes.items()),
+        ])
+        return hashlib.sha256(description.encode('utf-8')).hexdigest()[:12]
+
+    def _slot_volumes(self, slot):
+        ro_volumes, rw_volumes, tmpfs_volumes = self._container_volumes()
+        # Each slot gets its own folder within a file: workdir_storage
+        for host_path, image_path in list(rw_volumes.items()):
+            if image_path == self.config.workdir:
+                del rw_volumes[host_path]
+                rw_volumes[os.path.join(host_path, slot)] = image_path
+        return ro_volumes, rw_volumes, tmpfs_volumes
+
+    def _warm_container(self, client, image_id, key, slot, timings):
+        name = 'quern-pool-%s' % slot
+
+        try:
+            state = client.inspect_container(name)
+        except docker.errors.NotFound:
+            state = None
+
+        if state is not None:
+            if state['State']['Running']:
+                logger.info("Using warm container %s", name)
+                return docker_driver.Container(id=state['Id'], name=name, env={})
+            logger.info("Replacing stopped pool container %s", name)
+            client.remove_container(container=state['Id'], v=True, force=True)
+
+        ro_volumes, rw_volumes, tmpfs_volumes = self._slot_volumes(slot)
+        for host_path in rw_volumes:
+            os.makedirs(host_path, exist_ok=True)
+
+        logger.info("Creating pool container from %s (%s), name=%s", self.config.docker_image, image_id, name)
+        host_config = client.create_host_config(**self._make_host_config(
+            ro_volumes=ro_volumes,
+            rw_volumes=rw_volumes,
+            tmpfs_volumes=tmpfs_volumes,
+        ))
+        with timings.measure('create', section='container'):
+            created = client.create_container(
+                image=image_id,
+                entrypoint=IDLE_COMMAND,
+                volumes=list(ro_volumes.values()) + list(rw_volumes.values()),
+                name=name,
+                labels={POOL_LABEL: key},
+                host_config=host_config,
+            )
+        container = docker_driver.Container(id=created.get('Id'), name=name, env={})
+        with timings.measure('start', section='container'):
+            response = client.start(container=container.id)
+        if response is not None:
+            raise core.BuildError("Error starting container: %s" % response)
+        return container
+
+    def _run_quietly(self, client, container, command):
+        exec_id = client.exec_create(container=container.id, cmd=command)
+        output = client.exec_start(exec_id)
+        retcode = client.exec_inspect(exec_id)['ExitCode']
+        if retcode:
+            raise core.BuildError("Command %s failed in %s: %s" % (' '.join(command), container.name, output))
+
+    def _reset_workdir(self, client, container, timings):
+        folders = [self.config.workdir]
+        if not self.config.debug_workdir:
+            folders.append(self.INNER_PORTAGE_WORKDIR)
+
+        logger.info("Resetting %s in %s", ', '.join(folders), container.name)
+        with timings.measure('reset', section='container'):
+            self._run_quietly(client, container, [
+                '/bin/sh', '-c', 'mkdir -p "$@" && find "$@" -mindepth 1 -delete', 'reset',
+            ] + folders)
+
+    def _exec(self, client, container, sampler):
+        # docker-py 1.x can't set the environment of an exec; pass it through env(1)
+        env = self._make_runner_env()
+        command = ['env'] + ['%s=%s' % item for item in sorted(env.items())] + [
+            '/usr/bin/quern-builder', '/etc/quern.conf',
+        ]
+        logger.info("Running build in %s", container.name)
+        exec_id = client.exec_create(container=container.id, cmd=command)
+        for log in client.exec_start(exec_id, stream=True):
+            self._handle_log(log, sampler)
+        return client.exec_inspect(exec_id)['ExitCode']
+
+    def _release_container(self, client, container, retcode, timings):
+        # The container stays warm for the next build
+        if retcode and self.config.keep_failed:
+            logger.info("Failed build workdir kept in %s until its next build", container.name)
+        else:
+            # Release the tmpfs memory now
+            self._reset_workdir(client, container, timings)
@@ -1,16 +1,41 @@
+import hashlib
+import json
 import logging
 import os
 import os.path
+import re
 import shutil
 import subprocess
+import sys
+import tarfile
 
 from . import base
+from .. import archive
+from .. import assemble
+from .. import baseroot
+from .. import binpkgs
+from .. import checkpoint
+from .. import closure
+from .. import dedupe
+from .. import delta
+from .. import distfiles
+from .. import fsutil
+from .. import layers
+from .. import metadata
+from .. import profiling
+from .. import profiles
+from .. import strip
 
 
 logger = logging.getLogger('quern')
 
 
-def run_command(args, **environ):
+# Source merges in `emerge --pretend` output, e.g "[ebuild  N    ] sys-libs/zlib-1.2.11::gentoo"
+_PRETEND_EBUILD_RE = re.compile(r'^\[ebuild[^\]]*\]\s+(\S+)')
+
+
+def run_command(args, output_handler=None, **environ):
+    """Run a command; if set, output_handler receives each line of its output."""
     logger.info("Calling %s %s",
         ' '.join('%s="%s"' % item for item in sorted(environ.items())),
         ' '.join(args),
@@ -18,16 +43,32 @@ def run_command(args, **environ):
 
     env = dict(os.environ)
     env.update(environ)
-    return subprocess.check_call(args, env=env)
+    if output_handler is None:
+        return subprocess.check_call(args, env=env)
 
-
-COMPRESSION_TAR_OPTIONS = {
-    'gzip': '--gzip',
-    'bzip2': '--bzip2',
-}
+    process = subprocess.Popen(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    with process.stdout:
+        for line in process.stdout:
+            sys.stdout.buffer.write(line)
+            sys.stdout.buffer.flush()
+            output_handler(line.decode('utf-8', 'replace'))
+    retcode = process.wait()
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, args)
+    return retcode
 
 
 class Driver(base.BaseDriver):
+    # Written to the portage configuration root once setup completes
+    SETUP_MARKER = '.quern-setup'
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.base_roots = baseroot.BaseRootCache(config)
+        self.base_root_restored = False
+        self.assembled = False
+        self.report = profiling.BuildReport(config)
+
     def _fix_portage(self, main_repo):
         """Fix the portage setup: point /usr/portage at the main repo path."""
         if not self.config.autofix_portage:
@@ -50,6 +91,20 @@ class Driver(base.BaseDriver):
                 os.symlink(main_repo.location, expected_path)
 
     def setup(self):
+        make_conf_lines = list(self.config.make_conf_lines())
+        repos_conf_lines = list(self.config.make_repos_conf_lines())
+        fingerprint = hashlib.sha256(json.dumps(
+            [make_conf_lines, repos_conf_lines, self.config.autofix_portage],
+        ).encode('utf-8')).hexdigest()
+
+        # Warm containers (docker_pool driver) run many builds with the same setup
+        marker = os.path.join(self.config.portage_configroot, self.SETUP_MARKER)
+        if os.path.isfile(marker):
+            with open(marker, 'r', encoding='utf-8') as f:
+                if f.read().strip() == fingerprint:
+                    logger.info("Build portage configuration at %s is up to date", self.config.portage_configroot)
+                    return
+
         if os.path.exists(self.config.portage_configroot):
             logger.info("Existing portage configuration found at %s, moving to %s",
                     self.config.portage_configroot,
@@ -62,19 +117,96 @@ class Driver(base.BaseDriver):
 
         make_conf = os.path.join(self.config.portage_configroot, 'make.conf')
         with open(make_conf, 'w', encoding='UTF-8') as f:
-            for line in self.config.make_conf_lines():
+            for line in make_conf_lines:
                 f.write(line + '\n')
 
         logger.info("Configuring build repositories")
         repos_conf = os.path.join(self.config.portage_configroot, 'repos.conf')
         with open(repos_conf, 'w', encoding='UTF-8') as f:
-            f.write('\n'.join(self.config.make_repos_conf_lines()))
+            f.write('\n'.join(repos_conf_lines))
 
         self._fix_portage(self.config.repositories[0])
 
+        with open(marker, 'w', encoding='utf-8') as f:
+            f.write(fingerprint + '\n')
+
+    # Build stages, in order, as (name, checkpointed).
+    # Checkpointed stages are skipped on resume once completed; the others
+    # only configure the builder and always run.
+    STAGES = [
+        ('metadata', False),
+        ('unblock', False),
+        ('select_base_profile', False),
+        ('assemble', False),
+        ('restore_base_root', True),
+        ('prefetch_base', False),
+        ('baselayout', True),
+        ('system', True),
+        ('store_base_root', True),
+        ('select_profile', False),
+        ('prefetch_profile', False),
+        ('profile', True),
+        ('record_plan', False),
+        ('record_binpkgs', False),
+        ('index_layers', True),
+        ('strip', True),
+        ('minimize', True),
+        ('dedupe', True),
+        ('pack', False),
+    ]
+
+    # Stages replaced by the assembly of the image from binpkgs
+    EMERGE_STAGES = {
+        'restore_base_root', 'prefetch_base', 'baselayout', 'system', 'store_base_root',
+        'prefetch_profile', 'profile', 'record_plan',
+    }
+
     def build(self):
         logger.info("Starting compilation")
 
+        checkpoints = checkpoint.Checkpoints(self.config)
+        if self.config.resume:
+            done = checkpoints.restore([name for name, checkpointed in self.STAGES if checkpointed])
+        else:
+            checkpoints.clear()
+            done = []
+
+        for name, checkpointed in self.STAGES:
+            if name in done:
+                logger.info("Skipping stage %s, completed by a previous run", name)
+                self.report.skipped(name)
+                continue
+            if self.assembled and name in self.EMERGE_STAGES:
+                logger.info("Skipping stage %s, image assembled from binpkgs", name)
+                self.report.skipped(name)
+                continue
+
+            logger.info("Stage %s", name)
+            with self.report.measure(name):
+                getattr(self, '_stage_%s' % name)()
+                if checkpointed:
+                    checkpoints.record(name)
+
+        checkpoints.clear()
+        self.report.write()
+        logger.info("Done")
+
+    def _emerge(self, args, stage, **environ):
+        # emerge needs the terminal for its questions
+        if self.config.emerge_ask:
+            run_command(['emerge'] + args, **environ)
+            return
+
+        parser = profiling.EmergeLogParser(stage)
+        try:
+            run_command(['emerge'] + args, output_handler=parser.feed, **environ)
+        finally:
+            self.report.add_packages(parser)
+
+    def _stage_metadata(self):
+        metadata.MetadataCache(self.config).update()
+
+    def _stage_unblock(self):
         if self.config.unblocker_profile:
             # Specific profile that helps fixing USE conflicts (e.g when USE flags
             # trigger circular dependencies on the builder system)
@@ -82,39 +214,187 @@ class Driver(base.BaseDriver):
             run_command(['eselect', 'profile', 'set', self.config.unblocker_profile])
 
             logger.info("Merging unblocking packages to main system")
-            run_command(['emerge', '--oneshot', '--newuse', '--update', '@world'], ROOT='/')
+            self._emerge(['--oneshot', '--newuse', '--update', '@world'], 'unblock', ROOT='/')
 
-        logger.info("Enabling profile %s", self.config.profile)
-        run_command(['eselect', 'profile', 'set', self.config.profile])
+    def _select_profile(self, profile):
+        logger.info("Enabling profile %s", profile)
+        run_command(['eselect', 'profile', 'set', profile])
 
+    def _stage_select_base_profile(self):
+        self._select_profile(profiles.base_profile(self.config))
+
+    def _stage_assemble(self):
+        assembler = assemble.Assembler(self.config)
+        packages = assembler.load()
+        if packages is None:
+            return
+
+        def merge(cpv):
+            self._emerge(['--oneshot', '--nodeps', '--usepkgonly', '=%s' % cpv], 'assemble')
+
+        try:
+            assembler.assemble(packages, merge)
+        except (OSError, ValueError, tarfile.TarError, subprocess.CalledProcessError) as e:
+            logger.warning("Unable to assemble the image from binpkgs, using emerge: %s", e)
+            fsutil.remove_tree(self.config.workdir_image)
+            return
+        run_command(['env-update'])
+        self.assembled = True
+
+    def _stage_restore_base_root(self):
+        self.base_root_restored = self.base_roots.restore()
+
+    def _read_manifest(self, pkgdir):
+        """Map distfile names to (size, digests) from a package's Manifest."""
+        entries = {}
+        try:
+            with open(os.path.join(pkgdir, 'Manifest'), 'r', encoding='utf-8') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) >= 3 and fields[0] == 'DIST':
+                        entries[fields[1]] = (int(fields[2]), dict(zip(fields[3::2], fields[4::2])))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _fetch_list(self, targets):
+        """Resolve the distfiles needed to merge targets, as (distdir, distfiles).
+
+        Prefetching is only an optimization: on failure, nothing is prefetched
+        and emerge fetches what it needs.
+        """
+        try:
+            output = subprocess.check_output(
+                ['emerge', '--pretend', '--quiet', '--color=n'] + targets,
+                stderr=subprocess.DEVNULL,
+            ).decode('utf-8', 'replace')
+            import portage
+            import portage.exception
+        except (OSError, ImportError, subprocess.CalledProcessError) as e:
+            logger.warning("Unable to list distfiles of %s, not prefetching: %s", ' '.join(targets), e)
+            return None, []
+
+        cpvs = []
+        for line in output.splitlines():
+            match = _PRETEND_EBUILD_RE.match(line.strip())
+            if match:
+                cpvs.append(match.group(1).split('::')[0])
+
+        portdb = portage.db[portage.root]['porttree'].dbapi
+        settings = portage.config(clone=portdb.settings)
+        mirrors = settings.thirdpartymirrors()
+
+        found = {}
+        for cpv in cpvs:
+            try:
+                settings.setcpv(cpv, mydb=portdb)
+                fetch_map = portdb.getFetchMap(cpv, useflags=settings['PORTAGE_USE'].split())
+            except portage.exception.PortageException as e:
+                logger.warning("Unable to list distfiles of %s, not prefetching them: %s", cpv, e)
+                continue
+            manifest = self._read_manifest(os.path.dirname(portdb.findname(cpv)))
+            for name, uris in fetch_map.items():
+                if name not in manifest or name in found:
+                    continue
+                expanded = []
+                for uri in uris:
+                    if uri.startswith('mirror://'):
+                        mirror, _sep, path = uri[len('mirror://'):].partition('/')
+                        expanded.extend('%s/%s' % (base.rstrip('/'), path) for base in mirrors.get(mirror, []))
+                    else:
+                        expanded.append(uri)
+                size, digests = manifest[name]
+                found[name] = distfiles.Distfile(name=name, size=size, digests=digests, uris=expanded)
+
+        return settings['DISTDIR'], list(found.values())
+
+    def _prefetch(self, targets):
+        if not self.config.fetch_jobs or not targets:
+            return
+        distdir, needed = self._fetch_list(targets)
+        if not needed:
+            return
+        distfiles.Prefetcher(self.config, distdir).run(needed)
+
+    def _stage_prefetch_base(self):
+        targets = []
+        if not self.base_root_restored:
+            targets += self.config.baselayout_atoms
+            if self.config.include_system:
+                targets.append('@system')
+        if profiles.base_profile(self.config) == self.config.profile:
+            targets.append('@profile')
+        self._prefetch(targets)
+
+    def _stage_prefetch_profile(self):
+        # With a distinct base profile, @profile can only be resolved once selected
+        if profiles.base_profile(self.config) != self.config.profile:
+            self._prefetch(['@profile'])
+
+    def _stage_baselayout(self):
+        if self.base_root_restored:
+            return
         if self.config.baselayout_atoms:
             # Merge baselayout atoms first - they should setup common system files
             logger.info("Building baselayout atoms: %s", ', '.join(self.config.baselayout_atoms))
-            run_command(['emerge', '--jobs=1'] + self.config.baselayout_atoms)
+            self._emerge(['--jobs=1'] + self.config.baselayout_atoms, 'baselayout')
 
+    def _stage_system(self):
+        if self.base_root_restored:
+            return
         if self.config.include_system:
             logger.info("Building @system packages")
-            run_command(['emerge', '@system'])
+            self._emerge(['@system'], 'system')
+
+    def _stage_store_base_root(self):
+        if not self.base_root_restored:
+            self.base_roots.store()
+
+    def _stage_select_profile(self):
+        if profiles.base_profile(self.config) != self.config.profile:
+            self._select_profile(self.config.profile)
 
+    def _stage_profile(self):
         logger.info("Building @profile packages")
-        run_command(['emerge', '@profile'])
+        self._emerge(['@profile'], 'profile')
 
-        # Cleanup
-        for d in self.config.strip_folders:
-            folder = os.path.join(self.config.workdir_image, d.lstrip('/'))
-            logger.info("Pruning %s", folder)
-            shutil.rmtree(folder)
+    def _stage_record_plan(self):
+        install_mask = subprocess.check_output(
+            ['portageq', 'envvar', 'INSTALL_MASK', 'PKG_INSTALL_MASK'],
+        ).decode('utf-8').strip()
+        assemble.Assembler(self.config).record(install_mask)
 
+    def _stage_record_binpkgs(self):
+        # Before strip, which may remove the package database
+        binpkgs.BinpkgStore(self.config).record(self.config.workdir_image)
+
+    def _stage_index_layers(self):
+        if self.config.layers_enabled:
+            layers.LayerPlanner(self.config).index()
+
+    def _stage_strip(self):
+        self.report.data['strip'] = strip.Stripper(self.config, self.config.workdir_image).run()
+
+    def _stage_minimize(self):
+        if self.config.minimize:
+            closure.RuntimeClosure(self.config, self.config.workdir_image).run()
+
+    def _stage_dedupe(self):
+        if self.config.strip_dedupe:
+            self.report.data['dedupe'] = dedupe.Deduplicator(self.config, self.config.workdir_image).run()
+
+    def _stage_pack(self):
         logger.info("Collecting image at %s", self.config.image_path)
-        run_command([
-            'tar',
-            '--directory',
+        archive.pack(
             self.config.workdir_image,
-            '--create',
-            COMPRESSION_TAR_OPTIONS[self.config.image_compression],
-            '--file',
             self.config.image_path,
-            '.',
-        ])
+            algorithm=self.config.image_compression,
+            level=self.config.image_compression_level,
+            threads=self.config.image_compression_threads,
+            mtime=self.config.archive_mtime,
+        )
 
-        logger.info("Done")
+        if self.config.layers_enabled:
+            layers.LayerPlanner(self.config).pack()
+        if self.config.delta:
+            delta.DeltaWriter(self.config).write(self.config.workdir_image)
@@ -0,0 +1,44 @@
+import logging
+import os
+import os.path
+import shutil
+import subprocess
+
+
+logger = logging.getLogger('quern')
+
+
+def remove_tree(path):
+    if os.path.lexists(path):
+        shutil.rmtree(path)
+
+
+def clone_tree(source, target):
+    """Cheaply copy the `source` tree to `target`.
+
+    Uses reflinks where the filesystem supports them, then a hard-link farm,
+    then a plain copy across filesystems; portage replaces files instead of
+    rewriting them, so hard links are safe for image roots.
+    """
+    remove_tree(target)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        subprocess.check_call(
+            ['cp', '--archive', '--reflink=always', '--', source, target],
+            stderr=subprocess.DEVNULL,
+        )
+        return
+    except subprocess.CalledProcessError:
+        remove_tree(target)
+
+    try:
+        subprocess.check_call(
+            ['cp', '--archive', '--link', '--', source, target],
+            stderr=subprocess.DEVNULL,
+        )
+        return
+    except subprocess.CalledProcessError:
+        remove_tree(target)
+
+    logger.info("Copying %s to %s (no reflink or hard link support)", source, target)
+    subprocess.check_call(['cp', '--archive', '--', source, target])
@@ -0,0 +1,130 @@
+import contextlib
+import itertools
+import json
+import logging
+import os
+import os.path
+import time
+
+from . import locks
+
+
+logger = logging.getLogger('quern')
+
+
+STATE_FILE = 'builds.json'
+
+# Distinguish concurrent builds from the same process
+_build_counter = itertools.count()
+
+
+def host_memory_mb():
+    try:
+        with open('/proc/meminfo', 'r', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Governor:
+    """Share the host's CPUs and memory between concurrent quern builds.
+
+    Running builds are registered in a state file under governor.dir, shared
+    by all quern processes on the host. Each build starting gets a fair share
+    of the CPUs (and of the memory, at governor.memory_per_job per job), split
+    into emerge jobs and MAKEOPTS jobs; all builds also get the host's CPU
+    count as load average limit, so that emerge and make throttle themselves
+    as builds start and finish.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.build_id = '%d-%d' % (os.getpid(), next(_build_counter))
+
+    @property
+    def enabled(self):
+        return bool(self.config.governor_dir)
+
+    @property
+    def state_path(self):
+        return os.path.join(self.config.governor_dir, STATE_FILE)
+
+    @property
+    def cpus(self):
+        return self.config.governor_cpus or os.cpu_count() or 1
+
+    def _load(self):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                builds = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        # Drop builds whose process died without unregistering
+        return {build_id: build for build_id, build in builds.items() if _alive(build['pid'])}
+
+    def _write(self, builds):
+        tmp_path = '%s.partial' % self.state_path
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(builds, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def budget(self, active):
+        """Compute (emerge_jobs, make_jobs) for a build among `active` running builds."""
+        share = self.cpus // active
+        memory_mb = host_memory_mb()
+        if self.config.governor_memory_per_job and memory_mb:
+            share = min(share, memory_mb // self.config.governor_memory_per_job // active)
+        share = max(1, share)
+
+        emerge_jobs = max(1, min(self.config.emerge_jobs or 1, share))
+        make_jobs = max(1, share // emerge_jobs)
+        return emerge_jobs, make_jobs
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Register the build for its duration, applying its budget to the configuration."""
+        if not self.enabled:
+            yield
+            return
+
+        with locks.exclusive(self.config.governor_dir):
+            builds = self._load()
+            emerge_jobs, make_jobs = self.budget(len(builds) + 1)
+            builds[self.build_id] = {
+                'pid': os.getpid(),
+                'profile': self.config.profile,
+                'started': time.time(),
+                'emerge_jobs': emerge_jobs,
+                'make_jobs': make_jobs,
+            }
+            self._write(builds)
+
+        self.config.emerge_jobs = emerge_jobs
+        self.config.make_jobs = make_jobs
+        self.config.load_average = self.config.load_average or self.cpus
+        logger.info(
+            "Resource budget for %s, with %d other builds running: emerge.jobs = %d, emerge.make_jobs = %d, "
+            "emerge.load_average = %d",
+            self.config.profile, len(builds) - 1, emerge_jobs, make_jobs, self.config.load_average,
+        )
+
+        try:
+            yield
+        finally:
+            with locks.exclusive(self.config.governor_dir):
+                builds = self._load()
+                builds.pop(self.build_id, None)
+                self._write(builds)
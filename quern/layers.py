@@ -0,0 +1,211 @@
+import collections
+import fnmatch
+import json
+import logging
+import os
+import os.path
+import re
+
+from . import archive
+
+
+logger = logging.getLogger('quern')
+
+
+VDB_PATH = os.path.join('var', 'db', 'pkg')
+
+# Trailing version of a ${PF}, e.g foo-bar-1.2.3_p4-r1
+_VERSION_RE = re.compile(r'-\d+(\.\d+)*[a-z]?(_(alpha|beta|pre|rc|p)\d*)*(-r\d+)?$')
+
+
+def split_version(cpv):
+    """Split sys-libs/zlib-1.2.8-r1 into (sys-libs/zlib, 1.2.8-r1)."""
+    match = _VERSION_RE.search(cpv)
+    if not match:
+        return cpv, ''
+    return cpv[:match.start()], match.group()[1:]
+
+
+def _parse_contents_line(line):
+    kind, _sep, rest = line.rstrip('\n').partition(' ')
+    if kind == 'obj':
+        # obj <path> <md5> <mtime>
+        return rest.rsplit(' ', 2)[0]
+    elif kind == 'sym':
+        # sym <path> -> <target> <mtime>
+        return rest.split(' -> ', 1)[0]
+    elif kind in ('dir', 'dev', 'fif'):
+        return rest
+    return None
+
+
+def read_contents(root):
+    """Map each installed package (cat/pf) to the paths listed in its CONTENTS."""
+    vdb = os.path.join(root, VDB_PATH)
+    packages = collections.OrderedDict()
+    if not os.path.isdir(vdb):
+        return packages
+
+    for category in sorted(os.listdir(vdb)):
+        category_dir = os.path.join(vdb, category)
+        if not os.path.isdir(category_dir):
+            continue
+        for pf in sorted(os.listdir(category_dir)):
+            contents = os.path.join(category_dir, pf, 'CONTENTS')
+            if not os.path.isfile(contents):
+                continue
+            paths = []
+            with open(contents, 'r', encoding='utf-8', errors='surrogateescape') as f:
+                for line in f:
+                    path = _parse_contents_line(line)
+                    if path:
+                        paths.append(path)
+            packages['%s/%s' % (category, pf)] = paths
+    return packages
+
+
+def _real_relpath(root, path):
+    """Resolve folder symlinks (e.g /lib -> lib64) in an image path, relative to root."""
+    parent = os.path.realpath(os.path.join(root, os.path.dirname(path).lstrip('/')))
+    real_root = os.path.realpath(root)
+    if parent != real_root and not parent.startswith(real_root + os.sep):
+        return path.lstrip('/')
+    return os.path.relpath(os.path.join(parent, os.path.basename(path)), real_root)
+
+
+class LayerPlanner:
+    """Assign each installed package to an image layer.
+
+    Layers are ordered from the least to the most frequently changing:
+    one per layers.groups entry, then remaining packages, then packages whose
+    version changed at least layers.volatile_changes times along with files
+    not owned by any package.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.groups = [group.split() for group in config.layers_groups]
+        self.layer_names = ['group%d' % i for i in range(len(self.groups))] + ['packages', 'volatile']
+
+    @property
+    def history_path(self):
+        return os.path.join(self.config.outdir, 'layers-%s.json' % self.config.profile_safe)
+
+    @property
+    def index_path(self):
+        return os.path.join(self.config.workdir, 'layers-index.json')
+
+    def _load_history(self):
+        try:
+            with open(self.history_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _layer_for(self, cpv, history):
+        key, _version = split_version(cpv)
+        if history.get(key, {}).get('changes', 0) >= self.config.layers_volatile_changes:
+            return len(self.layer_names) - 1
+        for i, patterns in enumerate(self.groups):
+            if any(fnmatch.fnmatchcase(key, pattern) for pattern in patterns):
+                return i
+        return len(self.layer_names) - 2
+
+    def index(self):
+        """Record the layer of every package-owned path; must run before /var/db/pkg is stripped."""
+        root = self.config.workdir_image
+        history = self._load_history()
+        packages = read_contents(root)
+
+        package_layers = {cpv: self._layer_for(cpv, history) for cpv in packages}
+        path_layers = {}
+        for cpv, paths in packages.items():
+            for path in paths:
+                path_layers[_real_relpath(root, path)] = package_layers[cpv]
+
+        logger.info("Indexed %d paths from %d packages for layering", len(path_layers), len(packages))
+        with open(self.index_path, 'w', encoding='utf-8') as f:
+            json.dump({'packages': package_layers, 'paths': path_layers}, f)
+
+    def _update_history(self, packages):
+        history = self._load_history()
+        for cpv in packages:
+            key, version = split_version(cpv)
+            entry = history.setdefault(key, {'version': version, 'changes': 0})
+            if entry['version'] != version:
+                entry['version'] = version
+                entry['changes'] += 1
+
+        with open(self.history_path, 'w', encoding='utf-8') as f:
+            json.dump(history, f, indent=2, sort_keys=True)
+
+    def split(self):
+        """Distribute the current content of the image root among layers."""
+        root = self.config.workdir_image
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        path_layers = index['paths']
+        last = len(self.layer_names) - 1
+
+        layers = [set() for _name in self.layer_names]
+
+        def add(relpath, layer):
+            layers[layer].add(relpath)
+            parent = os.path.dirname(relpath)
+            while parent and parent not in layers[layer]:
+                layers[layer].add(parent)
+                parent = os.path.dirname(parent)
+
+        for dirpath, dirnames, filenames in os.walk(root):
+            reldir = os.path.relpath(dirpath, root)
+            for name in dirnames + filenames:
+                relpath = os.path.normpath(os.path.join(reldir, name))
+                full_path = os.path.join(dirpath, name)
+                if name in dirnames and not os.path.islink(full_path):
+                    # Folders follow their content, unless empty
+                    if not os.listdir(full_path):
+                        add(relpath, path_layers.get(relpath, last))
+                    continue
+                add(relpath, path_layers.get(relpath, last))
+
+        return index['packages'], layers
+
+    def pack(self):
+        packages, layers = self.split()
+
+        manifest_layers = []
+        for i, (name, paths) in enumerate(zip(self.layer_names, layers)):
+            if not paths:
+                continue
+            path = self.config.layer_path(len(manifest_layers), name)
+            logger.info("Collecting layer %s (%d entries) at %s", name, len(paths), path)
+            info = archive.pack_paths(
+                self.config.workdir_image,
+                paths,
+                path,
+                algorithm=self.config.image_compression,
+                level=self.config.image_compression_level,
+                threads=self.config.image_compression_threads,
+                mtime=self.config.archive_mtime,
+            )
+            manifest_layers.append({
+                'name': name,
+                'file': os.path.basename(path),
+                'digest': info.digest,
+                'size': info.size,
+                'diff_id': info.diff_id,
+                'packages': sorted(cpv for cpv, layer in packages.items() if layer == i),
+            })
+
+        manifest = {
+            'image': self.config.image_name,
+            'profile': self.config.profile,
+            'compression': self.config.image_compression,
+            'layers': manifest_layers,
+        }
+        with open(self.config.layers_manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        logger.info("Layer manifest written to %s", self.config.layers_manifest_path)
+
+        self._update_history(packages)
+        return manifest
@@ -0,0 +1,78 @@
+import contextlib
+import fcntl
+import logging
+import os
+import os.path
+
+
+logger = logging.getLogger('quern')
+
+
+LOCK_NAME = '.quern.lock'
+
+
+@contextlib.contextmanager
+def _locked(folder, operation):
+    os.makedirs(folder, exist_ok=True)
+    fd = os.open(os.path.join(folder, LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("Waiting for lock on %s", folder)
+            fcntl.flock(fd, operation)
+        yield
+    finally:
+        os.close(fd)
+
+
+def shared(folder):
+    """Hold a shared lock on a folder; concurrent builds take it while using the folder."""
+    return _locked(folder, fcntl.LOCK_SH)
+
+
+def exclusive(folder):
+    """Hold an exclusive lock on a folder, e.g for maintenance tasks."""
+    return _locked(folder, fcntl.LOCK_EX)
+
+
+@contextlib.contextmanager
+def exclusive_nowait(folder):
+    """Try to lock a folder exclusively; yields whether the lock was acquired."""
+    os.makedirs(folder, exist_ok=True)
+    fd = os.open(os.path.join(folder, LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+        else:
+            yield True
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def first_available(folders):
+    """Exclusively lock the first folder not locked by another process; yields that folder.
+
+    If all are locked, wait for one of them.
+    """
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+        fd = os.open(os.path.join(folder, LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+        try:
+            yield folder
+        finally:
+            os.close(fd)
+        return
+
+    # Spread waiting processes over all folders
+    folder = folders[os.getpid() % len(folders)]
+    with exclusive(folder):
+        yield folder
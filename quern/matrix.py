@@ -0,0 +1,125 @@
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+from . import core
+from . import profiles
+from . import runner
+
+
+logger = logging.getLogger('quern')
+
+
+BuildResult = collections.namedtuple('BuildResult', ['config', 'status', 'duration', 'error'])
+
+
+def expand(configs):
+    """Split configurations into one configuration per build, each with its own workdir.
+
+    Configurations listing matrix.profiles yield one build per profile.
+    """
+    builds = []
+    names = collections.Counter()
+    for config in configs:
+        for profile in config.matrix_profiles or [config.profile]:
+            build = config.for_profile(profile)
+            # Configuration files may share a workdir and a profile (with other outdirs)
+            key = (build.workdir, build.docker_workdir_storage)
+            names[key] += 1
+            if names[key] > 1:
+                build = config.for_profile(profile, name='%s-%d' % (build.profile_safe, names[key]))
+            builds.append(build)
+    return builds
+
+
+def _parent_chain(config):
+    try:
+        return tuple(profiles.parents(config, config.profile))
+    except (core.QuernError, OSError):
+        # Unknown layout: the profile can't share a parent with others.
+        return (config.profile,)
+
+
+class Scheduler:
+    """Run several builds concurrently.
+
+    Profiles sharing the same parent chain are grouped; the first profile of
+    each group (its seed) builds first, and the others only start once it
+    finished, so that they reuse the binpkgs it produced.
+    """
+
+    def __init__(self, configs, jobs):
+        self.configs = configs
+        self.jobs = max(jobs, 1)
+
+    def check(self):
+        seen = set()
+        for config in self.configs:
+            config.check()
+            if config.forced_image_name:
+                raise core.ImproperlyConfigured("build.image_name can't be forced in matrix builds")
+            key = (config.outdir, config.profile)
+            if key in seen:
+                raise core.ImproperlyConfigured("Profile %s is built twice to %s" % (config.profile, config.outdir))
+            seen.add(key)
+
+        if self.jobs > 1 and any(config.driver == 'raw' for config in self.configs):
+            raise core.ImproperlyConfigured(
+                "The raw driver rewrites the host's portage configuration and can't run concurrent builds; "
+                "use matrix.jobs = 1"
+            )
+
+    def plan(self):
+        """Return (seeds, followers), followers mapping each seed index to the builds waiting on it."""
+        groups = collections.OrderedDict()
+        for index, config in enumerate(self.configs):
+            groups.setdefault(_parent_chain(config), []).append(index)
+
+        # Largest groups first: their seeds unlock the most builds
+        ordered = sorted(groups.values(), key=len, reverse=True)
+        seeds = [group[0] for group in ordered]
+        followers = {group[0]: group[1:] for group in ordered}
+        return seeds, followers
+
+    def _run_one(self, index):
+        config = self.configs[index]
+        threading.current_thread().name = config.profile_safe
+        start = time.monotonic()
+        try:
+            status = runner.build(config)
+        except Exception as e:
+            logger.exception("Build of %s failed", config.profile)
+            return BuildResult(config, runner.STATUS_FAILED, time.monotonic() - start, e)
+        return BuildResult(config, status, time.monotonic() - start, None)
+
+    def run(self):
+        seeds, followers = self.plan()
+        results = {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            pending = {executor.submit(self._run_one, index): index for index in seeds}
+            while pending:
+                done, _not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    results[index] = future.result()
+                    for follower in followers.get(index, []):
+                        pending[executor.submit(self._run_one, follower)] = follower
+
+        return [results[index] for index in range(len(self.configs))]
+
+
+def log_summary(results):
+    logger.info("Matrix build summary:")
+    for result in results:
+        logger.info(
+            "  %-40s %-7s %7.1fs  %s",
+            result.config.profile,
+            result.status,
+            result.duration,
+            result.config.image_path if result.error is None else result.error,
+        )
+    failed = sum(1 for result in results if result.status == runner.STATUS_FAILED)
+    logger.info("%d builds, %d failed", len(results), failed)
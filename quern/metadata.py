@@ -0,0 +1,116 @@
+import concurrent.futures
+import json
+import logging
+import os
+import os.path
+import subprocess
+
+from . import cache
+from . import locks
+
+
+logger = logging.getLogger('quern')
+
+
+REVISIONS_FILE = 'revisions.json'
+
+
+class MetadataCache:
+    """Dependency metadata of the repositories, shared between builds.
+
+    egencache writes it to each repository's metadata/md5-cache, with
+    cache.metadata (portage's PORTAGE_DEPCACHEDIR) as its intermediate
+    cache. A repository is regenerated when its revision, or that of a
+    repository it inherits eclasses from, changed since the last run;
+    egencache then only re-sources ebuilds whose inputs changed.
+
+    Docker drivers update it on the host, where repositories are writable,
+    before starting builder containers. Read-only repositories and
+    generation failures are skipped with a warning: portage then computes
+    the metadata it needs during the build.
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    @property
+    def enabled(self):
+        return bool(self.config.metadata_cache_dir) and self.config.metadata_update
+
+    @property
+    def revisions_path(self):
+        return os.path.join(self.config.metadata_cache_dir, REVISIONS_FILE)
+
+    def _load_revisions(self):
+        try:
+            with open(self.revisions_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_revisions(self, revisions):
+        tmp_path = '%s.partial' % self.revisions_path
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(revisions, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.revisions_path)
+
+    def current_revisions(self):
+        """Map each repository to the revisions its metadata depends on."""
+        own = {
+            repo.name: cache.repository_revision(repo.location)
+            for repo in self.config.repositories
+        }
+        main_repo = self.config.repositories[0].name
+        revisions = {}
+        for repo in self.config.repositories:
+            names = {repo.name, main_repo} | set(repo.masters.split())
+            revisions[repo.name] = ' '.join(
+                '%s=%s' % (name, own[name]) for name in sorted(names) if name in own
+            )
+        return revisions
+
+    def update(self):
+        if not self.enabled:
+            return
+
+        with locks.exclusive(self.config.metadata_cache_dir):
+            known = self._load_revisions()
+            current = self.current_revisions()
+            stale = [repo for repo in self.config.repositories if known.get(repo.name) != current[repo.name]]
+            if not stale:
+                logger.info("Repository metadata is up to date in %s", self.config.metadata_cache_dir)
+                return
+
+            writable = []
+            for repo in stale:
+                if os.access(repo.location, os.W_OK):
+                    writable.append(repo)
+                else:
+                    logger.warning("Repository %s (%s) is read-only, not generating its metadata", repo.name, repo.location)
+            if not writable:
+                return
+
+            jobs = max(1, (os.cpu_count() or 1) // len(writable))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(writable)) as executor:
+                futures = {executor.submit(self._generate, repo, jobs): repo for repo in writable}
+                for future in concurrent.futures.as_completed(futures):
+                    repo = futures[future]
+                    if future.result():
+                        known[repo.name] = current[repo.name]
+                        self._write_revisions(known)
+
+    def _generate(self, repo, jobs):
+        """Run egencache for a repository; returns whether it succeeded."""
+        logger.info("Generating metadata for repository %s (%s)", repo.name, repo.location)
+        args = [
+            'egencache', '--update',
+            '--repo=%s' % repo.name,
+            '--jobs=%d' % jobs,
+            '--cache-dir=%s' % self.config.metadata_cache_dir,
+        ]
+        try:
+            subprocess.check_call(args)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning("Unable to generate metadata for repository %s, continuing without it: %s", repo.name, e)
+            return False
+        return True
@@ -0,0 +1,238 @@
+import copy
+import json
+import logging
+import math
+import os
+import os.path
+import re
+import statistics
+import subprocess
+
+from . import assemble
+from . import core
+from . import drivers
+from . import layers
+from . import locks
+from . import profiles
+
+
+logger = logging.getLogger('quern')
+
+
+DURATIONS_FILE = 'package-durations.json'
+
+# Estimates for packages never seen before, in seconds
+DEFAULT_DURATIONS = {'binpkg': 10.0, 'compile': 120.0}
+
+# Weight of the latest build in the per-package moving average
+DURATION_SMOOTHING = 0.5
+
+# "[ebuild  N    ]   sys-libs/zlib-1.2.11::gentoo  USE=..."; --tree indents dependencies
+_PRETEND_RE = re.compile(r'^\[(ebuild|binary)[^\]]*\](\s+)(\S+)')
+
+
+def parse_pretend(output):
+    """Parse `emerge --pretend --tree` output into an ordered {cpv: node} graph.
+
+    Each node lists the packages it depends on, as shown by the tree.
+    """
+    nodes = {}
+    parents = []
+    for line in output.splitlines():
+        match = _PRETEND_RE.match(line)
+        if not match:
+            continue
+        kind, indent, atom = match.groups()
+        cpv = atom.split('::')[0]
+        depth = len(indent) - 1
+
+        # The parent of a package is the closest previous package one level up
+        del parents[depth:]
+        if parents and parents[-1] in nodes:
+            nodes[parents[-1]]['deps'].append(cpv)
+        parents.append(cpv)
+
+        nodes.setdefault(cpv, {
+            'cpv': cpv,
+            'kind': 'binpkg' if kind == 'binary' else 'compile',
+            'deps': [],
+        })
+    return nodes
+
+
+def _durations_path(config):
+    return os.path.join(config.outdir, DURATIONS_FILE)
+
+
+def load_durations(config):
+    try:
+        with open(_durations_path(config), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def record_durations(config, packages):
+    """Update the per-package duration averages with the packages of a timings report."""
+    if not packages:
+        return
+    with locks.exclusive(config.outdir):
+        durations = load_durations(config)
+        for package in packages:
+            cp, _version = layers.split_version(package['package'])
+            kind = 'binpkg' if package['origin'] == 'binpkg' else 'compile'
+            key = '%s:%s' % (cp, kind)
+            previous = durations.get(key)
+            duration = package.get('duration', 0.0)
+            if previous is not None:
+                duration = DURATION_SMOOTHING * duration + (1 - DURATION_SMOOTHING) * previous
+            durations[key] = duration
+
+        tmp_path = '%s.partial' % _durations_path(config)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(durations, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, _durations_path(config))
+
+
+class Planner:
+    """Resolve what a build would merge, and estimate how long it would take.
+
+    The resolution (`emerge --pretend --tree`) is cached in <outdir>/plans,
+    keyed like binpkg plans on the inputs of dependency resolution. Package
+    durations come from the timings of previous builds.
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    @property
+    def path(self):
+        # Builder containers see other paths, hence another key: they get the file name from the host.
+        plan_file = self.config.plan_file or os.path.join('plans', '%s.json' % assemble.plan_key(self.config))
+        return os.path.join(self.config.outdir, plan_file)
+
+    @property
+    def targets(self):
+        targets = list(self.config.baselayout_atoms)
+        if self.config.include_system:
+            targets.append('@system')
+        return targets + ['@profile']
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _pretend(self, targets):
+        output = subprocess.check_output(
+            ['emerge', '--pretend', '--tree', '--color=n'] + targets,
+        ).decode('utf-8', 'replace')
+        return parse_pretend(output)
+
+    def resolve(self):
+        """Set up portage like a build, run the pretend resolution, and store it."""
+        logger.info("Resolving %s for %s", ' '.join(self.targets), self.config.profile)
+        # The plan must see the make.conf, repos.conf and profiles of the build
+        driver = drivers.load('raw', self.config)
+        driver.setup()
+        driver._stage_select_base_profile()
+        if profiles.base_profile(self.config) != self.config.profile:
+            # With a distinct base profile, @profile can only be resolved once selected
+            base_targets = self.targets[:-1]
+            nodes = self._pretend(base_targets) if base_targets else {}
+            driver._stage_select_profile()
+            for cpv, node in self._pretend(['@profile']).items():
+                nodes.setdefault(cpv, node)
+        else:
+            nodes = self._pretend(self.targets)
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = '%s.partial' % self.path
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'profile': self.config.profile, 'nodes': nodes}, f, indent=2)
+        os.replace(tmp_path, self.path)
+        return self.load()
+
+    def _resolve_in_builder(self):
+        """Run the resolution in a builder container, like a build would."""
+        config = copy.copy(self.config)
+        config.plan_file = os.path.relpath(self.path, self.config.outdir)
+        # Keep the reports and logs of actual builds
+        config.report_timings = False
+        config.resources_interval = 0
+        config.forced_image_name = 'plan-%s.tar.%s' % (
+            config.profile_safe, core.COMPRESSION_SUFFIXES[config.image_compression],
+        )
+        driver = drivers.load(self.config.driver, config)
+        driver.setup()
+        driver.build()
+        return self.load()
+
+    def plan(self):
+        cached = self.load()
+        if cached is not None:
+            logger.info("Using cached plan %s", self.path)
+            return cached
+        if self.config.uses_docker:
+            return self._resolve_in_builder()
+        return self.resolve()
+
+    def estimate(self, plan, cpus=None):
+        durations = load_durations(self.config)
+        nodes = plan['nodes']
+
+        known = [value for key, value in durations.items() if key.endswith(':compile')]
+        defaults = dict(DEFAULT_DURATIONS)
+        if known:
+            defaults['compile'] = statistics.median(known)
+
+        def duration(node):
+            cp, _version = layers.split_version(node['cpv'])
+            return durations.get('%s:%s' % (cp, node['kind']), defaults[node['kind']])
+
+        # Longest chain of dependencies ending with each package
+        paths = {}
+
+        def critical(cpv, visiting=()):
+            if cpv not in paths:
+                node = nodes[cpv]
+                chains = [
+                    critical(dep, visiting + (cpv,))
+                    for dep in node['deps']
+                    if dep in nodes and dep not in visiting
+                ]
+                longest = max(chains, key=lambda chain: chain[0], default=(0.0, []))
+                paths[cpv] = (longest[0] + duration(node), longest[1] + [cpv])
+            return paths[cpv]
+
+        for cpv in nodes:
+            critical(cpv)
+
+        total = sum(duration(node) for node in nodes.values())
+        length, path = max(paths.values(), key=lambda chain: chain[0], default=(0.0, []))
+        cpus = cpus or os.cpu_count() or 1
+        jobs = max(1, min(cpus, int(math.ceil(total / length)) if length else 1))
+        return {
+            'packages': len(nodes),
+            'compile': sum(1 for node in nodes.values() if node['kind'] == 'compile'),
+            'binpkg': sum(1 for node in nodes.values() if node['kind'] == 'binpkg'),
+            'total': total,
+            'critical_path': path,
+            'critical_duration': length,
+            'jobs': jobs,
+            'estimated_duration': max(length, total / jobs),
+        }
+
+
+def log_estimate(config, estimate):
+    logger.info(
+        "Plan for %s: %d packages (%d to compile, %d from binpkgs)",
+        config.profile, estimate['packages'], estimate['compile'], estimate['binpkg'],
+    )
+    logger.info("Critical path (%.0fs): %s", estimate['critical_duration'], ' -> '.join(estimate['critical_path']))
+    logger.info(
+        "Total work %.0fs; with emerge.jobs = %d, the build should take about %.0fs",
+        estimate['total'], estimate['jobs'], estimate['estimated_duration'],
+    )
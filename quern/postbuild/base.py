@@ -1,3 +1,63 @@
+import datetime
+
+from ..version import VERSION
+
+
 class BasePostBuilder:
     def __init__(self, config):
         self.config = config
+
+    @property
+    def target_tag(self):
+        if self.config.dockergen_tag == '$$DATE$$':
+            return datetime.date.today().strftime('%Y%m%d')
+        else:
+            return self.config.dockergen_tag
+
+    def image_config(self, diff_ids):
+        """Build an OCI/docker image configuration from the dockergen.* settings."""
+        container_config = {
+            'Labels': {
+                'quern-version': VERSION,
+                'quern-profile': self.config.profile,
+            },
+        }
+        if self.config.dockergen_maintainer:
+            container_config['Labels']['org.opencontainers.image.authors'] = self.config.dockergen_maintainer
+        if self.config.dockergen_entrypoint:
+            container_config['Entrypoint'] = self.config.dockergen_entrypoint
+        if self.config.dockergen_command:
+            container_config['Cmd'] = self.config.dockergen_command
+        if self.config.dockergen_ports:
+            container_config['ExposedPorts'] = {
+                port if '/' in port else '%s/tcp' % port: {}
+                for port in self.config.dockergen_ports
+            }
+        if self.config.dockergen_volumes:
+            container_config['Volumes'] = {volume: {} for volume in self.config.dockergen_volumes}
+        if self.config.dockergen_workdir:
+            container_config['WorkingDir'] = self.config.dockergen_workdir
+        if self.config.dockergen_user:
+            container_config['User'] = self.config.dockergen_user
+
+        now = self.config.now
+        if self.config.archive_mtime is not None:
+            now = datetime.datetime.utcfromtimestamp(self.config.archive_mtime)
+        created = now.replace(microsecond=0).isoformat() + 'Z'
+        image_config = {
+            'created': created,
+            'architecture': self.config.dockergen_architecture,
+            'os': 'linux',
+            'config': container_config,
+            'rootfs': {
+                'type': 'layers',
+                'diff_ids': list(diff_ids),
+            },
+            'history': [
+                {'created': created, 'created_by': 'quern %s (%s)' % (VERSION, self.config.profile)}
+                for _diff_id in diff_ids
+            ],
+        }
+        if self.config.dockergen_maintainer:
+            image_config['author'] = self.config.dockergen_maintainer
+        return image_config
@@ -1,94 +1,116 @@
-import datetime
-import io
+import hashlib
 import json
 import logging
-
-import docker
+import os.path
+import tarfile
+import time
 
 from . import base
-from ..version import VERSION
+from .. import archive
+from ..drivers import docker as docker_driver
 
 
 logger = logging.getLogger('quern')
 
 
-class PostBuilder(base.BasePostBuilder):
-    def __init__(self, config):
-        super().__init__(config)
-        self.raw_image_name = 'quern-%s' % self.config.profile_safe
-        self.raw_image_tag = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
-        self.raw_image_fullname = '%s:%s' % (self.raw_image_name, self.raw_image_tag)
+CHUNK_SIZE = 256 * 1024
 
-        # Generate 
-        if self.config.dockergen_tag == '$$DATE$$':
-            tag = datetime.date.today().strftime('%Y%m%d')
-        else:
-            tag = self.config.dockergen_tag
 
-        if tag:
-            self.target_image_name = '%s:%s' % (self.config.dockergen_name, tag)
-        else:
-            self.target_image_name = self.config.dockergen_name
-
-    def run(self):
-        logger.info("Connecting to docker")
-        client = docker.Client(self.config.docker_address)
-
-        logger.info("Building raw image %s", self.raw_image_fullname)
-        res_raw = client.import_image_from_file(
-            filename=self.config.image_path,
-            repository=self.raw_image_name,
-            tag=self.raw_image_tag,
-        )
-        res = json.loads(res_raw)
-        logger.info("Raw image %s built: %s", self.raw_image_fullname, res['status'].strip())
-
-        logger.info("Building full image %s from raw %s", self.target_image_name, self.raw_image_fullname)
-        dockerfile_lines = '\n'.join(self._dockerfile_template())
-        dockerfile = io.BytesIO(dockerfile_lines.encode('utf-8'))
-        output = client.build(
-            fileobj=dockerfile,
-            rm=True,
-            tag=self.target_image_name,
-            decode=True,
-        )
-        for line in output:
-            if 'stream' in line:
-                logger.info("  build: %s", line['stream'].strip())
-            else:
-                logger.warn("  build: error: %r", line)
+def _tar_header(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = mtime
+    return info.tobuf(format=tarfile.GNU_FORMAT)
 
-        logger.info("Image %s successfully built.", self.target_image_name)
 
-    def _dockerfile_template(self):
-        def line(text, **context):
-            return text.format(**context)
+def _tar_padding(size):
+    return b'\0' * ((tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE)
 
-        yield line("FROM {raw_image}", raw_image=self.raw_image_fullname)
-        yield line("MAINTAINER {maintainer}", maintainer=self.config.dockergen_maintainer)
 
-        if self.config.dockergen_entrypoint:
-            yield line(
-                    "ENTRYPOINT [{entrypoint}]",
-                    entrypoint=", ".join('"%s"' % part for part in self.config.dockergen_entrypoint),
-            )
+class PostBuilder(base.BasePostBuilder):
+    """Load the built image into docker in a single upload.
 
-        if self.config.dockergen_command:
-            yield line("CMD [{cmd}]", cmd=", ".join('"%s"' % part for part in self.config.dockergen_command))
+    The image is streamed as a `docker save`-style archive combining the
+    rootfs layers and the image configuration, so the daemon receives the
+    filesystem once and no intermediate image is left behind.
+    """
 
-        for port in self.config.dockergen_ports:
-            yield line("EXPOSE {port}", port=port)
+    def __init__(self, config):
+        super().__init__(config)
+        self.target_image_name = '%s:%s' % (self.config.dockergen_name, self.target_tag or 'latest')
 
-        for volume in self.config.dockergen_volumes:
-            yield line("VOLUME {volume}", volume=volume)
+    def run(self):
+        client = docker_driver.get_client(self.config.docker_address)
 
-        if self.config.dockergen_workdir:
-            yield line("WORKDIR {workdir}", workdir=self.config.dockergen_workdir)
+        logger.info("Loading image %s", self.target_image_name)
+        client.load_image(self._image_archive())
 
-        if self.config.dockergen_user:
-            yield line("USER {user}", user=self.config.dockergen_user)
+        logger.info("Image %s successfully built.", self.target_image_name)
 
-        yield line(
-            """LABEL quern-version="{version}" quern-profile="{profile}" """,
-            version=VERSION, profile=self.config.profile,
-        )
+    def _layers(self):
+        """List (path, diff_id) for each layer; diff_id is None when unknown."""
+        if self.config.layers_enabled:
+            with open(self.config.layers_manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            return [
+                (os.path.join(self.config.outdir, layer['file']), layer['diff_id'])
+                for layer in manifest['layers']
+            ]
+        return [(self.config.image_path, None)]
+
+    def _stream_layer(self, path, diff_ids=None):
+        """Yield the content of a compressed layer; append its diff_id to diff_ids if given."""
+        if diff_ids is not None:
+            decompressor = archive.Decompressor(self.config.image_compression)
+            sha256 = hashlib.sha256()
+
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                if diff_ids is not None:
+                    sha256.update(decompressor.decompress(data))
+                yield data
+
+        if diff_ids is not None:
+            diff_ids.append('sha256:%s' % sha256.hexdigest())
+
+    def _image_archive(self):
+        """Generate the `docker load` archive, chunk by chunk."""
+        mtime = self.config.archive_mtime
+        if mtime is None:
+            mtime = int(time.time())
+        diff_ids = []
+        layer_names = []
+
+        for index, (path, diff_id) in enumerate(self._layers()):
+            name = 'layer-%02d/layer.tar' % index
+            size = os.path.getsize(path)
+            logger.info("Streaming layer %s (%d bytes)", path, size)
+
+            yield _tar_header(name, size, mtime)
+            if diff_id:
+                diff_ids.append(diff_id)
+                yield from self._stream_layer(path)
+            else:
+                yield from self._stream_layer(path, diff_ids)
+            yield _tar_padding(size)
+            layer_names.append(name)
+
+        image_config = json.dumps(self.image_config(diff_ids), sort_keys=True).encode('utf-8')
+        config_name = '%s.json' % hashlib.sha256(image_config).hexdigest()
+        manifest = json.dumps([{
+            'Config': config_name,
+            'RepoTags': [self.target_image_name],
+            'Layers': layer_names,
+        }]).encode('utf-8')
+
+        for name, content in [(config_name, image_config), ('manifest.json', manifest)]:
+            yield _tar_header(name, len(content), mtime)
+            yield content
+            yield _tar_padding(len(content))
+
+        # End-of-archive marker
+        yield b'\0' * (2 * tarfile.BLOCKSIZE)
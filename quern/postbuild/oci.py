@@ -0,0 +1,144 @@
+import json
+import logging
+import os
+import os.path
+import shutil
+
+from . import base
+from .. import archive
+from .. import cache
+
+
+logger = logging.getLogger('quern')
+
+
+MEDIA_TYPE_INDEX = 'application/vnd.oci.image.index.v1+json'
+MEDIA_TYPE_MANIFEST = 'application/vnd.oci.image.manifest.v1+json'
+MEDIA_TYPE_CONFIG = 'application/vnd.oci.image.config.v1+json'
+
+# Layer compressions supported by the OCI image spec; others are transcoded to gzip
+LAYER_MEDIA_TYPES = {
+    'gzip': 'application/vnd.oci.image.layer.v1.tar+gzip',
+    'zstd': 'application/vnd.oci.image.layer.v1.tar+zstd',
+}
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class PostBuilder(base.BasePostBuilder):
+    """Write the image as an OCI image layout, without any container daemon."""
+
+    @property
+    def layout_path(self):
+        return os.path.join(self.config.outdir, '%s.oci' % self.config.image_basename)
+
+    @property
+    def blobs_path(self):
+        return os.path.join(self.layout_path, 'blobs', 'sha256')
+
+    def _blob_path(self, digest):
+        algorithm, hexdigest = digest.split(':', 1)
+        assert algorithm == 'sha256'
+        return os.path.join(self.blobs_path, hexdigest)
+
+    def run(self):
+        logger.info("Writing OCI image layout at %s", self.layout_path)
+        if os.path.exists(self.layout_path):
+            shutil.rmtree(self.layout_path)
+        os.makedirs(self.blobs_path)
+
+        layers = [self._add_layer(path) for path in self._layer_files()]
+
+        image_config = self.image_config([info.diff_id for _media_type, info in layers])
+        config_descriptor = self._add_json_blob(image_config, MEDIA_TYPE_CONFIG)
+        manifest = {
+            'schemaVersion': 2,
+            'mediaType': MEDIA_TYPE_MANIFEST,
+            'config': config_descriptor,
+            'layers': [
+                {'mediaType': media_type, 'digest': info.digest, 'size': info.size}
+                for media_type, info in layers
+            ],
+        }
+        manifest_descriptor = self._add_json_blob(manifest, MEDIA_TYPE_MANIFEST)
+
+        ref_name = self._ref_name()
+        if ref_name:
+            manifest_descriptor['annotations'] = {'org.opencontainers.image.ref.name': ref_name}
+
+        self._write_json(os.path.join(self.layout_path, 'oci-layout'), {'imageLayoutVersion': '1.0.0'})
+        self._write_json(os.path.join(self.layout_path, 'index.json'), {
+            'schemaVersion': 2,
+            'mediaType': MEDIA_TYPE_INDEX,
+            'manifests': [manifest_descriptor],
+        })
+
+        logger.info("OCI image %s written: %s", ref_name or self.layout_path, manifest_descriptor['digest'])
+
+    def _layer_files(self):
+        if self.config.layers_enabled:
+            with open(self.config.layers_manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            return [os.path.join(self.config.outdir, layer['file']) for layer in manifest['layers']]
+        return [self.config.image_path]
+
+    def _add_layer(self, path):
+        """Add a layer blob; returns (media_type, ArchiveInfo)."""
+        algorithm = self.config.image_compression
+        tmp_path = os.path.join(self.blobs_path, '%s.partial' % os.path.basename(path))
+
+        with open(path, 'rb') as f:
+            compressed = archive.DigestReader(f)
+            uncompressed = archive.DigestReader(archive.open_decompressor(compressed, algorithm))
+
+            if algorithm in LAYER_MEDIA_TYPES:
+                # Only compute digests; the archive itself is linked as the blob.
+                while uncompressed.read(CHUNK_SIZE):
+                    pass
+                compressed.drain()
+                cache.link_or_copy(path, tmp_path)
+                info = archive.ArchiveInfo(
+                    path=path, digest=compressed.digest, size=compressed.size, diff_id=uncompressed.digest,
+                )
+                media_type = LAYER_MEDIA_TYPES[algorithm]
+
+            else:
+                logger.info("Transcoding %s layer %s to gzip", algorithm, path)
+                with open(tmp_path, 'wb') as out:
+                    transcoded = archive.DigestWriter(out)
+                    compressor = archive.make_compressor(
+                        transcoded, 'gzip',
+                        threads=self.config.image_compression_threads,
+                    )
+                    with compressor:
+                        while True:
+                            data = uncompressed.read(CHUNK_SIZE)
+                            if not data:
+                                break
+                            compressor.write(data)
+                info = archive.ArchiveInfo(
+                    path=path, digest=transcoded.digest, size=transcoded.size, diff_id=uncompressed.digest,
+                )
+                media_type = LAYER_MEDIA_TYPES['gzip']
+
+        os.replace(tmp_path, self._blob_path(info.digest))
+        logger.info("Layer %s added as %s", os.path.basename(path), info.digest)
+        return media_type, info
+
+    def _add_json_blob(self, content, media_type):
+        writer_path = os.path.join(self.blobs_path, 'blob.partial')
+        with open(writer_path, 'wb') as f:
+            writer = archive.DigestWriter(f)
+            writer.write(json.dumps(content, sort_keys=True).encode('utf-8'))
+        os.replace(writer_path, self._blob_path(writer.digest))
+        return {'mediaType': media_type, 'digest': writer.digest, 'size': writer.size}
+
+    def _write_json(self, path, content):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(content, f, sort_keys=True)
+
+    def _ref_name(self):
+        tag = self.target_tag
+        if self.config.dockergen_name and tag:
+            return '%s:%s' % (self.config.dockergen_name, tag)
+        return self.config.dockergen_name or tag
@@ -0,0 +1,92 @@
+import os.path
+
+from . import core
+
+
+def resolve(config, profile):
+    """Find the folder of a profile, given as repo:path or relative to the main repository."""
+    if ':' in profile:
+        repo_name, path = profile.split(':', 1)
+    else:
+        repo_name, path = config.repositories[0].name, profile
+
+    for repo in config.repositories:
+        if repo.name == repo_name:
+            return os.path.normpath(os.path.join(repo.location, 'profiles', path))
+
+    raise core.ImproperlyConfigured("Unknown repository %s for profile %s" % (repo_name, profile))
+
+
+def _read_parents(config, folder):
+    parent_file = os.path.join(folder, 'parent')
+    if not os.path.isfile(parent_file):
+        return []
+
+    parents = []
+    with open(parent_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            if ':' in line:
+                parents.append(resolve(config, line))
+            else:
+                parents.append(os.path.normpath(os.path.join(folder, line)))
+    return parents
+
+
+def chain(config, profile):
+    """List the folders making up a profile, parents first."""
+    folders = []
+
+    def visit(folder):
+        for parent in _read_parents(config, folder):
+            visit(parent)
+        if folder not in folders:
+            folders.append(folder)
+
+    visit(resolve(config, profile))
+    return folders
+
+
+def parents(config, profile):
+    """List the folders of a profile's ancestors, excluding the profile itself."""
+    return chain(config, profile)[:-1]
+
+
+def profile_name(config, folder):
+    """Name of a profile folder, as accepted by `eselect profile set`; None outside the repositories."""
+    for index, repo in enumerate(config.repositories):
+        profiles_dir = os.path.join(os.path.normpath(repo.location), 'profiles')
+        if folder.startswith(profiles_dir + os.sep):
+            path = os.path.relpath(folder, profiles_dir)
+            return path if index == 0 else '%s:%s' % (repo.name, path)
+    return None
+
+
+def base_profile(config):
+    """Profile the base root is built with.
+
+    Defaults to build.profile; with cache.roots, to the profile's parent when
+    it has a single one, so that sibling profiles share their base root.
+    """
+    if config.base_profile:
+        return config.base_profile
+    if config.roots_cache_dir:
+        folders = _read_parents(config, resolve(config, config.profile))
+        if len(folders) == 1 and profile_name(config, folders[0]) is not None:
+            return profile_name(config, folders[0])
+    return config.profile
+
+
+def content_hash(folders, digest):
+    """Feed the content of the files in the given profile folders to a hashlib digest."""
+    for folder in folders:
+        digest.update(('%s\n' % folder).encode('utf-8'))
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            if os.path.isfile(path):
+                digest.update(('%s\n' % name).encode('utf-8'))
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+    return digest
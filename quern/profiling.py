@@ -0,0 +1,154 @@
+import collections
+import contextlib
+import json
+import logging
+import os
+import os.path
+import re
+import time
+
+
+logger = logging.getLogger('quern')
+
+
+_ANSI_RE = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+_EMERGE_RE = re.compile(r'^>>> (Emerging binary|Emerging|Installing|Completed) \((\d+) of (\d+)\) (\S+)')
+# Stage announcements from the raw driver, as relayed in builder container logs
+_STAGE_RE = re.compile(r'>>> INFO: Stage (\w+)')
+
+
+def parse_stage(text):
+    """Return the last build stage announced in a chunk of builder logs, if any."""
+    stages = _STAGE_RE.findall(text)
+    return stages[-1] if stages else None
+
+
+class EmergeLogParser:
+    """Extract per-package timings from emerge's output."""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.packages = collections.OrderedDict()
+
+    def feed(self, line, timestamp=None):
+        match = _EMERGE_RE.match(_ANSI_RE.sub('', line).strip())
+        if not match:
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        event, _index, _total, atom = match.groups()
+        cpv, _sep, repository = atom.partition('::')
+
+        if event.startswith('Emerging'):
+            # Without --jobs, emerge doesn't report completions: a package is
+            # done once the next one starts (a later "Completed" line wins).
+            for package in self.packages.values():
+                if package['installing'] is not None and package['completed'] is None:
+                    package['completed'] = timestamp
+
+            self.packages[cpv] = {
+                'package': cpv,
+                'repository': repository,
+                'origin': 'binpkg' if event == 'Emerging binary' else 'source',
+                'stage': self.stage,
+                'started': timestamp,
+                'installing': None,
+                'completed': None,
+            }
+        elif cpv in self.packages:
+            self.packages[cpv]['installing' if event == 'Installing' else 'completed'] = timestamp
+
+    def close(self, timestamp=None):
+        """Close timings of packages whose completion was not reported."""
+        timestamp = time.time() if timestamp is None else timestamp
+        for package in self.packages.values():
+            if package['completed'] is None:
+                package['completed'] = timestamp
+            package['duration'] = package['completed'] - package['started']
+            if package['installing'] is not None:
+                package['build_duration'] = package['installing'] - package['started']
+                package['install_duration'] = package['completed'] - package['installing']
+
+
+class BuildReport:
+    """Wall-time measurements of a build, written next to the image as JSON."""
+
+    def __init__(self, config):
+        self.config = config
+        self.data = {
+            'profile': config.profile,
+            'image': config.image_name,
+            'started': time.time(),
+            'stages': [],
+            'container': [],
+            'packages': [],
+        }
+
+    @property
+    def path(self):
+        return os.path.join(self.config.outdir, '%s.timings.json' % self.config.image_basename)
+
+    @classmethod
+    def load(cls, config):
+        """Load the report written by an earlier step (e.g inside the builder container)."""
+        report = cls(config)
+        if os.path.isfile(report.path):
+            with open(report.path, 'r', encoding='utf-8') as f:
+                report.data = json.load(f)
+        return report
+
+    @contextlib.contextmanager
+    def measure(self, name, section='stages'):
+        entry = {'name': name, 'started': time.time(), 'duration': None}
+        self.data[section].append(entry)
+        start = time.monotonic()
+        try:
+            yield entry
+        finally:
+            entry['duration'] = time.monotonic() - start
+
+    def skipped(self, name):
+        self.data['stages'].append({'name': name, 'started': time.time(), 'duration': 0.0, 'skipped': True})
+
+    def add_packages(self, parser):
+        parser.close()
+        self.data['packages'].extend(parser.packages.values())
+
+    def write(self):
+        if not self.config.report_timings:
+            return
+        self.data['duration'] = time.time() - self.data['started']
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, indent=2)
+        logger.info("Timing report written to %s", self.path)
+
+    def write_prometheus(self, folder):
+        """Write the report in the node_exporter textfile collector format."""
+        profile = self.config.profile.replace('\\', '\\\\').replace('"', '\\"')
+        lines = [
+            '# HELP quern_build_duration_seconds Wall time of the whole build.',
+            '# TYPE quern_build_duration_seconds gauge',
+            'quern_build_duration_seconds{profile="%s"} %f' % (profile, self.data.get('duration', 0.0)),
+            '# HELP quern_build_stage_seconds Wall time of each build stage.',
+            '# TYPE quern_build_stage_seconds gauge',
+        ]
+        for section in ('stages', 'container'):
+            for stage in self.data[section]:
+                lines.append('quern_build_stage_seconds{profile="%s",section="%s",stage="%s"} %f' % (
+                    profile, section, stage['name'], stage['duration'] or 0.0,
+                ))
+        lines += [
+            '# HELP quern_build_package_seconds Wall time of each emerged package.',
+            '# TYPE quern_build_package_seconds gauge',
+        ]
+        for package in self.data['packages']:
+            lines.append('quern_build_package_seconds{profile="%s",package="%s",origin="%s"} %f' % (
+                profile, package['package'], package['origin'], package.get('duration', 0.0),
+            ))
+
+        path = os.path.join(folder, 'quern_%s.prom' % self.config.profile_safe)
+        # node_exporter may read the file at any time: write atomically.
+        tmp_path = '%s.partial' % path
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+        logger.info("Prometheus metrics written to %s", path)
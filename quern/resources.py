@@ -0,0 +1,184 @@
+import collections
+import contextvars
+import json
+import logging
+import math
+import os.path
+import threading
+import time
+
+from . import profiling
+
+
+logger = logging.getLogger('quern')
+
+
+# Safety margin applied to observed peaks
+HEADROOM = 1.25
+MIN_TMPFS_MB = 64
+
+MB = 1024 * 1024
+
+
+def _blkio_bytes(stats, op):
+    entries = (stats.get('blkio_stats') or {}).get('io_service_bytes_recursive') or []
+    return sum(entry['value'] for entry in entries if entry.get('op', '').lower() == op)
+
+
+class ResourceSampler:
+    """Sample a container's resource usage from the docker stats API.
+
+    Samples are attributed to the build stage announced by the latest log
+    line seen by `feed_log`.
+    """
+
+    def __init__(self, client, container_id, interval):
+        self.client = client
+        self.container_id = container_id
+        self.interval = interval
+        self.stage = 'setup'
+        self.samples = []
+        self.memory_limit = 0
+        self.online_cpus = 0
+        self._stopped = threading.Event()
+        # Keep context variables, e.g the job of a quern-server worker
+        self._thread = threading.Thread(
+            target=contextvars.copy_context().run, args=(self._run,), name='stats-%s' % container_id[:12], daemon=True,
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join(timeout=2 * self.interval)
+
+    def feed_log(self, text):
+        self.stage = profiling.parse_stage(text) or self.stage
+
+    def _run(self):
+        last = 0
+        previous = None
+        try:
+            for stats in self.client.stats(container=self.container_id, decode=True):
+                if self._stopped.is_set():
+                    break
+                now = time.time()
+                if now - last < self.interval:
+                    continue
+                last = now
+                self._record(now, stats, previous)
+                previous = stats
+        except Exception:
+            # Sampling must never break a build
+            logger.warning("Resource sampling stopped", exc_info=True)
+
+    def _record(self, timestamp, stats, previous):
+        cpu_stats = stats.get('cpu_stats') or {}
+        memory_stats = stats.get('memory_stats') or {}
+        memory_details = memory_stats.get('stats') or {}
+
+        self.online_cpus = cpu_stats.get('online_cpus') or len(
+            (cpu_stats.get('cpu_usage') or {}).get('percpu_usage') or []) or self.online_cpus
+        self.memory_limit = memory_stats.get('limit') or self.memory_limit
+
+        cpu = 0.0
+        if previous is not None:
+            previous_cpu = previous.get('cpu_stats') or {}
+            cpu_delta = cpu_stats['cpu_usage']['total_usage'] - previous_cpu['cpu_usage']['total_usage']
+            system_delta = cpu_stats.get('system_cpu_usage', 0) - previous_cpu.get('system_cpu_usage', 0)
+            if system_delta > 0:
+                cpu = cpu_delta / system_delta * (self.online_cpus or 1)
+
+        # tmpfs pages are accounted as shared memory by the container's cgroup
+        tmpfs = memory_details.get('shmem', 0)
+        self.samples.append({
+            'time': timestamp,
+            'stage': self.stage,
+            'cpu': cpu,
+            'rss': memory_details.get('rss', memory_details.get('anon', memory_stats.get('usage', 0))),
+            'tmpfs': tmpfs,
+            'read_bytes': _blkio_bytes(stats, 'read'),
+            'write_bytes': _blkio_bytes(stats, 'write'),
+        })
+
+    def peaks(self):
+        peaks = collections.OrderedDict()
+        for sample in self.samples:
+            peak = peaks.setdefault(sample['stage'], {'cpu': 0.0, 'rss': 0, 'tmpfs': 0})
+            for key in peak:
+                peak[key] = max(peak[key], sample[key])
+        return peaks
+
+
+def recommend(config, sampler):
+    """Suggest tmpfs size and emerge jobs from observed peaks."""
+    if not sampler.samples:
+        return {}
+
+    peak_tmpfs = max(sample['tmpfs'] for sample in sampler.samples)
+    peak_rss = max(sample['rss'] for sample in sampler.samples)
+    tmpfs_mb = max(MIN_TMPFS_MB, int(math.ceil(peak_tmpfs * HEADROOM / MB)))
+
+    jobs = sampler.online_cpus or 1
+    current_jobs = config.emerge_jobs or 1
+    if sampler.memory_limit and peak_rss:
+        per_job = peak_rss / current_jobs * HEADROOM
+        available = sampler.memory_limit - tmpfs_mb * MB
+        jobs = min(jobs, int(available // per_job))
+
+    return {
+        'tmpfs': '%dM' % tmpfs_mb,
+        'jobs': max(1, jobs),
+    }
+
+
+def _recommendations_path(config):
+    return os.path.join(config.outdir, 'resources-%s.json' % config.profile_safe)
+
+
+def write_report(config, sampler, success):
+    """Write the resource usage of a build; only successful builds update the recommendations."""
+    recommendation = recommend(config, sampler)
+    report = {
+        'profile': config.profile,
+        'success': success,
+        'interval': sampler.interval,
+        'online_cpus': sampler.online_cpus,
+        'memory_limit': sampler.memory_limit,
+        'peaks': sampler.peaks(),
+        'recommendation': recommendation,
+        'samples': sampler.samples,
+    }
+    path = os.path.join(config.outdir, '%s.resources.json' % config.image_basename)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    logger.info("Resource usage written to %s", path)
+
+    if not success:
+        # Failed or OOM-killed runs stopped early, or at the limits they would set
+        logger.info("Build of %s failed, not updating its recommended settings", config.profile)
+    elif recommendation:
+        logger.info(
+            "Recommended settings for %s: docker.workdir_storage = tmpfs:%s, emerge.jobs = %d",
+            config.profile, recommendation['tmpfs'], recommendation['jobs'],
+        )
+        with open(_recommendations_path(config), 'w', encoding='utf-8') as f:
+            json.dump(recommendation, f, indent=2)
+
+
+def apply_recommendations(config):
+    """Override tmpfs size and emerge jobs with those recommended by the previous run."""
+    try:
+        with open(_recommendations_path(config), 'r', encoding='utf-8') as f:
+            recommendation = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return
+
+    if config.docker_workdir_storage.startswith('tmpfs:'):
+        config.docker_workdir_storage = 'tmpfs:%s' % recommendation['tmpfs']
+    config.emerge_jobs = recommendation['jobs']
+    logger.info(
+        "Applying recommended resources: docker.workdir_storage = %s, emerge.jobs = %d",
+        config.docker_workdir_storage, config.emerge_jobs,
+    )
@@ -0,0 +1,66 @@
+import contextlib
+import logging
+
+from . import binpkgs
+from . import cache
+from . import delta
+from . import drivers
+from . import governor
+from . import locks
+from . import planner
+from . import postbuild
+from . import profiling
+from . import resources
+
+
+logger = logging.getLogger('quern')
+
+
+STATUS_BUILT = 'built'
+STATUS_CACHED = 'cached'
+STATUS_FAILED = 'failed'
+
+
+def build(config):
+    """Build the image for a checked configuration, then run its postbuild engines.
+
+    Returns STATUS_BUILT or STATUS_CACHED.
+    """
+    if config.resources_apply:
+        resources.apply_recommendations(config)
+
+    build_cache = cache.BuildCache(config)
+    status = STATUS_CACHED
+
+    if build_cache.restore():
+        if config.delta:
+            delta.DeltaWriter(config).write_from_archive(config.image_path)
+    else:
+        driver = drivers.load(config.driver, config)
+
+        with contextlib.ExitStack() as stack:
+            # Shared folders may be used by concurrent builds, but not by maintenance tasks
+            for folder in (config.binpkg_dir, config.distfiles_dir):
+                if folder:
+                    stack.enter_context(locks.shared(folder))
+            stack.enter_context(governor.Governor(config).slot())
+
+            driver.setup()
+            driver.build()
+
+        build_cache.store()
+        status = STATUS_BUILT
+
+        report = profiling.BuildReport.load(config)
+        if config.report_timings and config.report_prometheus_dir:
+            report.write_prometheus(config.report_prometheus_dir)
+        planner.record_durations(config, report.data['packages'])
+
+        if config.binpkg_dir:
+            binpkgs.BinpkgStore(config).prune()
+
+    for engine_name in config.postbuild_engines:
+        engine = postbuild.load(engine_name, config)
+        engine.run()
+
+    return status
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+import collections
+import contextvars
+import itertools
+import json
+import logging
+import os
+import os.path
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+from . import builder_cli
+from . import core
+from . import runner
+
+
+logger = logging.getLogger('quern')
+
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_CANCELLED = 'cancelled'
+
+# Log lines kept in memory for each job
+JOB_LOG_LINES = 1000
+# Finished jobs kept for status requests
+JOB_HISTORY = 500
+
+# Job run by the current worker; also set in threads started by its build (see docker_async)
+current_job = contextvars.ContextVar('quern_job', default=None)
+
+
+def load_config(config_files, overrides):
+    """Load a build configuration; overrides map section.key options to values."""
+    sections = collections.defaultdict(dict)
+    for key, value in overrides.items():
+        section, _sep, name = key.rpartition('.')
+        if not section:
+            raise core.ImproperlyConfigured("Invalid override %s, expected section.key" % key)
+        sections[section][name] = value
+
+    # Later files take precedence
+    with tempfile.NamedTemporaryFile('w', suffix='.conf', encoding='utf-8') as f:
+        for section, options in sections.items():
+            f.write('[%s]\n' % section)
+            for name, value in options.items():
+                f.write('%s = %s\n' % (name, value))
+        f.flush()
+        _getter, config = builder_cli.load_config(list(config_files) + [f.name])
+    return config
+
+
+class Job:
+    def __init__(self, job_id, config, priority):
+        self.id = job_id
+        self.config = config
+        self.priority = priority
+        self.status = STATUS_QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.logs = collections.deque(maxlen=JOB_LOG_LINES)
+        # Number of lines dropped from logs
+        self.logs_offset = 0
+
+    def as_dict(self):
+        return {
+            'job': self.id,
+            'profile': self.config.profile,
+            'priority': self.priority,
+            'status': self.status,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'image': self.config.image_path,
+            'error': self.error,
+        }
+
+
+class _JobLogHandler(logging.Handler):
+    """Copy log records emitted while running a job to the logs of that job."""
+
+    def emit(self, record):
+        job = current_job.get()
+        if job is not None:
+            if len(job.logs) == job.logs.maxlen:
+                job.logs_offset += 1
+            job.logs.append(self.format(record))
+
+
+class Server:
+    """Run build jobs submitted over a Unix socket.
+
+    Requests and responses are JSON objects, one per line. Jobs are queued
+    by priority (highest first), then submission order, and run by
+    server.jobs worker threads; the process, its docker client and its
+    configuration stay loaded between jobs.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.queue = queue.PriorityQueue()
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self._stopping = False
+
+    def submit(self, config_files, overrides=None, priority=0):
+        config = load_config(config_files, overrides or {})
+        config.check()
+        if config.matrix_profiles:
+            raise core.ImproperlyConfigured("Matrix builds can't be submitted; submit one job per profile")
+        if config.driver == 'raw' and self.config.server_jobs > 1:
+            raise core.ImproperlyConfigured("The raw driver can't run concurrent builds; use server.jobs = 1")
+
+        with self.lock:
+            if self._stopping:
+                raise core.QuernError("Server is shutting down")
+            job = Job(next(self._counter), config, priority)
+            self.jobs[job.id] = job
+            self._prune()
+        self.queue.put((-priority, job.id, job))
+        logger.info("Queued job %d: %s (priority %d)", job.id, config.profile, priority)
+        return job
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished is not None]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY)]:
+            del self.jobs[job_id]
+
+    def cancel(self, job):
+        with self.lock:
+            if job.status != STATUS_QUEUED:
+                raise core.QuernError("Job %d is %s and can't be cancelled" % (job.id, job.status))
+            job.status = STATUS_CANCELLED
+            job.finished = time.time()
+
+    def _work(self):
+        while True:
+            _priority, _job_id, job = self.queue.get()
+            if job is None:
+                return
+            with self.lock:
+                if job.status != STATUS_QUEUED:
+                    continue
+                job.status = STATUS_RUNNING
+                job.started = time.time()
+            self._run(job)
+
+    def _run(self, job):
+        token = current_job.set(job)
+        logger.info("Starting job %d: %s", job.id, job.config.profile)
+        try:
+            job.status = runner.build(job.config)
+        except Exception as e:
+            logger.exception("Job %d failed", job.id)
+            job.status = runner.STATUS_FAILED
+            job.error = str(e)
+        finally:
+            job.finished = time.time()
+            current_job.reset(token)
+        logger.info("Job %d %s in %.1fs", job.id, job.status, job.finished - job.started)
+
+    def _get_job(self, request):
+        try:
+            return self.jobs[int(request['job'])]
+        except (KeyError, TypeError, ValueError):
+            raise core.QuernError("Unknown job %s" % request.get('job'))
+
+    def handle(self, request):
+        command = request.get('command')
+        if command == 'submit':
+            job = self.submit(
+                [os.path.abspath(path) for path in request.get('config', [])],
+                overrides=request.get('overrides'),
+                priority=int(request.get('priority', 0)),
+            )
+            return job.as_dict()
+        elif command == 'status':
+            if 'job' in request:
+                return self._get_job(request).as_dict()
+            return {'jobs': [job.as_dict() for job in list(self.jobs.values())]}
+        elif command == 'logs':
+            job = self._get_job(request)
+            lines = list(job.logs)
+            offset = job.logs_offset
+            start = max(0, int(request.get('offset', 0)) - offset)
+            return {'job': job.id, 'status': job.status, 'offset': offset + len(lines), 'lines': lines[start:]}
+        elif command == 'cancel':
+            job = self._get_job(request)
+            self.cancel(job)
+            return job.as_dict()
+        else:
+            raise core.QuernError("Unknown command %s" % command)
+
+    def serve(self):
+        path = self.config.server_socket
+        if os.path.exists(path):
+            os.unlink(path)
+
+        server = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = {'ok': True, 'result': server.handle(json.loads(line.decode('utf-8')))}
+                    except (core.QuernError, ValueError) as e:
+                        response = {'ok': False, 'error': str(e)}
+                    except Exception as e:
+                        logger.exception("Unable to handle request %r", line)
+                        response = {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+                    self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+        unix_server = socketserver.ThreadingUnixStreamServer(path, RequestHandler)
+        unix_server.daemon_threads = True
+        os.chmod(path, 0o660)
+
+        handler = _JobLogHandler()
+        handler.setFormatter(logging.Formatter('>>> %(levelname)s: %(message)s'))
+        logger.addHandler(handler)
+
+        workers = [
+            threading.Thread(target=self._work, name='worker-%d' % index)
+            for index in range(self.config.server_jobs)
+        ]
+        for worker in workers:
+            worker.start()
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=unix_server.shutdown).start())
+        logger.info("Listening on %s with %d workers", path, len(workers))
+        try:
+            unix_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            unix_server.server_close()
+            os.unlink(path)
+
+        # Let running jobs complete; drop queued ones
+        logger.info("Shutting down, waiting for running jobs")
+        with self.lock:
+            self._stopping = True
+            for job in self.jobs.values():
+                if job.status == STATUS_QUEUED:
+                    job.status = STATUS_CANCELLED
+        for _worker in workers:
+            self.queue.put((float('inf'), 0, None))
+        for worker in workers:
+            worker.join()
+        logger.removeHandler(handler)
+
+
+def request(path, payload):
+    """Send a request to a quern-server; returns its result."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(payload).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            response = json.loads(f.readline().decode('utf-8'))
+    if not response['ok']:
+        raise core.QuernError(response['error'])
+    return response['result']
+
+
+USAGE = """Usage: {prog} path/to/server.conf ...
+       {prog} submit [--priority=N] path/to/build.conf ... [section.key=value ...]
+       {prog} status [JOB]
+       {prog} logs JOB
+       {prog} cancel JOB
+
+Clients read server.socket from the QUERN_SERVER_SOCKET environment variable."""
+
+
+def client_main(command, args):
+    _getter, config = builder_cli.load_config([])
+    path = config.server_socket
+
+    if command == 'submit':
+        priority = 0
+        config_files = []
+        overrides = {}
+        for arg in args:
+            if arg.startswith('--priority='):
+                priority = int(arg.split('=', 1)[1])
+            elif '=' in arg:
+                key, value = arg.split('=', 1)
+                overrides[key] = value
+            else:
+                config_files.append(os.path.abspath(arg))
+        result = request(path, {
+            'command': 'submit', 'config': config_files, 'overrides': overrides, 'priority': priority,
+        })
+    elif command == 'logs':
+        result = request(path, {'command': 'logs', 'job': args[0]})
+        print('\n'.join(result['lines']))
+        return
+    elif args:
+        result = request(path, {'command': command, 'job': args[0]})
+    else:
+        result = request(path, {'command': command})
+
+    print(json.dumps(result, indent=2))
+
+
+def main(argv=sys.argv):
+    args = argv[1:]
+    if not args or args[0] in ('-h', '--help'):
+        print(USAGE.format(prog=argv[0]))
+        return
+
+    if args[0] in ('submit', 'status', 'logs', 'cancel'):
+        try:
+            client_main(args[0], args[1:])
+        except (core.QuernError, OSError) as e:
+            print("Error: %s" % e, file=sys.stderr)
+            return 1
+        return
+
+    core.setup_logging(concurrent=True)
+    _getter, config = builder_cli.load_config(args)
+    Server(config).serve()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
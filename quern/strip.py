@@ -0,0 +1,194 @@
+import collections
+import concurrent.futures
+import logging
+import os
+import os.path
+import re
+import shutil
+import stat
+import subprocess
+
+
+logger = logging.getLogger('quern')
+
+
+ELF_MAGIC = b'\x7fELF'
+ELF_RULE = 'elf:debug'
+
+MB = 1024 * 1024
+
+
+def compile_pattern(pattern):
+    """Compile a glob pattern on paths relative to the image root.
+
+    `*` and `?` don't match `/`, `**` matches any number of folders; patterns
+    without a `/` match at any depth, like in .gitignore.
+    """
+    pattern = pattern.strip().strip('/')
+    if '/' not in pattern:
+        pattern = '**/' + pattern
+
+    regex = []
+    parts = pattern.split('/')
+    for index, part in enumerate(parts):
+        last = index == len(parts) - 1
+        if part == '**':
+            regex.append('.*' if last else '(?:.*/)?')
+            continue
+        for char in part:
+            if char == '*':
+                regex.append('[^/]*')
+            elif char == '?':
+                regex.append('[^/]')
+            else:
+                regex.append(re.escape(char))
+        if not last:
+            regex.append('/')
+    return re.compile(''.join(regex) + r'\Z')
+
+
+class Stripper:
+    """Remove unwanted files from an image root, and strip debug symbols from its ELF files.
+
+    The root is walked once; paths matching a strip.paths folder or a
+    strip.patterns glob are removed (with everything below), unless they
+    match a strip.exclude glob. Removals and `strip --strip-debug` runs go to
+    strip.jobs worker threads; hard links are stripped once.
+    """
+
+    def __init__(self, config, root):
+        self.config = config
+        self.root = root
+        self.rules = [
+            ('/%s' % path.strip('/'), re.compile(re.escape(path.strip('/')) + r'\Z'))
+            for path in config.strip_folders
+        ]
+        self.rules += [(pattern, compile_pattern(pattern)) for pattern in config.strip_patterns]
+        self.excludes = [compile_pattern(pattern) for pattern in config.strip_exclude]
+
+    def _rule(self, relpath):
+        if any(exclude.match(relpath) for exclude in self.excludes):
+            return None
+        for name, regex in self.rules:
+            if regex.match(relpath):
+                return name
+        return None
+
+    def _remove(self, path):
+        """Remove a file or tree; returns (files, bytes) removed."""
+        st = os.lstat(path)
+        if not stat.S_ISDIR(st.st_mode):
+            os.unlink(path)
+            return 1, st.st_size
+
+        files = size = 0
+        for dirpath, _dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                files += 1
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+        shutil.rmtree(path)
+        return files, size
+
+    def _strip_elf(self, paths):
+        """Strip debug symbols from an ELF file and its hard links; returns (files, bytes) saved."""
+        path = paths[0]
+        try:
+            with open(path, 'rb') as f:
+                if f.read(4) != ELF_MAGIC:
+                    return 0, 0
+        except OSError:
+            return 0, 0
+
+        # Image roots may share hard links with cached base roots: never strip in place
+        st = os.lstat(path)
+        tmp_path = '%s.quern-strip' % path
+        result = subprocess.run(
+            ['strip', '--strip-debug', '--preserve-dates', '-o', tmp_path, path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+        if result.returncode:
+            logger.debug("Unable to strip %s: %s", path, result.stderr.decode('utf-8', 'replace').strip())
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return 0, 0
+
+        saved = st.st_size - os.lstat(tmp_path).st_size
+        if saved <= 0:
+            os.unlink(tmp_path)
+            return 0, 0
+        os.chown(tmp_path, st.st_uid, st.st_gid)
+        os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+        # Other links of the file within the image share the stripped copy
+        for link in paths[1:]:
+            link_tmp_path = '%s.quern-strip' % link
+            os.link(tmp_path, link_tmp_path)
+            os.replace(link_tmp_path, link)
+        os.replace(tmp_path, path)
+        return len(paths), saved
+
+    def _walk(self, strip_elf):
+        """Yield (rule, path) for the paths to remove, then (ELF_RULE, paths) for each file to strip.
+
+        ELF files are grouped by inode, to strip hard links once and keep them linked.
+        """
+        elf_files = collections.OrderedDict()
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            reldir = os.path.relpath(dirpath, self.root)
+            kept = []
+            for name in dirnames:
+                relpath = os.path.normpath(os.path.join(reldir, name))
+                rule = self._rule(relpath)
+                if rule is not None:
+                    yield rule, os.path.join(dirpath, name)
+                elif not os.path.islink(os.path.join(dirpath, name)):
+                    kept.append(name)
+                else:
+                    # Symlinks to folders are listed in dirnames, but never walked
+                    filenames.append(name)
+            dirnames[:] = kept
+
+            for name in filenames:
+                relpath = os.path.normpath(os.path.join(reldir, name))
+                path = os.path.join(dirpath, name)
+                rule = self._rule(relpath)
+                if rule is not None:
+                    yield rule, path
+                elif strip_elf:
+                    st = os.lstat(path)
+                    # Executables and shared libraries; the magic number is checked by the workers
+                    if stat.S_ISREG(st.st_mode) and (st.st_mode & 0o111 or '.so' in name):
+                        elf_files.setdefault((st.st_dev, st.st_ino), []).append(path)
+
+        for paths in elf_files.values():
+            yield ELF_RULE, paths
+
+    def run(self):
+        """Strip the image root; returns {rule: {'files': N, 'bytes': N}}."""
+        strip_elf = self.config.strip_elf
+        if strip_elf and shutil.which('strip') is None:
+            logger.warning("strip.elf is set, but strip (binutils) is not installed")
+            strip_elf = False
+        if not (self.rules or strip_elf):
+            return {}
+
+        saved = collections.OrderedDict(
+            (name, {'files': 0, 'bytes': 0}) for name, _regex in self.rules
+        )
+        if strip_elf:
+            saved[ELF_RULE] = {'files': 0, 'bytes': 0}
+
+        jobs = self.config.strip_jobs or os.cpu_count() or 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                (rule, executor.submit(self._strip_elf if rule == ELF_RULE else self._remove, path))
+                for rule, path in self._walk(strip_elf)
+            ]
+            for rule, future in futures:
+                files, size = future.result()
+                saved[rule]['files'] += files
+                saved[rule]['bytes'] += size
+
+        for rule, stats in saved.items():
+            logger.info("Stripped %s: %d files, %.1f MB", rule, stats['files'], stats['bytes'] / MB)
+        logger.info("Stripped %.1f MB from %s", sum(stats['bytes'] for stats in saved.values()) / MB, self.root)
+        return saved
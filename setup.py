@@ -41,6 +41,8 @@ setup(
     entry_points={
         'console_scripts': [
             'quern-builder=quern.builder_cli:main',
+            'quern-server=quern.server:main',
+            'quern-delta=quern.delta:main',
         ],
     },
     install_requires=[
@@ -53,6 +55,9 @@ setup(
         'docker': [
             'docker-py>=1.6,<2',
         ],
+        'zstd': [
+            'zstandard',
+        ],
     },
     zip_safe=False,
     classifiers=[
@@ -0,0 +1,49 @@
+import os
+import os.path
+import shutil
+import tempfile
+import types
+import unittest
+
+from quern import closure
+from quern import core
+
+
+def make_config(**options):
+    defaults = {
+        'outdir': '',
+        'image_basename': 'test',
+        'minimize_keep': [],
+        'minimize_allow_missing_libraries': False,
+        'dockergen_entrypoint': ['/bin/true'],
+        'dockergen_command': [],
+    }
+    defaults.update(options)
+    return types.SimpleNamespace(**defaults)
+
+
+@unittest.skipUnless(os.path.isfile('/bin/true') and closure.read_elf('/bin/true'), "requires an ELF /bin/true")
+class MissingLibraryTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='quern-test-')
+        self.addCleanup(shutil.rmtree, self.root)
+        os.makedirs(os.path.join(self.root, 'bin'))
+        shutil.copy('/bin/true', os.path.join(self.root, 'bin', 'true'))
+        os.makedirs(os.path.join(self.root, 'usr', 'lib'))
+        with open(os.path.join(self.root, 'usr', 'lib', 'libother.so'), 'wb') as f:
+            f.write(b'not ELF')
+        os.makedirs(os.path.join(self.root, 'usr', 'share'))
+        with open(os.path.join(self.root, 'usr', 'share', 'data'), 'wb') as f:
+            f.write(b'data')
+
+    def test_missing_library_fails(self):
+        config = make_config(outdir=self.root)
+        with self.assertRaises(core.BuildError):
+            closure.RuntimeClosure(config, self.root).compute()
+
+    def test_allow_missing_keeps_library_folders(self):
+        config = make_config(outdir=self.root, minimize_allow_missing_libraries=True)
+        kept = closure.RuntimeClosure(config, self.root).compute()
+        self.assertIn('/bin/true', kept)
+        self.assertIn('/usr/lib/libother.so', kept)
+        self.assertNotIn('/usr/share/data', kept)
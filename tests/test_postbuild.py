@@ -0,0 +1,119 @@
+import importlib.util
+import json
+import os
+import os.path
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from quern import archive
+from quern import core
+from quern.postbuild import base
+from quern.postbuild import oci
+
+
+class FakeGetter:
+    """Minimal getconf.ConfigGetter, reading options from a {'section.key': value} dict."""
+
+    def __init__(self, options):
+        self.options = options
+
+    def _get(self, key, default):
+        return self.options.get(key, default)
+
+    def getstr(self, key, default='', doc=None):
+        return self._get(key, default)
+
+    def getint(self, key, default=0, doc=None):
+        value = self._get(key, default)
+        return None if value is None else int(value)
+
+    def getbool(self, key, default=False, doc=None):
+        return bool(self._get(key, default))
+
+    def getlist(self, key, default='', doc=None):
+        value = self._get(key, default)
+        return value if isinstance(value, list) else [part.strip() for part in value.split(',') if part.strip()]
+
+
+def make_config(outdir, **options):
+    options.setdefault('build.profile', 'default/linux/amd64')
+    options.setdefault('build.outdir', outdir)
+    return core.Config(FakeGetter(options), 'quern')
+
+
+class ImageConfigTests(unittest.TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp(prefix='quern-test-')
+        self.addCleanup(shutil.rmtree, self.outdir)
+
+    def test_reproducible_created(self):
+        config = make_config(self.outdir, **{
+            'build.reproducible': True,
+            'build.source_date_epoch': '1600000000',
+        })
+        image_config = base.BasePostBuilder(config).image_config(['sha256:abcd'])
+        self.assertEqual('2020-09-13T12:26:40Z', image_config['created'])
+        self.assertEqual([image_config['created']], [entry['created'] for entry in image_config['history']])
+
+    def test_reproducible_default_epoch(self):
+        config = make_config(self.outdir, **{'build.reproducible': True, 'build.source_date_epoch': ''})
+        image_config = base.BasePostBuilder(config).image_config([])
+        self.assertEqual('1970-01-01T00:00:00Z', image_config['created'])
+
+    def test_not_reproducible(self):
+        config = make_config(self.outdir, **{'build.source_date_epoch': '1600000000'})
+        image_config = base.BasePostBuilder(config).image_config([])
+        self.assertEqual(config.now.replace(microsecond=0).isoformat() + 'Z', image_config['created'])
+
+    def test_oci_layout(self):
+        config = make_config(self.outdir, **{
+            'build.reproducible': True,
+            'build.source_date_epoch': '1600000000',
+            'build.image_name': 'test.tar.gz',
+        })
+        root = os.path.join(self.outdir, 'root')
+        os.makedirs(os.path.join(root, 'etc'))
+        with open(os.path.join(root, 'etc', 'hostname'), 'w', encoding='utf-8') as f:
+            f.write('quern\n')
+        archive.pack(root, config.image_path, 'gzip', mtime=config.archive_mtime)
+
+        builder = oci.PostBuilder(config)
+        builder.run()
+
+        with open(os.path.join(builder.layout_path, 'index.json'), 'r', encoding='utf-8') as f:
+            manifest_digest = json.load(f)['manifests'][0]['digest']
+        with open(builder._blob_path(manifest_digest), 'r', encoding='utf-8') as f:
+            config_digest = json.load(f)['config']['digest']
+        with open(builder._blob_path(config_digest), 'r', encoding='utf-8') as f:
+            image_config = json.load(f)
+        self.assertEqual('2020-09-13T12:26:40Z', image_config['created'])
+        self.assertEqual(1, len(image_config['rootfs']['diff_ids']))
+
+
+@unittest.skipUnless(importlib.util.find_spec('docker'), "requires docker-py")
+class DockerImageArchiveTests(unittest.TestCase):
+    def test_reproducible_archive(self):
+        from quern.postbuild import docker
+
+        outdir = tempfile.mkdtemp(prefix='quern-test-')
+        self.addCleanup(shutil.rmtree, outdir)
+        config = make_config(outdir, **{
+            'build.reproducible': True,
+            'build.source_date_epoch': '1600000000',
+            'build.image_name': 'test.tar.gz',
+            'dockergen.name': 'quern/test',
+        })
+        root = os.path.join(outdir, 'root')
+        os.makedirs(root)
+        archive.pack(root, config.image_path, 'gzip', mtime=config.archive_mtime)
+
+        path = os.path.join(outdir, 'image.tar')
+        with open(path, 'wb') as f:
+            for chunk in docker.PostBuilder(config)._image_archive():
+                f.write(chunk)
+        with tarfile.open(path) as tar:
+            manifest = json.load(tar.extractfile('manifest.json'))
+            image_config = json.load(tar.extractfile(manifest[0]['Config']))
+        self.assertEqual('2020-09-13T12:26:40Z', image_config['created'])